@@ -0,0 +1,32 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""asgi: ASGI versions of the eom middlewares.
+
+Each module wraps an ASGI application the way its namesake wraps a
+WSGI one, taking its configuration from the same option group, e.g.
+eom.asgi.rbac from [eom:rbac]; the namesake's configure() must be
+called first. Requests of other scope types, such as websocket or
+lifespan, are passed through untouched.
+
+Redis is accessed through redis.asyncio clients, which require
+redis-py 4.2 or later. The package requires Python 3.7 or later, while
+the rest of eom keeps supporting older interpreters.
+"""
+
+import sys
+
+if sys.version_info < (3, 7):
+    raise ImportError('eom.asgi requires Python 3.7 or later')
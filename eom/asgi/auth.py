@@ -0,0 +1,680 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""auth: ASGI version of the eom.auth middleware.
+
+Takes its configuration from [eom:auth]; eom.auth.configure() must be
+called first. Tokens are cached and blacklisted in Redis as by
+eom.auth, so both may share a cache, through a redis.asyncio client.
+
+Keystone is called through aiohttp when it is installed, and otherwise
+through requests, from the default executor of the event loop.
+
+The options relying on threads of their own are not supported, and
+wrap() refuses them: refresh_ahead, blacklist_local_cache,
+pki_validation and hedge_requests. Cache entries due for an early
+refresh are validated again while serving the request, whatever
+early_refresh_background says, and served if that fails.
+"""
+
+import asyncio
+import functools
+import time
+import timeit
+
+from keystoneclient import exceptions
+import requests
+import simplejson as json
+
+from eom.asgi import common
+from eom import auth
+from eom.utils import circuit_breaker
+from eom.utils import endpoints as endpoints_util
+from eom.utils import limits
+from eom.utils import log as logging
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+LOG = logging.getLogger(__name__)
+
+UNSUPPORTED_OPTIONS = (
+    'refresh_ahead',
+    'blacklist_local_cache',
+    'pki_validation',
+    'hedge_requests',
+)
+
+
+class _Response(object):
+
+    """The parts of a requests.Response read from a Keystone answer."""
+
+    __slots__ = ('status_code', 'headers', 'content')
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class _Transport(object):
+
+    """Sends the requests made to Keystone."""
+
+    def __init__(self):
+        self._session = None
+
+    async def request(self, method, url, headers, body=None):
+        """Sends a request.
+
+        :returns: a requests.Response, or an object with its interface
+        """
+        if aiohttp is None:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, functools.partial(
+                requests.request, method, url, headers=headers, json=body))
+
+        # NOTE: The session is made on the first request, from the
+        # worker and event loop it is then used in.
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+
+        async with self._session.request(method, url, headers=headers,
+                                         json=body) as resp:
+            return _Response(resp.status, resp.headers, await resp.read())
+
+
+class RedisRateLimiter(limits.RedisRateLimiter):
+
+    """eom.utils.limits.RedisRateLimiter, through a redis.asyncio client."""
+
+    async def consume(self):
+        now = time.time()
+        window = int(now)
+        key = '{0}:{1}'.format(self._key, window)
+
+        try:
+            pipe = self._redis_client.pipeline(transaction=False)
+            pipe.incr(key)
+            pipe.pexpire(key, 2000)
+            count = (await pipe.execute())[0]
+        except Exception as ex:
+            LOG.warn('Failed to count call - {0}'.format(ex))
+            return 0
+
+        if count <= self._limit:
+            return 0
+
+        return window + 1 - now
+
+
+async def _blacklist_token(redis_client, token, expires_in):
+    """Stores the token to the blacklist data in the cache
+
+    See eom.auth._blacklist_token.
+
+    :returns: True on success, otherwise False
+    """
+    try:
+        strikes = None
+        if auth._counts_strikes(expires_in):
+            pipe = redis_client.pipeline(transaction=True)
+            auth._queue_strike(pipe, token)
+            strikes = (await pipe.execute())[0]
+
+        pipe = redis_client.pipeline(transaction=False)
+        auth._queue_blacklist_entry(pipe, token, expires_in, strikes)
+        await pipe.execute()
+
+        if strikes is not None and strikes > 1:
+            auth._incr('blacklist.repeat')
+
+    except Exception as ex:
+        msg = 'Failed to cache the data - Exception: {0}'.format(str(ex))
+        LOG.error(msg)
+        return False
+
+    return True
+
+
+async def _is_token_blacklisted(redis_client, token):
+    """Determines if the token is in the cached blacklist data"""
+    cached_key = auth._blacklist_cache_key(token)
+    try:
+        cached_data = await redis_client.get(cached_key)
+    except Exception as ex:
+        LOG.debug(
+            (
+                'Failed to retrieve data to cache for key {0} '
+                'Exception: {1}'
+            ).format(cached_key, str(ex))
+        )
+        return False
+
+    return cached_data is not None
+
+
+async def _is_source_blocked(redis_client, source, limit):
+    """Determines if a client address sent too many invalid tokens"""
+    try:
+        failures = await redis_client.get(auth._source_cache_key(source))
+    except Exception as ex:
+        LOG.debug('Failed to retrieve failures of {0} - {1}'.format(
+            source, str(ex)))
+        return False
+
+    return failures is not None and int(failures) >= limit
+
+
+async def _record_source_failure(redis_client, source):
+    """Counts an invalid token sent by a client address"""
+    if source is None:
+        return
+
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        auth._queue_source_failure(pipe, source)
+        await pipe.execute()
+    except Exception as ex:
+        LOG.debug('Failed to count failure of {0} - {1}'.format(
+            source, str(ex)))
+
+
+async def _send_data_to_cache(redis_client, url, access_info, max_cache_life,
+                              delta_ms=0):
+    """Stores the authentication data to cache
+
+    See eom.auth._send_data_to_cache.
+
+    :returns: True on success, otherwise False
+    """
+    try:
+        # NOTE: Commands are queued on an asyncio pipeline as on any
+        # other, so they are shared with eom.auth.
+        pipe = redis_client.pipeline(transaction=False)
+        if not auth._queue_cache_entry(pipe, url, access_info,
+                                       max_cache_life, delta_ms):
+            LOG.debug('Token expired, not caching it')
+            return False
+
+        await pipe.execute()
+        return True
+
+    except Exception as ex:
+        msg = 'Failed to cache the data - Exception: {0}'.format(str(ex))
+        LOG.error(msg)
+        return False
+
+
+async def _retrieve_data_from_cache(redis_client, url, tenant, token,
+                                    early_refresh_beta=0, refresh=None,
+                                    serve_stale=False):
+    """Retrieve the authentication data from cache
+
+    See eom.auth._retrieve_data_from_cache; refresh is a coroutine
+    function.
+
+    :returns: a keystoneclient.access.AccessInfo on success or None
+    """
+    cache_key = None
+    try:
+        cache_key = auth._access_cache_key(tenant, token, url)
+        cached_data = await redis_client.get(cache_key)
+    except Exception as ex:
+        LOG.debug(
+            (
+                'Failed to retrieve data to cache for key {0}'
+                'Exception: {1}'
+            ).format(cache_key, str(ex))
+        )
+        auth._incr('cache.error')
+        return None
+
+    if cached_data is None:
+        LOG.debug('No data in cache for key {0}'.format(cache_key))
+        auth._incr('cache.miss')
+        return None
+
+    access_info, refresh_due = auth._read_cache_record(
+        cached_data, early_refresh_beta=early_refresh_beta,
+        serve_stale=serve_stale)
+
+    if refresh_due and refresh is not None:
+        return await refresh() or access_info
+
+    return access_info
+
+
+class _Keystone(object):
+
+    """Validates tokens against Keystone, within the configured budgets.
+
+    Holds the circuit breaker, limits, endpoints and service token that
+    eom.auth keeps in module globals, so each wrapped app has its own.
+    """
+
+    def __init__(self, redis_client, group):
+        """Initializes the validator from the eom:auth options.
+
+        :param redis_client: redis.asyncio.Redis client
+        :param group: the eom:auth options
+        """
+        self._redis_client = redis_client
+        self._transport = _Transport()
+        self._v3 = group['auth_version'] == 'v3'
+        self._alternate = group['alternate_validation'] is True
+
+        self.breaker = None
+        if group['circuit_breaker_failures'] > 0:
+            self.breaker = circuit_breaker.CircuitBreaker(
+                group['circuit_breaker_failures'],
+                group['circuit_breaker_reset'])
+
+        self._bulkhead = None
+        if group['keystone_max_concurrency'] > 0:
+            self._bulkhead = limits.Bulkhead(
+                group['keystone_max_concurrency'])
+
+        self._rate_limiter = None
+        self._shared_rate = group['keystone_rate_shared']
+        if group['keystone_rate'] > 0:
+            if self._shared_rate:
+                self._rate_limiter = RedisRateLimiter(
+                    redis_client, auth.KEYSTONE_CALLS_KEY,
+                    group['keystone_rate'])
+            else:
+                self._rate_limiter = limits.TokenBucket(
+                    group['keystone_rate'], group['keystone_burst'])
+
+        auth_urls = group['auth_url'] or []
+        self._endpoints = None
+        if len(auth_urls) > 1:
+            self._endpoints = endpoints_util.Endpoints(auth_urls,
+                                                       hedge_percentile=None)
+
+        self._service_token = None
+        if self._v3 and group['service_username']:
+            self._service_token = auth.ServiceToken(
+                group['service_username'],
+                group['service_password'],
+                user_domain_name=group['service_user_domain_name'],
+                project_name=group['service_project_name'],
+                project_domain_name=group['service_project_domain_name'],
+                margin=group['service_token_margin'])
+
+    async def retrieve(self, url, tenant, token, blacklist_ttl,
+                       max_cache_life, source=None):
+        """Retrieve the authentication data from OpenStack Keystone
+
+        See eom.auth._retrieve_data_from_keystone.
+
+        :returns: a keystoneclient.access.AccessInfo on success or None
+        :raises KeystoneUnavailable: when the circuit breaker is open or
+                                     the call is over the Keystone call
+                                     budget
+        """
+        breaker = self.breaker
+        auth._check_circuit(breaker)
+
+        bulkhead = self._bulkhead
+        auth._enter_keystone_call(breaker, bulkhead)
+        try:
+            rate_limiter = self._rate_limiter
+            if rate_limiter is not None:
+                if self._shared_rate:
+                    wait = await rate_limiter.consume()
+                else:
+                    wait = rate_limiter.consume()
+                auth._check_keystone_rate(breaker, wait)
+
+            return await self._call(url, tenant, token, blacklist_ttl,
+                                    max_cache_life, source)
+        finally:
+            if bulkhead is not None:
+                bulkhead.release()
+
+    async def _call(self, url, tenant, token, blacklist_ttl, max_cache_life,
+                    source):
+        """Validate a token against Keystone and cache the result"""
+        redis_client = self._redis_client
+        breaker = self.breaker
+
+        start = timeit.default_timer()
+        answered = False
+        try:
+            access_info = await self._request(url, tenant, token)
+            answered = True
+            delta_ms = auth._keystone_call_succeeded(start)
+
+            await _send_data_to_cache(redis_client, url, access_info,
+                                      max_cache_life, delta_ms)
+
+            return access_info
+
+        except Exception as ex:
+            answered = auth._is_keystone_answer(ex)
+            if auth._keystone_call_failed(url, ex, start):
+                await _blacklist_token(redis_client, token, blacklist_ttl)
+                await _record_source_failure(redis_client, source)
+
+            return None
+        finally:
+            # NOTE: The outcome is recorded whatever is raised, cancellations
+            # included, so that no trial call is left pending.
+            auth._record_keystone_outcome(breaker, answered)
+
+    async def _request(self, url, tenant, token):
+        """Validate a token, failing over to another endpoint if any"""
+        endpoints = self._endpoints
+        if endpoints is None:
+            return await self._validate(url, tenant, token)
+
+        first = endpoints.choose()
+        try:
+            return await self._validate_at(first, tenant, token)
+        except Exception as ex:
+            if not auth._should_fail_over(endpoints, ex):
+                raise
+
+        auth._incr('keystone.failover')
+        return await self._validate_at(endpoints.choose(exclude=first),
+                                       tenant, token)
+
+    async def _validate_at(self, index, tenant, token):
+        """Validate a token against one of the endpoints, scoring it"""
+        endpoints = self._endpoints
+        start = timeit.default_timer()
+        try:
+            access_info = await self._validate(endpoints.urls[index],
+                                               tenant, token)
+        except Exception as ex:
+            auth._observe_endpoint(endpoints, index, start, ex)
+            raise
+
+        auth._observe_endpoint(endpoints, index, start)
+        return access_info
+
+    async def _validate(self, url, tenant, token):
+        """Validate a token against a Keystone endpoint
+
+        :returns: a keystoneclient.access.AccessInfo
+        :raises: a keystoneclient exception when the token is invalid,
+                 or the error met when Keystone could not be reached
+        """
+        if self._v3:
+            return await self._validate_v3(url, tenant, token)
+
+        if self._alternate:
+            _url = url.rstrip('/') + '/tokens'
+            resp = await self._transport.request(
+                'GET', _url + '/{0}'.format(token),
+                {'Accept': 'application/json', 'X-Auth-Token': token})
+            return auth._access_info_v2(resp, 'GET', _url)
+
+        # NOTE: Rescoped by keystoneclient, as with eom.auth, so that
+        # errors are reported the same way.
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, auth._validate_token_v2,
+                                          url, tenant, token)
+
+    async def _validate_v3(self, url, tenant, token):
+        """Validate a token against a Keystone v3 endpoint
+
+        See eom.auth._validate_token_v3; the service token is obtained
+        from the default executor of the event loop.
+        """
+        validation_url = url.rstrip('/') + '/auth/tokens'
+        if self._alternate:
+            validation_url += '?nocatalog'
+
+        service_token = self._service_token
+        if service_token is None:
+            resp = await self._request_token_v3(validation_url, token, token)
+            return auth._access_info_v3(resp, validation_url, tenant, token)
+
+        loop = asyncio.get_event_loop()
+        for _ in range(2):
+            auth_token = await loop.run_in_executor(None, service_token.get,
+                                                    url)
+            resp = await self._request_token_v3(validation_url, token,
+                                                auth_token)
+            if resp.status_code != 401:
+                return auth._access_info_v3(resp, validation_url, tenant,
+                                            token)
+            service_token.invalidate(auth_token)
+
+        raise auth._service_token_rejected(url)
+
+    async def _request_token_v3(self, validation_url, token, auth_token):
+        headers = {
+            'Accept': 'application/json',
+            'X-Auth-Token': auth_token,
+            'X-Subject-Token': token,
+        }
+        return await self._transport.request('GET', validation_url, headers)
+
+
+async def _get_access_info(redis_client, keystone, url, tenant, token,
+                           blacklist_ttl, max_cache_life, source=None):
+    """Retrieve the access information regarding the specified user
+
+    See eom.auth._get_access_info.
+
+    :returns: keystoneclient.access.AccessInfo for the user on success
+              None on error
+    """
+    group = auth.get_conf()
+    breaker = keystone.breaker
+
+    async def refresh():
+        try:
+            return await keystone.retrieve(url, tenant, token, blacklist_ttl,
+                                           max_cache_life, source=source)
+        except Exception as ex:
+            LOG.debug('Failed to refresh token - {0}'.format(str(ex)))
+            return None
+
+    access_info = auth._check_cached_access_info(
+        await _retrieve_data_from_cache(
+            redis_client, url, tenant, token,
+            early_refresh_beta=group.early_refresh_beta,
+            refresh=refresh,
+            serve_stale=breaker is not None and breaker.is_open()),
+        tenant)
+
+    if access_info is None:
+        LOG.debug('Failed to retrieve token from cache. Trying Keystone')
+        access_info = auth._check_validated_access_info(
+            await keystone.retrieve(url, tenant, token, blacklist_ttl,
+                                    max_cache_life, source=source),
+            tenant)
+    else:
+        LOG.debug('Retrieved token from cache.')
+
+    if access_info is not None and access_info.will_expire_soon():
+        LOG.info('Token has expired')
+        access_info = None
+
+    return access_info
+
+
+async def _validate_client(redis_client, keystone, url, tenant, token,
+                           address_env, blacklist_ttl, max_cache_life):
+    """Determine the identity of the user
+
+    :param address_env: REMOTE_ADDR and HTTP_X_FORWARDED_FOR of the
+                        request, as a WSGI environment would hold them
+
+    The other parameters are those of eom.auth._validate_client.
+
+    :returns: the identity environment of eom.auth._identity_env on
+              success, otherwise None
+    """
+    try:
+        source = None
+        group = auth.get_conf()
+        if group.source_failure_limit > 0:
+            source = auth._client_address(address_env,
+                                          group.source_trusted_proxies)
+            if source is not None and await _is_source_blocked(
+                    redis_client, source, group.source_failure_limit):
+                auth._incr('source.blocked')
+                return None
+
+        if await _is_token_blacklisted(redis_client, token):
+            auth._incr('blacklist.hit')
+            await _record_source_failure(redis_client, source)
+            return None
+
+        access_info = await _get_access_info(redis_client, keystone, url,
+                                             tenant, token, blacklist_ttl,
+                                             max_cache_life, source=source)
+
+        if access_info is None:
+            LOG.debug('Unable to get Access info for {0}'.format(tenant))
+            return None
+
+        return auth._identity_env(access_info, tenant)
+
+    except exceptions.RequestEntityTooLarge:
+        LOG.debug('Request entity too large error from authentication server.')
+        raise
+
+    except auth.KeystoneUnavailable:
+        LOG.debug('Authentication server unavailable.')
+        raise
+
+    except Exception as ex:
+        msg = 'Error while trying to authenticate against {0} - {1}'.format(
+            url,
+            str(ex)
+        )
+        LOG.debug(msg)
+        return None
+
+
+async def _http_precondition_failed(send):
+    """Responds with HTTP 412."""
+    await common.respond(send, 412)
+
+
+async def _http_unauthorized(send):
+    """Responds with HTTP 401."""
+    await common.respond(send, 401)
+
+
+async def _http_service_unavailable(send, delta):
+    """Responds with HTTP 503."""
+    retry_after = str(delta or auth.get_conf().retry_after)
+    await common.respond(send, 503,
+                         [(b'retry-after', retry_after.encode('latin-1'))])
+
+
+def wrap(app, redis_client, stats_client=None):
+    """Wrap an ASGI app with Authentication middleware.
+
+    Requires eom.auth.configure() be called first
+
+    :param app: ASGI app to wrap
+    :param redis_client: redis.asyncio.Redis client connected to the
+        redis cache
+    :param stats_client: object with the statsd.StatsClient interface,
+        as for eom.auth.wrap()
+
+    :returns: a new ASGI app that wraps the original
+    :raises ValueError: when an option the ASGI middleware does not
+        support is set
+    """
+    group = auth.get_conf()
+
+    for name in UNSUPPORTED_OPTIONS:
+        if group[name]:
+            raise ValueError('{0} is not supported by the ASGI '
+                             'middleware'.format(name))
+
+    auth._setup_stats(group, stats_client)
+
+    # NOTE: The first url is the one cache entries are stored under,
+    # as with eom.auth.
+    auth_urls = group['auth_url'] or []
+    auth_url = auth_urls[0] if auth_urls else None
+    blacklist_ttl = group['blacklist_ttl']
+    max_cache_life = group['max_cache_life']
+
+    keystone = _Keystone(redis_client, group)
+
+    LOG.debug('Auth URLs: {0}'.format(', '.join(auth_urls)))
+
+    # ASGI callable
+    async def middleware(scope, receive, send):
+        if scope['type'] != 'http':
+            return await app(scope, receive, send)
+
+        headers = common.headers(scope)
+        token = headers.get('x-auth-token')
+        tenant = headers.get('x-project-id')
+        if token is None or tenant is None:
+            # Header failure, error out with 412
+            LOG.error('Missing required headers.')
+            return await _http_precondition_failed(send)
+
+        client = scope.get('client')
+        address_env = {
+            'HTTP_X_FORWARDED_FOR': headers.get('x-forwarded-for', ''),
+            'REMOTE_ADDR': client[0] if client else None,
+        }
+
+        try:
+            identity = await _validate_client(redis_client, keystone,
+                                              auth_url, tenant, token,
+                                              address_env, blacklist_ttl,
+                                              max_cache_life)
+        except exceptions.RequestEntityTooLarge as exc:
+            auth._incr('unavailable')
+            LOG.error(
+                'Request too large, client should retry after {0}.'.format(
+                    exc.retry_after
+                )
+            )
+            return await _http_service_unavailable(send, exc.retry_after)
+
+        except auth.KeystoneUnavailable as exc:
+            auth._incr('unavailable')
+            LOG.error(
+                'Authentication server unavailable, client should retry '
+                'after {0}.'.format(exc.retry_after)
+            )
+            return await _http_service_unavailable(
+                send, max(1, exc.retry_after))
+
+        if identity is None:
+            # Validation failed for some reason, just error out as a 401
+            LOG.error('Auth Token validation failed.')
+            return await _http_unauthorized(send)
+
+        LOG.debug('Auth Token validated.')
+        return await app(common.with_headers(scope, identity), receive, send)
+
+    return middleware
@@ -0,0 +1,72 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""bastion: ASGI version of the eom.bastion middleware.
+
+Takes its configuration from [eom:bastion], where gate_headers are
+still given by their WSGI names, e.g. HTTP_X_FORWARDED_FOR;
+eom.bastion.configure() must be called first.
+"""
+
+from eom.asgi import common
+from eom import bastion
+from eom.utils import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+async def _http_gate_failure(send):
+    """Responds with HTTP 404"""
+    await common.respond(send, 404)
+
+
+def wrap(app_backdoor, app_gated):
+    """Creates a backdoor to a set of routes for the app.
+
+    :param app_backdoor: an entry point in the app that bypasses middleware
+    :type app_backdoor: asgi_app
+    :param app_gated: app all wrapped and safe
+    :type app_gated: asgi_app
+    :returns: a new ASGI app that wraps the original with bastion powers
+    :rtype: asgi_app
+    """
+    group = bastion.get_conf()
+    unrestricted_routes = group.unrestricted_routes
+    gate_headers = set(common.header_name(name)
+                       for name in group.gate_headers)
+
+    # ASGI callable
+    async def middleware(scope, receive, send):
+        if scope['type'] != 'http':
+            return await app_gated(scope, receive, send)
+
+        if len(gate_headers) > 0:
+            path = scope['path']
+            if path in unrestricted_routes:
+                contains_gate_headers = gate_headers.issubset(
+                    set(name for (name, _) in scope['headers']))
+                if not contains_gate_headers:
+                    return await app_backdoor(scope, receive, send)
+                else:
+                    return await _http_gate_failure(send)
+        else:
+            LOG.warn(
+                "Bastion is in use and gate_headers option is not configured."
+            )
+
+        # NOTE: not special route - keep calm and ASGI on
+        return await app_gated(scope, receive, send)
+
+    return middleware
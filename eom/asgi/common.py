@@ -0,0 +1,109 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""common: helpers shared by the ASGI middlewares."""
+
+_EMPTY_BODY = {'type': 'http.response.body', 'body': b''}
+
+
+def header_name(env_name):
+    """Converts the WSGI environ name of a header to its ASGI name.
+
+    e.g. HTTP_X_PROJECT_ID becomes b'x-project-id'.
+    """
+    if env_name.startswith('HTTP_'):
+        env_name = env_name[5:]
+
+    return env_name.lower().replace('_', '-').encode('latin-1')
+
+
+def header(scope, name):
+    """Gets the value of a request header.
+
+    :param scope: ASGI connection scope
+    :param bytes name: lowercase name of the header
+    :returns: the value, repeated headers joined with commas, or None
+    """
+    values = [value for (key, value) in scope['headers'] if key == name]
+    if not values:
+        return None
+
+    return b','.join(values).decode('latin-1')
+
+
+def headers(scope):
+    """Gets every request header.
+
+    :param scope: ASGI connection scope
+    :returns: a dict of the values by lowercase name, repeated headers
+        joined with commas
+    """
+    result = {}
+    for (key, value) in scope['headers']:
+        key = key.decode('latin-1')
+        value = value.decode('latin-1')
+        if key in result:
+            result[key] += ',' + value
+        else:
+            result[key] = value
+
+    return result
+
+
+def with_headers(scope, env):
+    """Copies a scope, setting request headers as a WSGI middleware would.
+
+    Headers of the request with the same names are dropped, so that a
+    client cannot add its own values to those set.
+
+    :param scope: ASGI connection scope
+    :param env: dict of the headers to set, by WSGI environ name; None
+        values remove the header
+    :returns: the new scope
+    """
+    added = []
+    removed = set()
+    for (env_name, value) in env.items():
+        if value is None:
+            removed.add(header_name(env_name))
+            continue
+
+        # NOTE: Unlike WSGI environ values, ASGI headers are bytes;
+        # values such as user names are sent as UTF-8.
+        if not isinstance(value, bytes):
+            value = str(value).encode('utf-8')
+
+        added.append((header_name(env_name), value))
+
+    names = set(name for (name, _) in added) | removed
+    scope = dict(scope)
+    scope['headers'] = [(key, value) for (key, value) in scope['headers']
+                        if key not in names] + added
+    return scope
+
+
+async def respond(send, status, headers=None):
+    """Sends a response without a body.
+
+    :param send: ASGI send callable
+    :param int status: HTTP status code
+    :param headers: list of (name, value) pairs of bytes
+    """
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-length', b'0')] + (headers or []),
+    })
+    await send(_EMPTY_BODY)
@@ -0,0 +1,120 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""governor: ASGI version of the eom.governor middleware.
+
+Takes its configuration from [eom:governor]; eom.governor.configure()
+must be called first. Buckets are kept in Redis as by eom.governor,
+so both may share them, through a redis.asyncio client.
+"""
+
+import asyncio
+import time
+
+import redis
+
+from eom.asgi import common
+from eom import governor
+from eom.utils import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+def _create_limiter(redis_client):
+    """Creates a closure with the given params for convenience and perf."""
+
+    async def check_limit(project_id, rate):
+        key = governor._bucket_key(project_id)
+        now = time.time()
+        new_count = 1.0
+
+        try:
+            lookup = await redis_client.hmget(key, 'c', 't')
+            new_count = governor._new_count(lookup, now, rate)
+            await redis_client.hset(key, mapping={'c': new_count, 't': now})
+
+        except redis.exceptions.ConnectionError as ex:
+            message = 'Redis Error:{0} for Project-ID:{1}'
+            LOG.warn(message.format(ex, project_id))
+
+        if new_count > rate.limit:
+            raise governor.HardLimitError()
+
+    return check_limit
+
+
+async def _http_429(send):
+    """Responds with HTTP 429."""
+    await common.respond(send, 429)
+
+
+async def _http_400(send):
+    """Responds with HTTP 400."""
+    await common.respond(send, 400)
+
+
+def wrap(app, redis_client):
+    """Wrap an ASGI app with rate limiting middleware.
+
+    :param app: ASGI app to wrap
+    :param redis_client: redis.asyncio.Redis client
+    :returns: a new ASGI app that wraps the original
+    """
+    group = governor.get_conf()
+
+    throttle_seconds = group['throttle_milliseconds'] / 1000
+
+    rates = governor._load_rates(group['rates_file'])
+    project_rates = governor._load_project_rates(group['project_rates_file'])
+
+    check_limit = _create_limiter(redis_client)
+
+    # ASGI callable
+    async def middleware(scope, receive, send):
+        if scope['type'] != 'http':
+            return await app(scope, receive, send)
+
+        project_id = common.header(scope, b'x-project-id')
+        if project_id is None:
+            LOG.debug('Request headers did not include X-Project-ID')
+            return await _http_400(send)
+
+        rate = governor.match_rate(project_id, scope['method'], scope['path'],
+                                   project_rates, rates)
+        if rate is None:
+            LOG.debug('Requested path not recognized. Full steam ahead!')
+            return await app(scope, receive, send)
+
+        try:
+            await check_limit(project_id, rate)
+        except governor.HardLimitError:
+            message = (
+                'Hit limit of {rate} per sec. for '
+                'project {project_id} according to '
+                'rate rule "{name}"'
+            )
+
+            # NOTE: Only this request waits; the event loop serves
+            # the others meanwhile.
+            await asyncio.sleep(throttle_seconds)
+
+            LOG.warn(message.format(rate=rate.limit,
+                                    project_id=project_id,
+                                    name=rate.name))
+            return await _http_429(send)
+
+        return await app(scope, receive, send)
+
+    return middleware
@@ -0,0 +1,102 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""metrics: ASGI version of the eom.metrics middleware.
+
+Takes its configuration from [eom:metrics]; eom.metrics.configure()
+must be called first. Metrics are reported through the client shared
+with eom.metrics; statsd packets are sent without waiting, so they do
+not block the event loop.
+"""
+
+import time
+
+from eom import metrics
+
+
+def wrap(app):
+    """Wrap an ASGI app with metrics middleware.
+
+    :param app: ASGI app to wrap
+    :returns: a new ASGI app that wraps the original
+    """
+    group = metrics.get_conf()
+    regex = metrics._path_regexes(group)
+    histograms = group.histograms
+    timing_sample_rate = group.timing_sample_rate
+
+    client = metrics.get_client()
+    base_path = metrics.stat_prefix()
+
+    # initialize buckets
+    metrics._init_buckets(client, base_path, regex)
+
+    # ASGI callable
+    async def middleware(scope, receive, send):
+        if scope['type'] != 'http':
+            return await app(scope, receive, send)
+
+        request_method = scope['method']
+        api_method = metrics._api_method(regex, scope['path'])
+
+        started = []
+        report = metrics._reporter(client, base_path, request_method,
+                                   api_method, histograms,
+                                   timing_sample_rate, started)
+
+        start = time.time() * 1000
+        first_byte = None
+        sent = 0
+        done = False
+
+        def _done():
+            nonlocal done
+            if done:
+                return
+
+            done = True
+            stop = time.time() * 1000
+            report((first_byte or stop) - start, stop - start, sent)
+
+        async def _send(message):
+            nonlocal first_byte
+            nonlocal sent
+
+            if message['type'] == 'http.response.start':
+                started[:] = [message['status'], message.get('headers', [])]
+                return await send(message)
+
+            if message['type'] == 'http.response.body':
+                body = message.get('body', b'')
+                if body:
+                    if first_byte is None:
+                        first_byte = time.time() * 1000
+                    sent += len(body)
+
+                await send(message)
+                if not message.get('more_body', False):
+                    _done()
+                return
+
+            await send(message)
+
+        try:
+            await app(scope, receive, _send)
+        finally:
+            # NOTE: The app may fail or the client may go away before
+            # the body is complete.
+            _done()
+
+    return middleware
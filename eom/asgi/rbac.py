@@ -0,0 +1,80 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""rbac: ASGI version of the eom.rbac middleware.
+
+Takes its configuration from [eom:rbac]; eom.rbac.configure() must be
+called first.
+"""
+
+from eom.asgi import common
+from eom import rbac
+from eom.utils import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+async def _http_forbidden(send):
+    """Responds with HTTP 403."""
+    await common.respond(send, 403)
+
+
+def wrap(app):
+    """Wrap an ASGI app with ACL middleware.
+
+    :param app: ASGI app to wrap
+    :returns: a new ASGI app that wraps the original
+    """
+    rules = rbac._load_rules(rbac.get_conf()[rbac.OPTION_NAME])
+    acl_map = rbac._create_acl_map(rules)
+
+    # ASGI callable
+    async def middleware(scope, receive, send):
+        if scope['type'] != 'http':
+            return await app(scope, receive, send)
+
+        path = scope['path']
+        for resource, route, acl in acl_map:
+            if route.match(path):
+                break
+        else:
+            LOG.debug('Requested path not recognized. Skipping RBAC.')
+            return await app(scope, receive, send)
+
+        roles = common.header(scope, b'x-roles')
+        if roles is None:
+            LOG.error('Request headers did not include X-Roles')
+            return await _http_forbidden(send)
+
+        given_roles = set(roles.split(',')) if roles else rbac.EMPTY_SET
+
+        method = scope['method']
+        try:
+            authorized_roles = acl[method]
+        except KeyError:
+            LOG.error('HTTP method not supported: {0}'.format(method))
+            return await _http_forbidden(send)
+
+        # The user must have one of the roles that
+        # is authorized for the requested method.
+        if (authorized_roles & given_roles):
+            # Carry on
+            return await app(scope, receive, send)
+
+        log_line = 'User not authorized to {0} the {1} resource'
+        LOG.info(log_line.format(method, resource))
+        return await _http_forbidden(send)
+
+    return middleware
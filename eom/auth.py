@@ -14,34 +14,145 @@
 # limitations under the License.
 
 import base64
+import calendar
 import datetime
 import functools
 import hashlib
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+import timeit
 
 from keystoneclient import access
+from keystoneclient.common import cms
 from keystoneclient import exceptions
 from keystoneclient.v2_0 import client as keystonev2_client
 import msgpack
 from oslo_config import cfg
-import redis
 from redis import connection
 import requests
 import simplejson as json
 import six
 
+from eom import metrics
+from eom.utils import circuit_breaker
+from eom.utils import endpoints as endpoints_util
+from eom.utils import expiring_set
+from eom.utils import fork
+from eom.utils import heavy_hitters
+from eom.utils import limits
 from eom.utils import log as logging
+from eom.utils import redis_pool
+from eom.utils import stats
 
 _CONF = cfg.CONF
 LOG = logging.getLogger(__name__)
 
+# NOTE: Set by wrap() when metrics are reported.
+_STATS = stats.NullClient()
+_STAT_PREFIX = ''
+
+# NOTE: Cache keys of the tokens being refreshed in the background by
+# this process, with the time their refresh started. A refresh that is
+# not done after REFRESH_TIMEOUT seconds, e.g. because its thread never
+# ran, is dropped.
+_REFRESHING = {}
+_REFRESHING_LOCK = threading.Lock()
+REFRESH_TIMEOUT = 60
+
+# NOTE: Set by wrap() when the refresh_ahead option is set.
+_REFRESH_AHEAD = None
+
+# NOTE: Set by wrap() when the circuit_breaker_failures option is set.
+_BREAKER = None
+
+# NOTE: Set by wrap() when the keystone_max_concurrency and keystone_rate
+# options are set.
+_BULKHEAD = None
+_RATE_LIMITER = None
+
+# NOTE: Set by wrap() when the blacklist_local_cache option is set.
+_BLACKLIST_FILTER = None
+
+# NOTE: Set by wrap() when several auth urls are given or requests are
+# hedged.
+_ENDPOINTS = None
+
+# NOTE: Set by wrap() when v3 service credentials are configured.
+_SERVICE_TOKEN = None
+
+# NOTE: Set by wrap() when the pki_validation option is set.
+_PKI = None
+
 MAX_CACHE_LIFE_DEFAULT = ((datetime.datetime.max -
                            datetime.datetime.utcnow()).total_seconds() - 30)
 
+CACHE_KEY_PREFIX = 'eom:auth:'
+KEYSTONE_CALLS_KEY = CACHE_KEY_PREFIX + '{keystone}:calls'
+BLACKLIST_CHANNEL = CACHE_KEY_PREFIX + 'blacklist'
+
+# NOTE: Cache entries are stored as
+# [version, expires_ms, delta_ms, data, catalog_data], where delta_ms is
+# the time Keystone took to validate the token, data the access
+# information without its service catalog, and catalog_data the UTF-8
+# JSON forwarded as the service catalog, if any. Version 1 entries have
+# no catalog_data and keep the catalog in data.
+CACHE_RECORD_VERSION = 2
+CATALOG_KEYS = ('serviceCatalog', 'catalog')
+
+# NOTE: Set from the validated token only; values sent by the client are
+# replaced, or removed when the token has none.
+IDENTITY_ENV = (
+    'HTTP_X_IDENTITY_STATUS',
+    'HTTP_X_USER_ID',
+    'HTTP_X_USER_NAME',
+    'HTTP_X_USER_DOMAIN_ID',
+    'HTTP_X_USER_DOMAIN_NAME',
+    'HTTP_X_ROLES',
+    'HTTP_X_SERVICE_CATALOG',
+    'HTTP_X_PROJECT_ID',
+    'HTTP_X_PROJECT_NAME',
+    'HTTP_X_PROJECT_DOMAIN_ID',
+    'HTTP_X_PROJECT_DOMAIN_NAME',
+    'HTTP_X_DOMAIN_ID',
+    'HTTP_X_DOMAIN_NAME',
+)
+
+# NOTE: Adds ARGV[2] to the index KEYS[1] with the score ARGV[1], drops
+# the entries expired at ARGV[3], and extends the life of the index to
+# ARGV[4] milliseconds, unless it already lives longer.
+INDEX_SCRIPT = '''
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[3])
+if redis.call('PTTL', KEYS[1]) < tonumber(ARGV[4]) then
+    redis.call('PEXPIRE', KEYS[1], ARGV[4])
+end
+'''
+
 AUTH_GROUP_NAME = 'eom:auth'
 AUTH_OPTIONS = [
-    cfg.StrOpt(
+    cfg.ListOpt(
         'auth_url',
-        help='Identity url to authenticate tokens.'
+        help=(
+            'Identity urls to authenticate tokens, all of the same Keystone. '
+            'The first one also identifies it in the cache keys.'
+        )
+    ),
+    cfg.BoolOpt(
+        'hedge_requests',
+        default=False,
+        help=(
+            'Send a request to Keystone again, to another identity url, '
+            'when it takes longer than hedge_percentile of the recent ones.'
+        )
+    ),
+    cfg.FloatOpt(
+        'hedge_percentile',
+        default=95,
+        help='Percentile of the Keystone latencies after which to hedge.'
     ),
     cfg.BoolOpt(
         'alternate_validation',
@@ -52,10 +163,145 @@ AUTH_OPTIONS = [
             'this option is set to True.'
         )
     ),
+    cfg.StrOpt(
+        'auth_version',
+        default='v2.0',
+        choices=['v2.0', 'v3'],
+        help=(
+            'Identity API version of the auth urls. With v3, '
+            'alternate_validation validates tokens without their catalog.'
+        )
+    ),
+    cfg.StrOpt(
+        'service_username',
+        help=(
+            'User validating tokens against the v3 API, and fetching '
+            'the PKI revocation list. When not set, tokens validate '
+            'themselves.'
+        )
+    ),
+    cfg.StrOpt(
+        'service_password',
+        secret=True,
+        help='Password of the service user.'
+    ),
+    cfg.StrOpt(
+        'service_user_domain_name',
+        default='Default',
+        help='Domain of the service user.'
+    ),
+    cfg.StrOpt(
+        'service_project_name',
+        help='Project the service token is scoped to, if any.'
+    ),
+    cfg.StrOpt(
+        'service_project_domain_name',
+        default='Default',
+        help='Domain of the service project.'
+    ),
+    cfg.IntOpt(
+        'service_token_margin',
+        default=300,
+        help=(
+            'Time in seconds before its expiration at which the service '
+            'token is renewed.'
+        )
+    ),
+    cfg.BoolOpt(
+        'pki_validation',
+        default=False,
+        help=(
+            'Validate signed (PKI and PKIZ) tokens locally, checking them '
+            'against the revocation list of Keystone. Requires service '
+            'credentials.'
+        )
+    ),
+    cfg.StrOpt(
+        'pki_signing_dir',
+        help=(
+            'Directory the signing and CA certificates of Keystone are '
+            'stored in; a temporary directory when not set.'
+        )
+    ),
+    cfg.IntOpt(
+        'pki_revocation_interval',
+        default=10,
+        help='Time in seconds between fetches of the revocation list.'
+    ),
+    cfg.ListOpt(
+        'pki_hash_algorithms',
+        default=['md5'],
+        help='Algorithms the revocation list may hash token ids with.'
+    ),
     cfg.IntOpt(
         'blacklist_ttl',
         help='Time to live in milliseconds for tokens marked as unauthorized.'
     ),
+    cfg.BoolOpt(
+        'token_cache',
+        default=False,
+        help=(
+            'Cache the validation of each token once, whatever the project '
+            'it is used with, and check the requested project against the '
+            'scope and roles of the token. Ignored with auth_version v2.0 '
+            'unless alternate_validation is set, since Keystone then '
+            'rescopes tokens to each project.'
+        )
+    ),
+    cfg.BoolOpt(
+        'cache_index',
+        default=False,
+        help=(
+            'Index cache entries by tenant and user, so that those of a '
+            'tenant or user can be invalidated at once.'
+        )
+    ),
+    cfg.IntOpt(
+        'blacklist_max_ttl',
+        default=0,
+        help=(
+            'Maximum time to live in milliseconds for tokens marked as '
+            'unauthorized again and again; the time to live doubles every '
+            'time, from blacklist_ttl. 0 keeps it fixed.'
+        )
+    ),
+    cfg.BoolOpt(
+        'blacklist_local_cache',
+        default=False,
+        help=(
+            'Keep the blacklisted tokens in memory, in sync with the other '
+            'processes through Redis pub/sub, to skip the blacklist lookup '
+            'for the other tokens.'
+        )
+    ),
+    cfg.IntOpt(
+        'blacklist_local_size',
+        default=10000,
+        help='Maximum number of blacklisted tokens kept in memory.'
+    ),
+    cfg.IntOpt(
+        'source_failure_limit',
+        default=0,
+        help=(
+            'Number of invalid tokens a client address may send within '
+            'source_failure_window before its requests are rejected without '
+            'checking their token. 0 disables it.'
+        )
+    ),
+    cfg.IntOpt(
+        'source_failure_window',
+        default=60,
+        help='Seconds over which invalid tokens are counted per address.'
+    ),
+    cfg.IntOpt(
+        'source_trusted_proxies',
+        default=1,
+        help=(
+            'Number of proxies in front of the app that append to the '
+            'X-Forwarded-For header; the client address is taken that many '
+            'entries from the end. 0 uses the address of the peer.'
+        )
+    ),
     cfg.IntOpt(
         'max_cache_life',
         help='Time to live in seconds for valid tokens.',
@@ -72,6 +318,112 @@ AUTH_OPTIONS = [
             'seconds to wait before retrying the request '
             'again upon getting (503 Service Unavailable) error.'
         )
+    ),
+    cfg.BoolOpt(
+        'report_metrics',
+        default=False,
+        help=(
+            'Report cache and Keystone statistics through the eom:metrics '
+            'client. Requires eom.metrics to be configured.'
+        )
+    ),
+    cfg.FloatOpt(
+        'early_refresh_beta',
+        default=0.0,
+        help=(
+            'How eagerly cached tokens are validated again before their '
+            'cache entry expires; higher is earlier, 1.0 is a good start. '
+            '0 disables it.'
+        )
+    ),
+    cfg.BoolOpt(
+        'early_refresh_background',
+        default=False,
+        help=(
+            'Validate tokens again from a background thread, serving the '
+            'request from the cache meanwhile, rather than from the request '
+            'that triggers the refresh.'
+        )
+    ),
+    cfg.BoolOpt(
+        'refresh_ahead',
+        default=False,
+        help=(
+            'Track the most used tokens and validate them again from a '
+            'background thread shortly before their cache entry expires.'
+        )
+    ),
+    cfg.IntOpt(
+        'refresh_ahead_tokens',
+        default=100,
+        help='Maximum number of tokens tracked by each process.'
+    ),
+    cfg.IntOpt(
+        'refresh_ahead_margin',
+        default=60,
+        help=(
+            'Seconds before the expiration of the cache entry of a tracked '
+            'token when it is validated again; should be more than '
+            'refresh_ahead_interval.'
+        )
+    ),
+    cfg.FloatOpt(
+        'refresh_ahead_interval',
+        default=10.0,
+        help='Average seconds between two checks of the tracked tokens.'
+    ),
+    cfg.IntOpt(
+        'circuit_breaker_failures',
+        default=0,
+        help=(
+            'Consecutive Keystone errors after which Keystone is not called '
+            'anymore for a while and cache misses fail with a 503; '
+            '0 disables the circuit breaker.'
+        )
+    ),
+    cfg.IntOpt(
+        'circuit_breaker_reset',
+        default=30,
+        help='Seconds before Keystone is tried again once the circuit opened.'
+    ),
+    cfg.IntOpt(
+        'stale_grace',
+        default=0,
+        help=(
+            'Seconds valid tokens are kept in the cache past max_cache_life, '
+            'to be served while the circuit breaker is open.'
+        )
+    ),
+    cfg.IntOpt(
+        'keystone_max_concurrency',
+        default=0,
+        help=(
+            'Maximum number of concurrent Keystone calls made by a process; '
+            'cache misses over it fail with a 503. 0 means no limit.'
+        )
+    ),
+    cfg.FloatOpt(
+        'keystone_rate',
+        default=0,
+        help=(
+            'Maximum number of Keystone calls per second; cache misses over '
+            'it fail with a 503. 0 means no limit.'
+        )
+    ),
+    cfg.IntOpt(
+        'keystone_burst',
+        help=(
+            'Number of Keystone calls that may be made at once by a process '
+            'within keystone_rate; keystone_rate by default.'
+        )
+    ),
+    cfg.BoolOpt(
+        'keystone_rate_shared',
+        default=False,
+        help=(
+            'Apply keystone_rate to every process using the auth Redis '
+            'server, rather than to each process.'
+        )
     )
 ]
 
@@ -86,6 +438,14 @@ REDIS_OPTIONS = [
     cfg.StrOpt('ssl_certfile', default=None),
     cfg.StrOpt('ssl_cert_reqs', default=None),
     cfg.StrOpt('ssl_ca_certs', default=None),
+    cfg.ListOpt(
+        'replicas',
+        default=[],
+        help=(
+            'host:port of replicas of the Redis server, to which cache '
+            'lookups are sent. Ignored with a Redis Cluster.'
+        )
+    ),
 ]
 
 
@@ -101,6 +461,18 @@ class UnknownAuthenticationDataVersion(Exception):
     pass
 
 
+class ServiceAuthenticationFailed(Exception):
+    pass
+
+
+class KeystoneUnavailable(Exception):
+
+    def __init__(self, retry_after):
+        super(KeystoneUnavailable, self).__init__(
+            'Keystone unavailable, retry after {0}s'.format(retry_after))
+        self.retry_after = retry_after
+
+
 def configure(config):
     global _CONF
     global LOG
@@ -108,334 +480,2001 @@ def configure(config):
     _CONF = config
     _CONF.register_opts(AUTH_OPTIONS, group=AUTH_GROUP_NAME)
     _CONF.register_opts(REDIS_OPTIONS, group=REDIS_GROUP_NAME)
+    redis_pool.register_pool_options(_CONF, REDIS_GROUP_NAME)
 
     logging.register(_CONF, AUTH_GROUP_NAME)
     logging.setup(_CONF, AUTH_GROUP_NAME)
     LOG = logging.getLogger(__name__)
 
 
-def get_conf(redis_config=False):
-    global _CONF
-    if redis_config:
-        return _CONF[REDIS_GROUP_NAME]
-    else:
-        return _CONF[AUTH_GROUP_NAME]
+def get_conf(redis_config=False):
+    global _CONF
+    if redis_config:
+        return _CONF[REDIS_GROUP_NAME]
+    else:
+        return _CONF[AUTH_GROUP_NAME]
+
+
+def get_auth_redis_client():
+    """Get a Redis Client connection from the pool
+
+    uses the eom:auth_redis settings; the pool is shared by every
+    client returned, or a Redis Cluster client when cluster is set.
+    Lookups go to the replicas, if any.
+    """
+    group = _CONF[REDIS_GROUP_NAME]
+
+    kwargs = {
+        'password': group['password'],
+    }
+    if group['ssl_enable']:
+        kwargs.update(ssl_keyfile=group['ssl_keyfile'],
+                      ssl_certfile=group['ssl_certfile'],
+                      ssl_cert_reqs=group['ssl_cert_reqs'],
+                      ssl_ca_certs=group['ssl_ca_certs'])
+
+    # NOTE: A Redis Cluster only has the database 0.
+    if group['cluster']:
+        if group['ssl_enable']:
+            kwargs['ssl'] = True
+        return redis_pool.get_cluster_client(REDIS_GROUP_NAME, _CONF,
+                                             **kwargs)
+
+    kwargs['db'] = group['redis_db']
+    if group['ssl_enable']:
+        kwargs['connection_class'] = connection.SSLConnection
+
+    pool = redis_pool.get_pool(REDIS_GROUP_NAME, _CONF, **kwargs)
+    client = redis_pool.make_client(pool)
+
+    if group['replicas']:
+        replicas = [
+            redis_pool.make_client(
+                redis_pool.get_pool(REDIS_GROUP_NAME, _CONF, node=node,
+                                    **kwargs))
+            for node in group['replicas']
+        ]
+        client = redis_pool.ReplicatedClient(client, replicas)
+
+    return client
+
+
+def _incr(stat):
+    _STATS.incr(_STAT_PREFIX + stat)
+
+
+def _timing(stat, start):
+    _STATS.timing(_STAT_PREFIX + stat, (timeit.default_timer() - start) * 1000)
+
+
+def _tuple_to_cache_key(t):
+    """Convert a tuple to a cache key."""
+    key_data = '(%(s_data)s)' % {
+        's_data': ','.join(t)
+    }
+    if six.PY3:
+        key_data = key_data.encode('utf-8')
+
+    key = hashlib.sha1()
+    key.update(key_data)
+    return key.hexdigest()
+
+
+def _token_hash(token):
+    """Hash a token, so it is not stored or sent as is"""
+    key_data = token
+    if six.PY3:
+        key_data = key_data.encode('utf-8')
+
+    key = hashlib.sha1()
+    key.update(key_data)
+    return key.hexdigest()
+
+
+def _token_key_prefix(token):
+    """Build the prefix shared by every cache key of a token
+
+    The hash of the token is wrapped in braces so it is the Redis Cluster
+    hash tag of the keys, which then all map to the same slot.
+    """
+    return '%(prefix)s{%(tag)s}:' % {
+        'prefix': CACHE_KEY_PREFIX,
+        'tag': _token_hash(token)
+    }
+
+
+def _cache_key(tenant, token, url):
+    """Build the cache key of the authentication data for a token"""
+    return _token_key_prefix(token) + _tuple_to_cache_key((tenant, token, url))
+
+
+def _token_cache_key(token, url):
+    """Build the cache key of the authentication data for a token alone"""
+    return _token_key_prefix(token) + _tuple_to_cache_key((token, url))
+
+
+def _token_cache_enabled():
+    """Determines if tokens are cached once for all of their tenants
+
+    Keystone v2.0 rescopes a token to the tenant it is validated for,
+    unless alternate_validation is set; each tenant then needs an entry
+    of its own, whatever token_cache says.
+    """
+    group = get_conf()
+    return group.token_cache and (group.auth_version == 'v3' or
+                                  group.alternate_validation is True)
+
+
+def _access_cache_key(tenant, token, url):
+    """Build the cache key of the authentication data for a request
+
+    :returns: the key of the token alone when token_cache is set, or of
+              the token and the tenant otherwise
+    """
+    if _token_cache_enabled():
+        return _token_cache_key(token, url)
+    return _cache_key(tenant, token, url)
+
+
+def _blacklist_cache_key(t):
+    """Convert token to a cache key for blacklists"""
+    return _token_key_prefix(t) + 'blacklist'
+
+
+def _strikes_cache_key(t):
+    """Convert token to a cache key for its count of blacklistings"""
+    return _token_key_prefix(t) + 'strikes'
+
+
+def _source_cache_key(source):
+    """Build the cache key of the count of failures of a client address"""
+    return '%(prefix)s{source:%(source)s}:failures' % {
+        'prefix': CACHE_KEY_PREFIX,
+        'source': source
+    }
+
+
+def _tenant_index_key(tenant):
+    """Build the key of the index of the cache entries of a tenant"""
+    return '%(prefix)s{tenant:%(tenant)s}:entries' % {
+        'prefix': CACHE_KEY_PREFIX,
+        'tenant': tenant
+    }
+
+
+def _user_index_key(user_id):
+    """Build the key of the index of the cache entries of a user"""
+    return '%(prefix)s{user:%(user)s}:entries' % {
+        'prefix': CACHE_KEY_PREFIX,
+        'user': user_id
+    }
+
+
+__packer = msgpack.Packer(encoding='utf-8', use_bin_type=True)
+__unpacker = functools.partial(msgpack.unpackb, encoding='utf-8')
+
+
+class BlacklistFilter(object):
+
+    """Local view of the blacklisted tokens, to skip most lookups.
+
+    Tokens are blacklisted in Redis as usual, and their hash is also
+    published on the blacklist channel. Every process keeps the hashes
+    it hears about, until their blacklisting expires, in a bounded set
+    listened for by a daemon thread.
+
+    A token missing from the set is known not to be blacklisted only
+    once the process has been subscribed for longer than any token may
+    be blacklisted; until then, and whenever the subscription drops or
+    the set overflows, lookups go to Redis.
+    """
+
+    def __init__(self, redis_client, capacity=10000, warmup=3600.0):
+        """Initializes the filter.
+
+        :param redis_client: redis.Redis object connected to the redis cache
+        :param int capacity: maximum number of tokens kept
+        :param float warmup: seconds the process must be subscribed before
+                             its view is complete; the longest time a token
+                             may be blacklisted
+        """
+        self._redis_client = redis_client
+        self._capacity = capacity
+        self._warmup = warmup
+
+        self._lock = threading.Lock()
+        self._tokens = expiring_set.ExpiringSet(capacity)
+        self._subscribed_at = None
+
+        self._listener = None
+        self._stop = threading.Event()
+
+        fork.register(self._after_fork)
+
+    def add(self, token_hash, ttl):
+        """Keeps a blacklisted token for ttl milliseconds."""
+        with self._lock:
+            self._tokens.add(token_hash, ttl / 1000.0)
+
+    def may_contain(self, token_hash):
+        """Tells whether a token may be blacklisted.
+
+        :returns: False only if the token is certainly not blacklisted
+        """
+        self._ensure_listener()
+
+        subscribed_at = self._subscribed_at
+        if (subscribed_at is None or
+                timeit.default_timer() - subscribed_at < self._warmup):
+            return True
+
+        with self._lock:
+            return self._tokens.may_contain(token_hash)
+
+    def publish(self, token_hash, ttl):
+        """Tells every process a token is blacklisted for ttl milliseconds."""
+        self.add(token_hash, ttl)
+        try:
+            self._redis_client.publish(
+                BLACKLIST_CHANNEL, '{0} {1}'.format(token_hash, int(ttl)))
+        except Exception as ex:
+            LOG.debug('Failed to publish blacklisted token - {0}'.format(ex))
+
+    def stop(self):
+        """Stops the listener thread, if any."""
+        self._stop.set()
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._tokens = expiring_set.ExpiringSet(self._capacity)
+        self._subscribed_at = None
+        self._listener = None
+
+    def _ensure_listener(self):
+        if self._listener is not None and self._listener.is_alive():
+            return
+
+        if self._listener is not None:
+            fork.postfork()
+
+        self._listener = threading.Thread(target=self._run,
+                                          name='eom-auth-blacklist')
+        self._listener.daemon = True
+        self._listener.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._listen()
+            except Exception as ex:
+                LOG.warn('Blacklist subscription failed: {0}'.format(ex))
+
+            # NOTE: Messages may have been missed meanwhile.
+            self._subscribed_at = None
+            self._stop.wait(1.0)
+
+    def _listen(self):
+        pubsub = self._redis_client.pubsub()
+        try:
+            pubsub.subscribe(BLACKLIST_CHANNEL)
+            while not self._stop.is_set():
+                message = pubsub.get_message(timeout=1.0)
+                if message is None:
+                    continue
+
+                # NOTE: A subscription confirmation also follows every
+                # reconnection, after which messages may have been missed.
+                if message['type'] == 'subscribe':
+                    self._subscribed_at = timeit.default_timer()
+                elif message['type'] == 'message':
+                    self._on_message(message['data'])
+        finally:
+            pubsub.close()
+
+    def _on_message(self, data):
+        if isinstance(data, six.binary_type):
+            data = data.decode('utf-8')
+
+        try:
+            token_hash, ttl = data.split()
+            self.add(token_hash, int(ttl))
+        except ValueError:
+            LOG.debug('Invalid blacklist message: {0}'.format(data))
+
+
+def _get_blacklist_ttl(expires_in, max_expires_in, strikes):
+    """Determines how long a token is blacklisted for
+
+    :param expires_in: time in milliseconds for blacklisting failed tokens
+    :param max_expires_in: maximum time in milliseconds for blacklisting
+                           tokens that failed repeatedly
+    :param strikes: number of times the token was blacklisted, this one
+                    included
+
+    :returns: expires_in doubled for every strike after the first one, up
+              to max_expires_in
+    """
+    # NOTE: The exponent is capped so the product never gets huge.
+    return min(expires_in * 2 ** min(strikes - 1, 32), max_expires_in)
+
+
+def _blacklist_value(strikes):
+    """Pack the value of a blacklist entry
+
+    :param strikes: number of times the token was blacklisted, or True
+                    when they are not counted
+    """
+    return __packer.pack(strikes)
+
+
+def _counts_strikes(expires_in):
+    """Tells whether the blacklisting of tokens is counted
+
+    :param expires_in: time in milliseconds for blacklisting failed tokens
+    """
+    max_expires_in = get_conf().blacklist_max_ttl
+    return bool(max_expires_in) and max_expires_in > expires_in
+
+
+def _queue_strike(pipe, token):
+    """Counts the blacklisting of a token
+
+    The count is the result of the first command queued. It is given the
+    longest life it may need along with its increment, so that it
+    expires even when the entry is never stored; the pipeline should
+    thus be transactional.
+
+    :param pipe: redis pipeline the commands are queued on
+    :param token: auth_token for the user
+    """
+    strikes_key = _strikes_cache_key(token)
+    pipe.incr(strikes_key)
+    pipe.pexpire(strikes_key, 2 * get_conf().blacklist_max_ttl)
+
+
+def _queue_blacklist_entry(pipe, token, expires_in, strikes=None):
+    """Stores the blacklist entry of a token
+
+    :param pipe: redis client or pipeline the commands are sent to
+    :param token: auth_token for the user
+    :param expires_in: time in milliseconds for blacklisting failed tokens
+    :param strikes: number of times the token was blacklisted, as counted
+                    by _queue_strike, or None when they are not counted
+
+    :returns: time to live of the entry in milliseconds
+    """
+    cache_key = _blacklist_cache_key(token)
+    if strikes is None:
+        pipe.set(cache_key, _blacklist_value(True), px=expires_in)
+        return expires_in
+
+    max_expires_in = get_conf().blacklist_max_ttl
+    ttl = _get_blacklist_ttl(expires_in, max_expires_in, strikes)
+
+    # NOTE: Both keys share the hash tag of the token, so they can be
+    # sent together to a Redis Cluster.
+    pipe.set(cache_key, _blacklist_value(strikes), px=ttl)
+    pipe.pexpire(_strikes_cache_key(token), ttl + max_expires_in)
+    return ttl
+
+
+def _blacklist_token(redis_client, token, expires_in):
+    """Stores the token to the blacklist data in the cache
+
+    When blacklist_max_ttl is set, the number of times the token was
+    blacklisted is kept until blacklist_max_ttl after the entry expires,
+    and the entry lives longer for every such strike.
+
+    :param redis_client: redis.Redis object connected to the redis cache
+    :param token: auth_token for the user
+    :param expires_in: time in milliseconds for blacklisting failed tokens
+
+    :returns: True on success, otherwise False
+    """
+    try:
+        if not _counts_strikes(expires_in):
+            ttl = _queue_blacklist_entry(redis_client, token, expires_in)
+        else:
+            pipe = redis_client.pipeline(transaction=True)
+            _queue_strike(pipe, token)
+            strikes = pipe.execute()[0]
+
+            pipe = redis_client.pipeline(transaction=False)
+            ttl = _queue_blacklist_entry(pipe, token, expires_in, strikes)
+            pipe.execute()
+
+            if strikes > 1:
+                _incr('blacklist.repeat')
+
+    except Exception as ex:
+        msg = 'Failed to cache the data - Exception: {0}'.format(str(ex))
+        LOG.error(msg)
+        return False
+
+    blacklist_filter = _BLACKLIST_FILTER
+    if blacklist_filter is not None:
+        blacklist_filter.publish(_token_hash(token), ttl)
+
+    return True
+
+
+def _is_token_blacklisted(redis_client, token):
+    """Determines if the token is in the cached blacklist data
+
+    :param redis_client: redis.Redis object connected to the redis cache
+    :param token: auth_token for the user
+
+    :returns: True on success, otherwise False
+    """
+    blacklist_filter = _BLACKLIST_FILTER
+    if blacklist_filter is not None and not blacklist_filter.may_contain(
+            _token_hash(token)):
+        _incr('blacklist.local_miss')
+        return False
+
+    cached_data = None
+    cached_key = None
+    try:
+        cached_key = _blacklist_cache_key(token)
+
+        # NOTE: Most tokens are not blacklisted, so a miss on a replica
+        # is not checked again on the primary. A token blacklisted a
+        # moment ago may then be validated once more by Keystone.
+        get = getattr(redis_client, 'get_from_replica', redis_client.get)
+        cached_data = get(cached_key)
+    except Exception as ex:
+        LOG.debug(
+            (
+                'Failed to retrieve data to cache for key {0} '
+                'Exception: {1}'
+            ).format(cached_key, str(ex))
+        )
+        cached_data = None
+
+    if cached_data is None:
+        return False
+    else:
+        return True
+
+
+def _client_address(env, trusted_proxies):
+    """Finds the address of the client that sent a request
+
+    :param env: environment variable dictionary for the client connection
+    :param trusted_proxies: number of proxies appending to X-Forwarded-For
+
+    :returns: the address, or None if unknown
+    """
+    if trusted_proxies > 0:
+        # NOTE: Entries are only trusted from the right, since the client
+        # may send any X-Forwarded-For header it likes.
+        forwarded = [address.strip() for address
+                     in env.get('HTTP_X_FORWARDED_FOR', '').split(',')
+                     if address.strip()]
+        if len(forwarded) >= trusted_proxies:
+            return forwarded[-trusted_proxies]
+
+    return env.get('REMOTE_ADDR')
+
+
+def _is_source_blocked(redis_client, source, limit):
+    """Determines if a client address sent too many invalid tokens
+
+    :param redis_client: redis.Redis object connected to the redis cache
+    :param source: address of the client
+    :param limit: number of failures allowed within the window
+
+    :returns: True if requests from the address should be rejected
+    """
+    try:
+        failures = redis_client.get(_source_cache_key(source))
+    except Exception as ex:
+        LOG.debug('Failed to retrieve failures of {0} - {1}'.format(
+            source, str(ex)))
+        return False
+
+    return failures is not None and int(failures) >= limit
+
+
+def _record_source_failure(redis_client, source):
+    """Counts an invalid token sent by a client address
+
+    :param redis_client: redis.Redis object connected to the redis cache
+    :param source: address of the client, or None if unknown
+    """
+    if source is None:
+        return
+
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        _queue_source_failure(pipe, source)
+        pipe.execute()
+    except Exception as ex:
+        LOG.debug('Failed to count failure of {0} - {1}'.format(
+            source, str(ex)))
+
+
+def _queue_source_failure(pipe, source):
+    """Counts an invalid token sent by a client address
+
+    :param pipe: redis pipeline the commands are queued on
+    :param source: address of the client
+    """
+    cache_key = _source_cache_key(source)
+    # NOTE: The counter is created with its expiry and only
+    # incremented afterwards, so the window starts at the first
+    # failure and is not extended by the next ones.
+    pipe.set(cache_key, 0, ex=get_conf().source_failure_window, nx=True)
+    pipe.incr(cache_key)
+
+
+def _epoch_milliseconds(dt):
+    """Converts a DateTime object, UTC if naive, to epoch milliseconds"""
+    return (calendar.timegm(dt.utctimetuple()) * 1000 +
+            dt.microsecond // 1000)
+
+
+def _get_cache_ttl(expires_ms, max_cache_life):
+    """Determines how long authentication data may be cached
+
+    :param expires_ms: expiration time of the token, in milliseconds
+                       since the epoch
+    :param max_cache_life: time in seconds for the maximum time a cache entry
+                           should remain in the cache of valid data
+
+    :returns: time to live of the cache entry in milliseconds, until the
+              nearest of either the expiration of the token or the current
+              time plus max_cache_life; 0 or less if the token expired
+    """
+    now_ms = int(time.time() * 1000)
+    return min(expires_ms - now_ms, int(max_cache_life * 1000))
+
+
+def _service_catalog_data(access_info):
+    """Encode the service catalog forwarded to the app
+
+    :param access_info: keystoneclient.access.AccessInfo of the token
+
+    :returns: the catalog as UTF-8 JSON, or None if the token has none
+    """
+    # NOTE: Access information read from the cache holds it encoded.
+    utf8_data = getattr(access_info, 'service_catalog_data', None)
+    if utf8_data is not None:
+        return utf8_data
+
+    if not access_info.has_service_catalog():
+        return None
+
+    # Convert the service catalog to JSON
+    service_catalog_data = json.dumps(access_info.service_catalog.catalog)
+
+    # convert service catalog to unicode to try to help
+    # prevent encode/decode errors under python2
+    if six.PY2:  # pragma: no cover
+        u_service_catalog_data = service_catalog_data.decode('utf-8')
+    else:  # pragma: no cover
+        u_service_catalog_data = service_catalog_data
+
+    # Convert the JSON string data to strict UTF-8
+    return u_service_catalog_data.encode(encoding='utf-8', errors='strict')
+
+
+def _pack_cache_record(access_info, expires_ms, delta_ms):
+    """Pack the access information of a token into a cache entry
+
+    The service catalog, which makes up most of the access information,
+    is stored apart, already encoded as it is forwarded, so that reading
+    the entry back neither decodes nor encodes it again.
+    """
+    data = dict((key, value) for key, value in six.iteritems(access_info)
+                if key not in CATALOG_KEYS)
+    return __packer.pack([CACHE_RECORD_VERSION, expires_ms, int(delta_ms),
+                          data, _service_catalog_data(access_info)])
+
+
+def _send_data_to_cache(redis_client, url, access_info, max_cache_life,
+                        delta_ms=0):
+    """Stores the authentication data to cache
+
+    :param redis_client: redis.Redis object connected to the redis cache
+    :param url: URL used for authentication
+    :param access_info: keystoneclient.access.AccessInfo containing
+        the auth data
+    :param max_cache_life: time in seconds for the maximum time a cache entry
+                           should remain in the cache of valid data
+    :param delta_ms: time in milliseconds it took to get the auth data,
+                     used to refresh the entry early enough
+
+    :returns: True on success, otherwise False
+    """
+    try:
+        # NOTE: The indexes are updated along with the entry, when kept.
+        if get_conf().cache_index:
+            pipe = redis_client.pipeline(transaction=False)
+        else:
+            pipe = redis_client
+
+        if not _queue_cache_entry(pipe, url, access_info, max_cache_life,
+                                  delta_ms):
+            LOG.debug('Token expired, not caching it')
+            return False
+
+        if pipe is not redis_client:
+            pipe.execute()
+
+        return True
+
+    except Exception as ex:
+        msg = 'Failed to cache the data - Exception: {0}'.format(str(ex))
+        LOG.error(msg)
+        return False
+
+
+def _queue_cache_entry(pipe, url, access_info, max_cache_life, delta_ms=0):
+    """Stores the authentication data to cache
+
+    The parameters are those of _send_data_to_cache, but for the redis
+    client or pipeline the commands are sent to, which must be a pipeline
+    when cache_index is set.
+
+    :returns: True if the entry was stored, False if the token expired
+    """
+    entry = _cache_entry(url, access_info, max_cache_life, delta_ms)
+    if entry is None:
+        return False
+
+    # Store the value along with its expiry, so that it always
+    # expires even if the connection drops
+    cache_key, cache_data, key_ttl = entry
+    pipe.set(cache_key, cache_data, px=key_ttl)
+    if get_conf().cache_index:
+        _index_cache_entry(pipe, cache_key, access_info, key_ttl)
+
+    return True
+
+
+def _cache_entry(url, access_info, max_cache_life, delta_ms=0):
+    """Build the cache entry of the authentication data
+
+    The parameters are those of _send_data_to_cache.
+
+    :returns: the key, the packed value and the time to live in
+              milliseconds of the entry, or None if the token expired
+    """
+    token_expires_ms = _epoch_milliseconds(access_info.expires)
+    ttl = _get_cache_ttl(token_expires_ms, max_cache_life)
+    if ttl <= 0:
+        return None
+
+    # NOTE: The entry is kept up to stale_grace seconds longer than
+    # it is fresh, but never past the expiration of the token.
+    key_ttl = _get_cache_ttl(token_expires_ms,
+                             max_cache_life + get_conf().stale_grace)
+
+    # Convert the storable format
+    expires_ms = int(time.time() * 1000) + ttl
+    cache_data = _pack_cache_record(access_info, expires_ms, delta_ms)
+
+    cache_key = _access_cache_key(access_info.tenant_id,
+                                  access_info.auth_token, url)
+    return cache_key, cache_data, key_ttl
+
+
+def _index_cache_entry(pipe, cache_key, access_info, key_ttl):
+    """Adds a cache entry to the indexes of its tenants and user
+
+    Indexes are sorted sets of cache keys, scored by their expiration
+    time, from which expired keys are dropped on every addition. An index
+    lives as long as its longest lived entry.
+
+    :param pipe: redis pipeline the commands are queued on
+    :param cache_key: key of the cache entry
+    :param access_info: keystoneclient.access.AccessInfo cached
+    :param key_ttl: time to live of the entry, in milliseconds
+    """
+    now_ms = int(time.time() * 1000)
+
+    # NOTE: A token may be used with the tenants it has a role on, so
+    # its entry is invalidated with any of them.
+    tenants = set([access_info.project_id])
+    for role in access_info.get('user', {}).get('roles', []):
+        tenants.add(role.get('tenantId'))
+    tenants.discard(None)
+
+    index_keys = [_tenant_index_key(tenant) for tenant in sorted(tenants)]
+    index_keys.append(_user_index_key(access_info.user_id))
+    for index_key in index_keys:
+        # NOTE: The script is sent as is, so that it is queued the same
+        # way on any pipeline, asyncio ones included.
+        pipe.execute_command('EVAL', INDEX_SCRIPT, 1, index_key,
+                             now_ms + key_ttl, cache_key, now_ms, key_ttl)
+
+
+def _invalidate_index(redis_client, index_key):
+    keys = redis_client.zrange(index_key, 0, -1)
+    if not keys:
+        return 0
+
+    pipe = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.delete(key)
+
+    # NOTE: Only the keys read are dropped from the index, not those
+    # added since.
+    pipe.zrem(index_key, *keys)
+    deleted = sum(pipe.execute()[:-1])
+
+    _STATS.incr(_STAT_PREFIX + 'cache.invalidated', deleted)
+    return deleted
+
+
+def invalidate_tenant(redis_client, tenant):
+    """Removes the cached validations of the tokens of a tenant
+
+    Requires the cache_index option to have been set when the tokens
+    were cached.
+
+    :param redis_client: redis.Redis object connected to the redis cache
+    :param tenant: tenant id
+
+    :returns: the number of cache entries removed
+    """
+    return _invalidate_index(redis_client, _tenant_index_key(tenant))
+
+
+def invalidate_user(redis_client, user_id):
+    """Removes the cached validations of the tokens of a user
+
+    Requires the cache_index option to have been set when the tokens
+    were cached.
+
+    :param redis_client: redis.Redis object connected to the redis cache
+    :param user_id: user id
+
+    :returns: the number of cache entries removed
+    """
+    return _invalidate_index(redis_client, _user_index_key(user_id))
+
+
+def _should_refresh_early(expires_ms, delta_ms, beta):
+    """Decides whether a cache entry is refreshed before it expires
+
+    Probabilistic early expiration (XFetch): the closer the entry is to
+    its expiration, and the longer it took to compute, the more likely a
+    refresh is, so that refreshes are spread over the requests rather
+    than all made at once when the entry expires.
+
+    :param expires_ms: expiration time of the entry, in milliseconds
+                       since the epoch
+    :param delta_ms: time in milliseconds it took to compute the entry
+    :param beta: how eagerly entries are refreshed, 0 never does
+
+    :returns: True if the entry should be refreshed now
+    """
+    if beta <= 0:
+        return False
+
+    # NOTE: 1 - random() is in (0, 1], so its log is defined and <= 0.
+    gap = -delta_ms * beta * math.log(1.0 - random.random())
+    return time.time() * 1000 + gap >= expires_ms
+
+
+def _load_access_info(data, catalog_data=None):
+    """Rebuild the access information stored in a cache entry
+
+    :param data: the access information
+    :param catalog_data: the service catalog stored apart, as UTF-8 JSON
+    """
+    if data.get('version') == 'v3':
+        access_info = access.AccessInfoV3(data.get('auth_token'), data)
+    else:
+        access_info = access.AccessInfoV2(data)
+
+    if catalog_data is not None:
+        access_info.service_catalog_data = catalog_data
+    return access_info
+
+
+def _retrieve_data_from_cache(redis_client, url, tenant, token,
+                              early_refresh_beta=0, refresh=None,
+                              serve_stale=False):
+    """Retrieve the authentication data from cache
+
+    :param redis_client: redis.Redis object connected to the redis cache
+    :param url: URL used for authentication
+    :param tenant: tenant id of the user
+    :param token: auth_token for the user
+    :param early_refresh_beta: how eagerly entries are refreshed before they
+                               expire, 0 never does
+    :param refresh: callable refreshing an entry due for it, returning the
+                    new access information, or None if it is not available
+                    (yet); the cached one is then returned
+    :param serve_stale: whether an entry past max_cache_life, kept for the
+                        stale_grace period, is returned rather than reported
+                        as a miss
+
+    :returns: a keystoneclient.access.AccessInfo on success or None
+    """
+    cached_data = None
+    cache_key = None
+    try:
+        # Try to get the data from the cache
+        cache_key = _access_cache_key(tenant, token, url)
+        cached_data = redis_client.get(cache_key)
+    except Exception as ex:
+        LOG.debug(
+            (
+                'Failed to retrieve data to cache for key {0}'
+                'Exception: {1}'
+            ).format(cache_key, str(ex))
+        )
+        _incr('cache.error')
+        return None
+
+    if cached_data is None:
+        LOG.debug('No data in cache for key {0}'.format(cache_key))
+        _incr('cache.miss')
+        # It wasn't cached
+        return None
+
+    access_info, refresh_due = _read_cache_record(
+        cached_data, early_refresh_beta=early_refresh_beta,
+        serve_stale=serve_stale)
+
+    # NOTE: Refreshing early is only an optimization; the entry is still
+    # valid, and served if the refresh fails.
+    if refresh_due and refresh is not None:
+        return refresh() or access_info
+
+    return access_info
+
+
+def _read_cache_record(cached_data, early_refresh_beta=0, serve_stale=False):
+    """Rebuild the access information of a cache entry read from Redis
+
+    The parameters are those of _retrieve_data_from_cache, plus the
+    packed entry.
+
+    :returns: a keystoneclient.access.AccessInfo, or None if the entry
+              is stale or unreadable, and whether it is due for an early
+              refresh
+    """
+    # So 'data' can be used in the exception handler...
+    data = None
+
+    try:
+        record = __unpacker(cached_data)
+        version, expires_ms, delta_ms, data = record[:4]
+        if version == CACHE_RECORD_VERSION:
+            catalog_data = record[4]
+        elif version == 1:
+            catalog_data = None
+        else:
+            raise UnknownAuthenticationDataVersion(version)
+
+        # NOTE: Checked before the access information is rebuilt,
+        # which is then not needed.
+        stale = time.time() * 1000 >= expires_ms
+        if stale and not serve_stale:
+            _incr('cache.miss')
+            return None, False
+
+        access_info = _load_access_info(data, catalog_data)
+
+        # NOTE: Counted once the entry is known to be served.
+        _incr('cache.hit')
+        if stale:
+            _incr('cache.stale')
+            return access_info, False
+
+        if _should_refresh_early(expires_ms, delta_ms,
+                                 early_refresh_beta):
+            _incr('cache.early_refresh')
+            return access_info, True
+
+        return access_info, False
+
+    except Exception as ex:
+        # The cached object didn't match what we expected
+        msg = (
+            'Stored Data does not contain any credentials - '
+            'Exception: {0}; Data: {1}'
+        ).format(str(ex), data)
+        LOG.error(msg)
+        _incr('cache.error')
+        return None, False
+
+
+def _retrieve_data_from_keystone(redis_client, url, tenant, token,
+                                 blacklist_ttl, max_cache_life, source=None):
+    """Retrieve the authentication data from OpenStack Keystone
+
+    :param redis_client: redis.Redis object connected to the redis cache
+    :param url: Keystone Identity URL to authenticate against
+    :param tenant: tenant id of user data to retrieve
+    :param token: auth_token for the tenant_id
+    :param blacklist_ttl: time in milliseconds for blacklisting failed tokens
+    :param max_cache_life: time in seconds for the maximum time a cache entry
+                           should remain in the cache of valid data
+    :param source: address of the client, charged if the token is invalid
+
+    :returns: a keystoneclient.access.AccessInfo on success or None on error
+    :raises KeystoneUnavailable: when the circuit breaker is open or the
+                                 call is over the Keystone call budget
+    """
+    breaker = _BREAKER
+    _check_circuit(breaker)
+
+    bulkhead = _BULKHEAD
+    _enter_keystone_call(breaker, bulkhead)
+    try:
+        # NOTE: Consumed last, so that calls turned away by the bulkhead
+        # or the circuit breaker do not use up the call budget.
+        rate_limiter = _RATE_LIMITER
+        if rate_limiter is not None:
+            _check_keystone_rate(breaker, rate_limiter.consume())
+
+        return _call_keystone(redis_client, url, tenant, token,
+                              blacklist_ttl, max_cache_life, breaker, source)
+    finally:
+        if bulkhead is not None:
+            bulkhead.release()
+
+
+def _keystone_unavailable(stat, retry_after):
+    """Counts a call to Keystone that is not made
+
+    :param stat: name of the counter to increment
+    :param retry_after: time in seconds after which to retry
+
+    :returns: the KeystoneUnavailable exception to raise
+    """
+    _incr(stat)
+    return KeystoneUnavailable(int(math.ceil(retry_after)))
+
+
+def _check_circuit(breaker):
+    """Rejects a call to Keystone while the circuit is open
+
+    :param breaker: the circuit breaker, if any
+
+    :raises KeystoneUnavailable: when the circuit is open
+    """
+    if breaker is not None and breaker.is_open():
+        raise _keystone_unavailable('keystone.rejected',
+                                    breaker.retry_after())
+
+
+def _check_keystone_rate(breaker, wait):
+    """Rejects a call to Keystone over the call rate
+
+    The call was admitted by the circuit breaker already, which gets it
+    back when it is rejected.
+
+    :param breaker: the circuit breaker, if any
+    :param wait: time in seconds to wait, as returned by the rate limiter
+
+    :raises KeystoneUnavailable: when the call must wait
+    """
+    if wait > 0:
+        if breaker is not None:
+            breaker.cancel()
+        raise _keystone_unavailable('keystone.rate_limited', wait)
+
+
+def _enter_keystone_call(breaker, bulkhead):
+    """Admits a call to Keystone through the bulkhead and circuit breaker
+
+    The caller must release the bulkhead, if any, once the call is made.
+
+    :param breaker: the circuit breaker, if any
+    :param bulkhead: the bulkhead, if any
+
+    :raises KeystoneUnavailable: when the call is not admitted; the
+                                 bulkhead is then not held
+    """
+    if bulkhead is not None and not bulkhead.acquire():
+        raise _keystone_unavailable('keystone.saturated', 1)
+
+    try:
+        # NOTE: Checked last, since it lets a single trial call through
+        # once the circuit has been open for long enough.
+        if breaker is not None and not breaker.allow():
+            raise _keystone_unavailable('keystone.rejected',
+                                        breaker.retry_after())
+    except KeystoneUnavailable:
+        if bulkhead is not None:
+            bulkhead.release()
+        raise
+
+
+def _keystone_call_succeeded(start):
+    """Counts a token Keystone validated
+
+    :param start: time the call started at, from timeit.default_timer
+
+    :returns: the time in milliseconds the call took
+    """
+    delta_ms = (timeit.default_timer() - start) * 1000
+    _STATS.timing(_STAT_PREFIX + 'keystone.latency', delta_ms)
+    _incr('keystone.valid')
+    return delta_ms
+
+
+def _keystone_call_failed(url, ex, start):
+    """Counts a call to Keystone that failed
+
+    :param url: Keystone Identity URL the token was validated against
+    :param ex: exception raised by the validation
+    :param start: time the call started at, from timeit.default_timer
+
+    :returns: True if Keystone rejected the token, which is then to be
+              blacklisted, False if it could not be reached or failed
+    :raises RequestEntityTooLarge: when Keystone throttled the call
+    """
+    _timing('keystone.latency', start)
+
+    if isinstance(ex, exceptions.RequestEntityTooLarge):
+        _incr('keystone.throttled')
+        LOG.debug('Request entity too large error from '
+                  'authentication server.')
+        raise ex
+
+    return _token_rejected(url, ex)
+
+
+def _record_keystone_outcome(breaker, answered):
+    """Reports the outcome of a call to Keystone to the circuit breaker
+
+    :param breaker: the circuit breaker, if any
+    :param answered: True if Keystone answered, whatever the answer
+    """
+    if breaker is not None:
+        if answered:
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+
+
+class ServiceToken(object):
+
+    """Token of the service user, validating the tokens of the clients.
+
+    The token is obtained from Keystone on first use, and renewed once it
+    is about to expire or was rejected. It is shared by the threads of a
+    process, which wait for the one renewing it.
+    """
+
+    def __init__(self, username, password, user_domain_name='Default',
+                 project_name=None, project_domain_name='Default',
+                 margin=300, auth_version='v3'):
+        """Initializes the service credentials.
+
+        :param username: name of the service user
+        :param password: password of the service user
+        :param user_domain_name: domain of the service user, ignored
+            with v2.0
+        :param project_name: project the token is scoped to, unscoped
+            when None
+        :param project_domain_name: domain of the project, ignored with
+            v2.0
+        :param margin: time in seconds before its expiration at which
+            the token is renewed
+        :param auth_version: Keystone API the token is obtained from,
+            v2.0 or v3
+        """
+        self._v3 = auth_version == 'v3'
+        self._margin = margin
+        self._access_info = None
+        self._lock = threading.Lock()
+
+        fork.register(self._after_fork)
+
+        if not self._v3:
+            auth = {
+                'passwordCredentials': {
+                    'username': username,
+                    'password': password,
+                },
+            }
+            if project_name is not None:
+                auth['tenantName'] = project_name
+
+            self._body = {'auth': auth}
+            return
+
+        auth = {
+            'identity': {
+                'methods': ['password'],
+                'password': {
+                    'user': {
+                        'name': username,
+                        'password': password,
+                        'domain': {'name': user_domain_name},
+                    },
+                },
+            },
+        }
+        if project_name is not None:
+            auth['scope'] = {
+                'project': {
+                    'name': project_name,
+                    'domain': {'name': project_domain_name},
+                },
+            }
+
+        self._body = {'auth': auth}
+
+    def get(self, url):
+        """Returns the service token, renewing it if needed
+
+        :param url: Keystone Identity URL to renew the token with
+
+        :returns: the token
+        :raises: ServiceAuthenticationFailed if Keystone rejected the
+                 credentials
+        """
+        with self._lock:
+            access_info = self._access_info
+            if access_info is None or access_info.will_expire_soon(
+                    stale_duration=self._margin):
+                access_info = self._authenticate(url)
+                self._access_info = access_info
+
+            return access_info.auth_token
+
+    def invalidate(self, token):
+        """Forgets a token that Keystone rejected, if still current"""
+        with self._lock:
+            access_info = self._access_info
+            if access_info is not None and access_info.auth_token == token:
+                self._access_info = None
+
+    def _authenticate(self, url):
+        _incr('keystone.service_token')
+
+        if self._v3:
+            auth_url = url.rstrip('/') + '/auth/tokens?nocatalog'
+        else:
+            auth_url = url.rstrip('/') + '/tokens'
+        resp = requests.post(auth_url, json=self._body,
+                             headers={'Accept': 'application/json'})
+        if resp.status_code >= 400:
+            raise ServiceAuthenticationFailed(
+                'Service authentication returned status {0}'.format(
+                    resp.status_code))
+
+        try:
+            if self._v3:
+                return access.AccessInfoV3(resp.headers['X-Subject-Token'],
+                                           **resp.json()['token'])
+
+            access_info = access.AccessInfoV2(**resp.json()['access'])
+            if not access_info.auth_token:
+                raise exceptions.InvalidResponse(response=resp)
+            return access_info
+        except (KeyError, ValueError, TypeError, NotImplementedError):
+            raise exceptions.InvalidResponse(response=resp)
+
+    def _after_fork(self):
+        # NOTE: The token itself remains valid in the children.
+        self._lock = threading.Lock()
+
+
+class PkiValidator(object):
+
+    """Validates signed tokens without calling Keystone.
+
+    The signing and CA certificates are fetched once and kept in the
+    signing directory. The revocation list is fetched again every
+    revocation_interval seconds, when needed; tokens are only validated
+    locally while it is known.
+    """
+
+    CERTIFICATE_PATHS = {
+        'v2.0': ('/certificates/signing', '/certificates/ca'),
+        'v3': ('/OS-SIMPLE-CERT/certificates', '/OS-SIMPLE-CERT/ca'),
+    }
+
+    REVOCATION_PATHS = {
+        'v2.0': '/tokens/revoked',
+        'v3': '/auth/tokens/OS-PKI/revoked',
+    }
+
+    def __init__(self, signing_dir=None, revocation_interval=10,
+                 hash_algorithms=('md5',)):
+        """Initializes the validator.
+
+        :param signing_dir: directory to store the certificates in, a
+            temporary one when None
+        :param revocation_interval: time in seconds between fetches of
+            the revocation list
+        :param hash_algorithms: algorithms the revocation list may hash
+            token ids with
+        """
+        self._signing_dir = signing_dir
+        self._revocation_interval = revocation_interval
+        self._hash_algorithms = list(hash_algorithms)
+
+        self._lock = threading.Lock()
+        self._certificates = None
+        self._revoked = None
+        self._checked_at = None
+        self._fetched_at = None
+
+        fork.register(self._after_fork)
+
+    @staticmethod
+    def is_signed(token):
+        return cms.is_asn1_token(token) or cms.is_pkiz(token)
+
+    def is_revoked(self, url, token):
+        """Looks a token up in the revocation list
+
+        :param url: Keystone Identity URL to fetch the list from
+        :param token: the signed token
+
+        :returns: True or False, or None when the list is not known
+        """
+        revoked = self._revocation_list(url)
+        if revoked is None:
+            return None
+
+        return any(cms.cms_hash_token(token, mode=algorithm) in revoked
+                   for algorithm in self._hash_algorithms)
+
+    def verify(self, url, tenant, token):
+        """Validates a signed token locally
+
+        The token should have been checked not to be revoked first.
+
+        :param url: Keystone Identity URL to fetch the certificates from
+        :param tenant: tenant id the token must be scoped to
+        :param token: the signed token
+
+        :returns: a keystoneclient.access.AccessInfo, or None if the token
+                  must be validated by Keystone instead
+        """
+        try:
+            data = self._verify(url, token)
+            access_info = access.AccessInfo.factory(body=json.loads(data),
+                                                    auth_token=token)
+        except Exception as ex:
+            LOG.debug('Failed to verify signed token - {0}'.format(ex))
+            return None
+
+        # NOTE: Unlike Keystone, the token cannot be rescoped here.
+        if not _scope_allows(access_info, tenant):
+            return None
+
+        return access_info
+
+    def _verify(self, url, token):
+        if cms.is_pkiz(token):
+            verify = cms.pkiz_verify
+        else:
+            verify = cms.verify_token
+
+        signing_file, ca_file = self._certificate_files(url)
+        try:
+            return verify(token, signing_file, ca_file)
+        except exceptions.CertificateConfigError:
+            # NOTE: The files were removed, or the certificates rotated.
+            signing_file, ca_file = self._certificate_files(url, True)
+            return verify(token, signing_file, ca_file)
+
+    def _certificate_files(self, url, refresh=False):
+        # NOTE: Fetched without holding the lock, so that a slow Keystone
+        # does not block the threads verifying tokens or checking the
+        # revocation list; concurrent fetches write the same files.
+        with self._lock:
+            certificates = self._certificates
+            if self._signing_dir is None:
+                self._signing_dir = tempfile.mkdtemp(prefix='eom-signing-')
+            signing_dir = self._signing_dir
+
+        if certificates is None or refresh:
+            certificates = self._fetch_certificates(url, signing_dir)
+            with self._lock:
+                self._certificates = certificates
+
+        return certificates
+
+    def _fetch_certificates(self, url, signing_dir):
+        files = []
+        for path, name in zip(self.CERTIFICATE_PATHS[get_conf().auth_version],
+                              ('signing_cert.pem', 'cacert.pem')):
+            resp = requests.get(url.rstrip('/') + path)
+            if resp.status_code >= 400:
+                raise exceptions.from_response(resp, 'GET', path)
+
+            # NOTE: Written aside and renamed, so that concurrent
+            # verifications never read a partial file.
+            file_name = os.path.join(signing_dir, name)
+            fd, tmp_name = tempfile.mkstemp(dir=signing_dir)
+            with os.fdopen(fd, 'w') as f:
+                f.write(resp.text)
+            os.rename(tmp_name, file_name)
+            files.append(file_name)
+
+        return tuple(files)
+
+    def _revocation_list(self, url):
+        # NOTE: A single thread fetches the list, without holding the
+        # lock; the others keep using the previous one meanwhile.
+        with self._lock:
+            now = timeit.default_timer()
+            due = (self._checked_at is None or
+                   now - self._checked_at >= self._revocation_interval)
+            if due:
+                self._checked_at = now
+
+        if due:
+            try:
+                revoked = self._fetch_revocation_list(url)
+                with self._lock:
+                    self._revoked = revoked
+                    self._fetched_at = now
+            except Exception as ex:
+                LOG.warn('Failed to fetch the revocation list - '
+                         '{0}'.format(ex))
+
+        with self._lock:
+            # NOTE: A list that could not be refreshed twice in a row is
+            # too old to be trusted.
+            if (self._fetched_at is None or
+                    now - self._fetched_at > 2 * self._revocation_interval):
+                return None
+
+            return self._revoked
+
+    def _fetch_revocation_list(self, url):
+        if _SERVICE_TOKEN is None:
+            raise ServiceAuthenticationFailed('No service credentials')
+
+        path = self.REVOCATION_PATHS[get_conf().auth_version]
+        headers = {
+            'Accept': 'application/json',
+            'X-Auth-Token': _SERVICE_TOKEN.get(url),
+        }
+        resp = requests.get(url.rstrip('/') + path, headers=headers)
+        if resp.status_code >= 400:
+            raise exceptions.from_response(resp, 'GET', path)
+
+        signing_file, ca_file = self._certificate_files(url)
+
+        data = cms.cms_verify(resp.json()['signed'], signing_file, ca_file)
+        _incr('pki.revocation_list')
+        return frozenset(token['id']
+                         for token in json.loads(data)['revoked'])
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+
+def _request_token_v3(validation_url, token, auth_token):
+    headers = {
+        'Accept': 'application/json',
+        'X-Auth-Token': auth_token,
+        'X-Subject-Token': token,
+    }
+    return requests.get(validation_url, headers=headers)
+
+
+def _validate_token_v3(url, tenant, token):
+    """Validate a token against a Keystone v3 endpoint
+
+    The token is validated with the service token, or by itself when no
+    service credentials are configured. Unlike v2, validation does not
+    rescope the token, which must already be scoped to the tenant.
+
+    :param url: Keystone v3 Identity URL to authenticate against
+    :param tenant: tenant id the token must be valid for
+    :param token: auth_token for the tenant_id
+
+    :returns: a keystoneclient.access.AccessInfoV3
+    :raises: a keystoneclient exception when the token is invalid or
+             Keystone could not be reached
+    """
+    validation_url = url.rstrip('/') + '/auth/tokens'
+    if get_conf().alternate_validation is True:
+        validation_url += '?nocatalog'
+
+    service_token = _SERVICE_TOKEN
+    if service_token is None:
+        resp = _request_token_v3(validation_url, token, token)
+        return _access_info_v3(resp, validation_url, tenant, token)
+
+    # NOTE: The service token may have been revoked before it expired;
+    # a new one is requested once.
+    for _ in range(2):
+        auth_token = service_token.get(url)
+        resp = _request_token_v3(validation_url, token, auth_token)
+        if resp.status_code != 401:
+            return _access_info_v3(resp, validation_url, tenant, token)
+        service_token.invalidate(auth_token)
+
+    raise _service_token_rejected(url)
+
+
+def _service_token_rejected(url):
+    """Builds the error raised when Keystone rejects the service token
+
+    :returns: the ServiceAuthenticationFailed exception to raise
+    """
+    return ServiceAuthenticationFailed(
+        'Service token rejected by {0}'.format(url))
+
+
+def _access_info_v3(resp, validation_url, tenant, token):
+    """Read the access information from a Keystone v3 validation
+
+    :param resp: requests.Response, or an object with its interface,
+                 answering the validation of the token
+    :param validation_url: URL the token was validated at
+    :param tenant: tenant id the token must be valid for
+    :param token: auth_token validated
+
+    :returns: a keystoneclient.access.AccessInfoV3
+    :raises: a keystoneclient exception when the token is invalid
+    """
+    # NOTE: Keystone v3 answers 404 for tokens it does not know of.
+    if resp.status_code == 404:
+        raise exceptions.Unauthorized('Token not found', http_status=404)
+
+    if resp.status_code >= 400:
+        LOG.debug('Request returned failure status: {0}'.format(
+            resp.status_code))
+        raise exceptions.from_response(resp, 'GET', validation_url)
+
+    try:
+        access_info = access.AccessInfoV3(token, **resp.json()['token'])
+    except (KeyError, ValueError, TypeError, NotImplementedError):
+        raise exceptions.InvalidResponse(response=resp)
+
+    if not _scope_allows(access_info, tenant):
+        raise exceptions.Unauthorized(
+            'Token is not scoped to {0}'.format(tenant), http_status=401)
+
+    return access_info
+
+
+def _validate_token(url, tenant, token):
+    """Validate a token against a Keystone endpoint
+
+    :param url: Keystone Identity URL to authenticate against
+    :param tenant: tenant id of user data to retrieve
+    :param token: auth_token for the tenant_id
+
+    :returns: a keystoneclient.access.AccessInfo
+    :raises: a keystoneclient exception when the token is invalid or
+             Keystone could not be reached
+    """
+    if get_conf().auth_version == 'v3':
+        return _validate_token_v3(url, tenant, token)
+
+    # Try to authenticate the user and get the user information using
+    # only the data provided, no special administrative tokens required.
+    # When using the alternative validation method, the service catalog
+    # identity does not return a service catalog for valid tokens.
+
+    if get_conf().alternate_validation is True:
+        _url = url.rstrip('/') + '/tokens'
+        validation_url = _url + '/{0}'.format(token)
+        headers = {
+            'Accept': 'application/json',
+            'X-Auth-Token': token
+        }
+        resp = requests.get(validation_url, headers=headers)
+        return _access_info_v2(resp, 'GET', _url)
+
+    return _validate_token_v2(url, tenant, token)
+
+
+def _validate_token_v2(url, tenant, token):
+    """Validate and rescope a token through keystoneclient, with v2.0
+
+    The parameters are those of _validate_token.
+
+    :returns: a keystoneclient.access.AccessInfoV2
+    :raises: a keystoneclient exception when the token is invalid or
+             Keystone could not be reached
+    """
+    keystone = keystonev2_client.Client(tenant_id=tenant,
+                                        token=token,
+                                        auth_url=url)
+    return keystone.get_raw_token_from_identity_service(
+        auth_url=url, tenant_id=tenant, token=token)
+
+
+def _access_info_v2(resp, method, url):
+    """Read the access information from a Keystone v2 answer
+
+    :param resp: requests.Response, or an object with its interface,
+                 answering the request
+    :param method: HTTP method of the request
+    :param url: URL requested
+
+    :returns: a keystoneclient.access.AccessInfoV2
+    :raises: a keystoneclient exception when the token is invalid
+    """
+    if resp.status_code >= 400:
+        LOG.debug('Request returned failure status: {0}'.format(
+            resp.status_code))
+        raise exceptions.from_response(resp, method, url)
+
+    try:
+        resp_data = resp.json()['access']
+    except (KeyError, ValueError):
+        raise exceptions.InvalidResponse(response=resp)
+
+    return access.AccessInfoV2(**resp_data)
+
+
+def _is_keystone_answer(ex):
+    """Determines if an exception is an answer from Keystone
+
+    :returns: True if Keystone answered, e.g. that the token is invalid,
+              False if it could not be reached or failed
+    """
+    if isinstance(ex, exceptions.HTTPClientError):
+        return True
+
+    # NOTE: keystoneclient wraps every error in an AuthorizationFailure,
+    # which only tells them apart by their message.
+    return (isinstance(ex, exceptions.AuthorizationFailure) and
+            '(HTTP 4' in str(ex))
 
 
-def get_auth_redis_client():
-    """Get a Redis Client connection from the pool
+def _token_rejected(url, ex):
+    """Logs and counts a failed validation of a token
 
-    uses the eom:auth_redis settings
+    :param url: Keystone Identity URL the token was validated against
+    :param ex: exception raised by the validation
+
+    :returns: True if Keystone rejected the token, False if it could not
+              be reached or failed
+    :raises RequestEntityTooLarge: when Keystone throttled the call
     """
-    group = _CONF[REDIS_GROUP_NAME]
+    LOG.debug('Failed to authenticate against {0} - {1}'.format(url, ex))
+    if not _is_keystone_answer(ex):
+        _incr('keystone.error')
+        return False
 
-    if group['ssl_enable']:
-        pool = redis.ConnectionPool(host=group['host'],
-                                    port=group['port'],
-                                    db=group['redis_db'],
-                                    password=group['password'],
-                                    ssl_keyfile=group['ssl_keyfile'],
-                                    ssl_certfile=group['ssl_certfile'],
-                                    ssl_cert_reqs=group['ssl_cert_reqs'],
-                                    ssl_ca_certs=group['ssl_ca_certs'],
-                                    connection_class=connection.SSLConnection)
-    else:
-        pool = redis.ConnectionPool(host=group['host'],
-                                    port=group['port'],
-                                    password=group['password'],
-                                    db=group['redis_db'])
+    # re-raise 413 here and later on respond with 503
+    if 'HTTP 413' in str(ex):
+        _incr('keystone.throttled')
+        raise exceptions.RequestEntityTooLarge(
+            method='POST',
+            url=url,
+            http_status=413
+        )
 
-    return redis.Redis(connection_pool=pool)
+    _incr('keystone.invalid')
+    return True
 
 
-def _tuple_to_cache_key(t):
-    """Convert a tuple to a cache key."""
-    key_data = '(%(s_data)s)' % {
-        's_data': ','.join(t)
-    }
-    if six.PY3:
-        key_data = key_data.encode('utf-8')
+def _validate_token_at(endpoints, index, tenant, token):
+    """Validate a token against one of the endpoints, scoring it"""
+    start = timeit.default_timer()
+    try:
+        access_info = _validate_token(endpoints.urls[index], tenant, token)
+    except Exception as ex:
+        _observe_endpoint(endpoints, index, start, ex)
+        raise
 
-    key = hashlib.sha1()
-    key.update(key_data)
-    return key.hexdigest()
+    _observe_endpoint(endpoints, index, start)
+    return access_info
 
 
-def _blacklist_cache_key(t):
-    """Convert token to a cache key for blacklists"""
-    key_data = 'blacklist%(s_data)s' % {
-        's_data': t
-    }
-    if six.PY3:
-        key_data = key_data.encode('utf-8')
+def _observe_endpoint(endpoints, index, start, ex=None):
+    """Scores an endpoint with the outcome of a validation
 
-    key = hashlib.sha1()
-    key.update(key_data)
-    return key.hexdigest()
+    :param endpoints: the Endpoints the validation was made against
+    :param index: index of the endpoint in endpoints.urls
+    :param start: time the validation started at
+    :param ex: exception raised by the validation, if any
+    """
+    endpoints.observe(index, timeit.default_timer() - start,
+                      failed=ex is not None and not _is_keystone_answer(ex))
 
 
-__packer = msgpack.Packer(encoding='utf-8', use_bin_type=True)
-__unpacker = functools.partial(msgpack.unpackb, encoding='utf-8')
+def _should_fail_over(endpoints, ex):
+    """Determines if a failed validation is to be made again elsewhere
 
+    :returns: True if there is another endpoint to ask and the failure
+              is not an answer from Keystone
+    """
+    return len(endpoints.urls) > 1 and not _is_keystone_answer(ex)
 
-def _blacklist_token(redis_client, token, expires_in):
-    """Stores the token to the blacklist data in the cache
 
-    :param redis_client: redis.Redis object connected to the redis cache
-    :param token: auth_token for the user
-    :param expires_in: time in milliseconds for blacklisting failed tokens
+def _validate_token_hedged(endpoints, delay, tenant, token):
+    """Validate a token, asking a second endpoint if the first is slow
 
-    :returns: True on success, otherwise False
+    Both requests are made from threads, and the first answer wins; a
+    failure of one endpoint waits for the answer of the other.
     """
+    results = six.moves.queue.Queue()
+
+    def _attempt(index):
+        try:
+            results.put((True, _validate_token_at(endpoints, index,
+                                                  tenant, token)))
+        except Exception as ex:
+            results.put((False, ex))
+
+    def _start(index):
+        thread = threading.Thread(target=_attempt, args=(index,),
+                                  name='eom-auth-keystone')
+        thread.daemon = True
+        thread.start()
+
+    first = endpoints.choose()
+    _start(first)
+
     try:
-        cache_data = __packer.pack(True)
-        cache_key = _blacklist_cache_key(token)
+        succeeded, value = results.get(timeout=delay)
+        pending = False
+    except six.moves.queue.Empty:
+        _incr('keystone.hedged')
+        _start(endpoints.choose(exclude=first))
+        succeeded, value = results.get()
+        pending = True
+
+    if not succeeded and not _is_keystone_answer(value):
+        if pending:
+            succeeded, value = results.get()
+        elif len(endpoints.urls) > 1:
+            _incr('keystone.failover')
+            return _validate_token_at(endpoints,
+                                      endpoints.choose(exclude=first),
+                                      tenant, token)
+
+    if succeeded:
+        return value
+    raise value
+
+
+def _request_keystone(url, tenant, token):
+    """Validate a token against the configured Keystone endpoints
+
+    With several endpoints, a request that fails is made once more to
+    another endpoint.
+
+    :param url: Keystone Identity URL used when there is a single endpoint
+    :param tenant: tenant id of user data to retrieve
+    :param token: auth_token for the tenant_id
 
-        redis_client.set(cache_key, cache_data)
-        redis_client.pexpire(cache_key, expires_in)
-        return True
+    :returns: a keystoneclient.access.AccessInfo
+    :raises: a keystoneclient exception when the token is invalid or
+             Keystone could not be reached
+    """
+    endpoints = _ENDPOINTS
+    if endpoints is None:
+        return _validate_token(url, tenant, token)
 
+    delay = endpoints.hedge_delay()
+    if delay is not None:
+        return _validate_token_hedged(endpoints, delay, tenant, token)
+
+    first = endpoints.choose()
+    try:
+        return _validate_token_at(endpoints, first, tenant, token)
     except Exception as ex:
-        msg = 'Failed to cache the data - Exception: {0}'.format(str(ex))
-        LOG.error(msg)
-        return False
+        if not _should_fail_over(endpoints, ex):
+            raise
 
+    _incr('keystone.failover')
+    return _validate_token_at(endpoints, endpoints.choose(exclude=first),
+                              tenant, token)
 
-def _is_token_blacklisted(redis_client, token):
-    """Determines if the token is in the cached blacklist data
 
-    :param redis_client: redis.Redis object connected to the redis cache
-    :param token: auth_token for the user
+def _call_keystone(redis_client, url, tenant, token, blacklist_ttl,
+                   max_cache_life, breaker, source=None):
+    """Validate a token against Keystone and cache the result
 
-    :returns: True on success, otherwise False
+    The parameters are those of _retrieve_data_from_keystone, plus the
+    circuit breaker to report the outcome to, if any.
     """
-    cached_data = None
-    cached_key = None
+    start = timeit.default_timer()
+    answered = False
     try:
-        cached_key = _blacklist_cache_key(token)
+        access_info = _request_keystone(url, tenant, token)
+        answered = True
+        delta_ms = _keystone_call_succeeded(start)
+
+        # cache the data so it is easier to access next time
+        _send_data_to_cache(redis_client, url, access_info, max_cache_life,
+                            delta_ms)
+
+        return access_info
 
-        cached_data = redis_client.get(cached_key)
     except Exception as ex:
-        LOG.debug(
-            (
-                'Failed to retrieve data to cache for key {0} '
-                'Exception: {1}'
-            ).format(cached_key, str(ex))
-        )
-        cached_data = None
+        # NOTE: keystoneclient reports unreachable servers as failed
+        # authorizations too, so only an answer from Keystone tells it
+        # is up and the token invalid.
+        answered = _is_keystone_answer(ex)
+        if _keystone_call_failed(url, ex, start):
+            _blacklist_token(redis_client, token, blacklist_ttl)
+            _record_source_failure(redis_client, source)
 
-    if cached_data is None:
-        return False
-    else:
-        return True
+        return None
+    finally:
+        # NOTE: The outcome is recorded whatever is raised, so that no
+        # trial call is left pending.
+        _record_keystone_outcome(breaker, answered)
 
 
-def _get_expiration_time(service_catalog_expiration_time, max_cache_life):
-    """Determines the cache expiration time
+def _refresh(redis_client, url, tenant, token, blacklist_ttl,
+             max_cache_life, source=None):
+    """Validate a token again and update its cache entry
 
-    :param service_catalog_expiration_time: DateTime object containing the
-           expiration time from the service catalog
-    :param max_cache_life: time in seconds for the maximum time a cache entry
-                           should remain in the cache of valid data
+    The parameters are those of _retrieve_data_from_keystone.
 
-    :returns: DateTime object with the time that the cache should be
-              expired at. This is the nearest time of either the
-              expiration of the service catalog or the combination of
-              the current time and the max_cache_life parameter
+    :returns: a keystoneclient.access.AccessInfo on success, or None if
+              the token could not be validated, whatever the reason
     """
-    class UtcTzInfo(datetime.tzinfo):
-
-        def utcoffset(self, dt):
-            return datetime.timedelta(0)
+    try:
+        return _retrieve_data_from_keystone(redis_client, url, tenant, token,
+                                            blacklist_ttl, max_cache_life,
+                                            source=source)
+    except Exception as ex:
+        LOG.debug('Failed to refresh token - {0}'.format(str(ex)))
+        return None
 
-        def tzname(self, dt):
-            return 'UTC'
 
-        def dst(self, dt):
-            return datetime.timedelta(0)
+def _refresh_in_background(redis_client, url, tenant, token, blacklist_ttl,
+                           max_cache_life):
+    """Validate a token again and update its cache entry, in a thread
 
-    # calculate the time based on the max_cache_life
-    now = datetime.datetime.utcnow()
-    max_expire_time = now + datetime.timedelta(seconds=max_cache_life)
+    Does nothing if the token is already being refreshed by this process.
 
-    if service_catalog_expiration_time.tzinfo is not None:  # pragma: no cover
-        max_expire_time = max_expire_time.replace(tzinfo=UtcTzInfo())
+    :returns: None, the cache entry being updated later on
+    """
+    # NOTE: Keyed by cache key, so that no token is kept in memory.
+    key = _access_cache_key(tenant, token, url)
+    now = time.time()
+    with _REFRESHING_LOCK:
+        started = _REFRESHING.get(key)
+        if started is not None and now - started < REFRESH_TIMEOUT:
+            return
+
+        for other, since in list(_REFRESHING.items()):
+            if now - since >= REFRESH_TIMEOUT:
+                del _REFRESHING[other]
+        _REFRESHING[key] = now
+
+    def _run():
+        try:
+            _refresh(redis_client, url, tenant, token, blacklist_ttl,
+                     max_cache_life)
+        finally:
+            with _REFRESHING_LOCK:
+                if _REFRESHING.get(key) == now:
+                    del _REFRESHING[key]
 
-    # return the nearest time to now
-    return min(service_catalog_expiration_time,
-               max_expire_time)
+    thread = threading.Thread(target=_run, name='eom-auth-refresh')
+    thread.daemon = True
+    thread.start()
+    return None
 
 
-def _send_data_to_cache(redis_client, url, access_info, max_cache_life):
-    """Stores the authentication data to cache
+class RefreshAhead(object):
 
-    :param redis_client: redis.Redis object connected to the redis cache
-    :param url: URL used for authentication
-    :param access_info: keystoneclient.access.AccessInfo containing
-        the auth data
-    :param max_cache_life: time in seconds for the maximum time a cache entry
-                           should remain in the cache of valid data
+    """Validates the most used tokens again before their entry expires.
 
-    :returns: True on success, otherwise False
+    Every token validated by this process is counted in a bounded
+    heavy-hitters structure. A daemon thread periodically checks the
+    remaining time to live of the cache entries of the most used tokens
+    and validates again those expiring within the margin, so that their
+    clients do not wait for Keystone when the entry expires.
     """
-    try:
-        # Convert the storable format
-        cache_data = __packer.pack(access_info)
 
-        tenant = access_info.tenant_id
-        token = access_info.auth_token
+    def __init__(self, redis_client, blacklist_ttl, max_cache_life,
+                 capacity=100, margin=60, interval=10.0, stale_grace=0):
+        """Initializes the worker.
+
+        :param redis_client: redis.Redis object connected to the redis cache
+        :param blacklist_ttl: time in milliseconds for blacklisting failed
+                              tokens
+        :param max_cache_life: time in seconds for the maximum time a cache
+                               entry should remain in the cache of valid data
+        :param int capacity: maximum number of tokens tracked
+        :param int margin: seconds before the expiration of a cache entry
+                           when it is refreshed
+        :param float interval: average seconds between two checks
+        :param int stale_grace: seconds cache entries are kept past
+                                max_cache_life
+        """
+        self._redis_client = redis_client
+        self._blacklist_ttl = blacklist_ttl
+        self._max_cache_life = max_cache_life
+        self._capacity = capacity
+        self._margin_ms = margin * 1000
+        self._interval = interval
+        self._grace_ms = stale_grace * 1000
+
+        self._lock = threading.Lock()
+        self._hitters = heavy_hitters.SpaceSaving(capacity)
+
+        self._worker = None
+        self._stop = threading.Event()
+
+        fork.register(self._after_fork)
+
+    def record(self, url, tenant, token):
+        """Counts a use of a valid token."""
+        self._ensure_worker()
+        with self._lock:
+            self._hitters.add((tenant, token, url))
+
+    def refresh(self):
+        """Validates again the tracked tokens whose entry expires soon.
+
+        :returns: the number of tokens validated again
+        """
+        with self._lock:
+            hot = self._hitters.top()
+            # NOTE: Tokens that are not used anymore fade away.
+            self._hitters.decay()
+
+        refreshed = 0
+        for (tenant, token, url), count, error in hot:
+            try:
+                ttl = self._redis_client.pttl(
+                    _access_cache_key(tenant, token, url))
+            except Exception as ex:
+                LOG.debug('Failed to check the cache entry - {0}'.format(ex))
+                continue
+
+            # NOTE: A missing entry (-2) is left for the next request
+            # to fill in, as the token may have been revoked meanwhile.
+            if ttl < 0 or ttl - self._grace_ms > self._margin_ms:
+                continue
+
+            _incr('cache.refresh_ahead')
+            refreshed += 1
+            try:
+                access_info = _retrieve_data_from_keystone(
+                    self._redis_client, url, tenant, token,
+                    self._blacklist_ttl, self._max_cache_life)
+            except Exception as ex:
+                LOG.debug('Failed to refresh token - {0}'.format(ex))
+                continue
+
+            # NOTE: Once the token itself expires within the margin,
+            # validating it again would not extend its cache entry.
+            expires_soon = access_info is None or (
+                _epoch_milliseconds(access_info.expires) -
+                time.time() * 1000 <= self._margin_ms + self._grace_ms)
+            if expires_soon:
+                with self._lock:
+                    self._hitters.discard((tenant, token, url))
+
+        return refreshed
+
+    def stop(self):
+        """Stops the worker thread, if any."""
+        self._stop.set()
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._hitters = heavy_hitters.SpaceSaving(self._capacity)
+        self._worker = None
+
+    def _ensure_worker(self):
+        # NOTE: Started lazily, like the stats flusher, so the thread
+        # runs in the worker processes rather than in a forking master.
+        if self._worker is not None and self._worker.is_alive():
+            return
+
+        if self._worker is not None:
+            fork.postfork()
+
+        self._worker = threading.Thread(target=self._run,
+                                        name='eom-auth-refresh-ahead')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def _run(self):
+        # NOTE: The interval is jittered so that the processes of a host,
+        # which track the same tokens, do not all check them at once; the
+        # first one to refresh an entry extends it for the others.
+        while not self._stop.wait(self._interval * random.uniform(0.5, 1.5)):
+            try:
+                self.refresh()
+            except Exception as ex:
+                LOG.error('Refresh-ahead failed: {0}'.format(ex))
 
-        # Build the cache key and store the value
-        cache_key = _tuple_to_cache_key((tenant, token, url))
-        redis_client.set(cache_key, cache_data)
 
-        # Get the cache expiration time
-        cache_expiration_time = _get_expiration_time(access_info.expires,
-                                                     max_cache_life)
+def _scope_allows(access_info, tenant):
+    """Determines if a token may be used with a tenant
 
-        redis_client.pexpireat(cache_key, cache_expiration_time)
+    :param access_info: keystoneclient.access.AccessInfo of the token
+    :param tenant: tenant id requested
 
+    :returns: True if the token is scoped to the tenant, or has a role on it
+    """
+    if access_info.project_id == tenant:
         return True
 
-    except Exception as ex:
-        msg = 'Failed to cache the data - Exception: {0}'.format(str(ex))
-        LOG.error(msg)
-        return False
+    # NOTE: Roles only tell their tenant (tenantId) with Rackspace
+    # Identity, an extension of v2.0; elsewhere, only the scope of the
+    # token counts.
+    roles = access_info.get('user', {}).get('roles', [])
+    return any(role.get('tenantId') == tenant for role in roles)
 
 
-def _retrieve_data_from_cache(redis_client, url, tenant, token):
-    """Retrieve the authentication data from cache
+def _role_names(access_info, tenant):
+    """Lists the roles a token grants on a tenant
 
-    :param redis_client: redis.Redis object connected to the redis cache
-    :param url: URL used for authentication
-    :param tenant: tenant id of the user
-    :param token: auth_token for the user
+    :param access_info: keystoneclient.access.AccessInfo of the token
+    :param tenant: tenant id requested
 
-    :returns: a keystoneclient.access.AccessInfo on success or None
+    :returns: the names of the roles to forward in X-Roles
     """
-    cached_data = None
-    cache_key = None
-    try:
-        # Try to get the data from the cache
-        cache_key_tuple = (tenant, token, url)
-        cache_key = _tuple_to_cache_key(cache_key_tuple)
-        cached_data = redis_client.get(cache_key)
-    except Exception as ex:
-        LOG.debug(
-            (
-                'Failed to retrieve data to cache for key {0}'
-                'Exception: {1}'
-            ).format(cache_key, str(ex))
-        )
-        return None
-
-    if cached_data is not None:
-        # So 'data' can be used in the exception handler...
-        data = None
+    if not _token_cache_enabled():
+        return access_info.role_names
 
-        try:
-            data = __unpacker(cached_data)
-            return access.AccessInfoV2(data)
+    # NOTE: A token cached once for all of its tenants may hold roles
+    # on other tenants than the one requested; only the global ones
+    # and those given on the tenant requested apply.
+    roles = access_info.get('user', {}).get('roles')
+    if roles is None:
+        if access_info.project_id == tenant:
+            return access_info.role_names
+        return []
 
-        except Exception as ex:
-            # The cached object didn't match what we expected
-            msg = (
-                'Stored Data does not contain any credentials - '
-                'Exception: {0}; Data: {1}'
-            ).format(str(ex), data)
-            LOG.error(msg)
-            return None
-    else:
-        LOG.debug('No data in cache for key {0}'.format(cache_key))
-        # It wasn't cached
-        return None
+    return [role['name'] for role in roles
+            if role.get('tenantId') in (None, tenant)]
 
 
-def _retrieve_data_from_keystone(redis_client, url, tenant, token,
-                                 blacklist_ttl, max_cache_life):
-    """Retrieve the authentication data from OpenStack Keystone
+def _check_cached_access_info(access_info, tenant):
+    """Determines if access information read from the cache may be used
 
-    :param redis_client: redis.Redis object connected to the redis cache
-    :param url: Keystone Identity URL to authenticate against
-    :param tenant: tenant id of user data to retrieve
-    :param token: auth_token for the tenant_id
-    :param blacklist_ttl: time in milliseconds for blacklisting failed tokens
-    :param max_cache_life: time in seconds for the maximum time a cache entry
-                           should remain in the cache of valid data
+    :param access_info: keystoneclient.access.AccessInfo read, or None
+    :param tenant: tenant id requested
 
-    :returns: a keystoneclient.access.AccessInfo on success or None on error
+    :returns: access_info if it may be used for the tenant, otherwise None
     """
-    try:
-        # Try to authenticate the user and get the user information using
-        # only the data provided, no special administrative tokens required.
-        # When using the alternative validation method, the service catalog
-        # identity does not return a service catalog for valid tokens.
-
-        if get_conf().alternate_validation is True:
-            _url = url.rstrip('/') + '/tokens'
-            validation_url = _url + '/{0}'.format(token)
-            headers = {
-                'Accept': 'application/json',
-                'X-Auth-Token': token
-            }
-            resp = requests.get(validation_url, headers=headers)
-            if resp.status_code >= 400:
-                LOG.debug('Request returned failure status: {0}'.format(
-                    resp.status_code))
-                raise exceptions.from_response(resp, 'GET', _url)
+    if access_info is None:
+        return None
 
-            try:
-                resp_data = resp.json()['access']
-            except (KeyError, ValueError):
-                raise exceptions.InvalidResponse(response=resp)
+    if access_info.will_expire_soon():
+        LOG.info('Token has expired')
+        _incr('token.expiring')
+        return None
 
-            access_info = access.AccessInfoV2(**resp_data)
-        else:
-            keystone = keystonev2_client.Client(tenant_id=tenant,
-                                                token=token,
-                                                auth_url=url)
-            access_info = keystone.get_raw_token_from_identity_service(
-                auth_url=url, tenant_id=tenant, token=token)
+    # NOTE: The token may have been cached for another tenant, and be
+    # scoped to the one requested only once validated for it.
+    if _token_cache_enabled() and not _scope_allows(access_info, tenant):
+        _incr('cache.scope_miss')
+        return None
 
-        # cache the data so it is easier to access next time
-        _send_data_to_cache(redis_client, url, access_info, max_cache_life)
+    return access_info
 
-        return access_info
 
-    except (exceptions.AuthorizationFailure, exceptions.Unauthorized) as ex:
-        # re-raise 413 here and later on respond with 503
-        if 'HTTP 413' in str(ex):
-            raise exceptions.RequestEntityTooLarge(
-                method='POST',
-                url=url,
-                http_status=413
-            )
-        # Provided data was invalid and authorization failed
-        msg = 'Failed to authenticate against {0} - {1}'.format(
-            url,
-            str(ex)
-        )
-        LOG.debug(msg)
+def _check_validated_access_info(access_info, tenant):
+    """Determines if access information from Keystone may be used
 
-        # Blacklist the token
-        _blacklist_token(redis_client, token, blacklist_ttl)
-        return None
-    except exceptions.RequestEntityTooLarge:
-        LOG.debug('Request entity too large error from authentication server.')
-        raise
-    except Exception as ex:
-        # Provided data was invalid or something else went wrong
-        msg = 'Failed to authenticate against {0} - {1}'.format(
-            url,
-            str(ex)
-        )
-        LOG.debug(msg)
+    :param access_info: keystoneclient.access.AccessInfo validated, or None
+    :param tenant: tenant id requested
+
+    :returns: access_info if it may be used for the tenant, otherwise None
+    """
+    if access_info is None or not _token_cache_enabled():
+        return access_info
 
+    if not _scope_allows(access_info, tenant):
+        LOG.debug('Token is not valid for {0}'.format(tenant))
+        _incr('token.scope_denied')
         return None
 
+    return access_info
+
 
 def _get_access_info(redis_client, url, tenant, token, blacklist_ttl,
-                     max_cache_life):
+                     max_cache_life, source=None):
     """Retrieve the access information regarding the specified user
 
     :param redis_client: redis.Redis object connected to the redis cache
@@ -445,22 +2484,49 @@ def _get_access_info(redis_client, url, tenant, token, blacklist_ttl,
     :param blacklist_ttl: time in milliseconds for blacklisting failed tokens
     :param max_cache_life: time in seconds for the maximum time a cache entry
                            should remain in the cache of valid data
+    :param source: address of the client, charged if the token is invalid
 
     :returns: keystoneclient.access.AccessInfo for the user on success
               None on error
     """
 
+    group = get_conf()
+
+    if group.early_refresh_background:
+        refresh = functools.partial(_refresh_in_background, redis_client,
+                                    url, tenant, token, blacklist_ttl,
+                                    max_cache_life)
+    else:
+        refresh = functools.partial(_refresh, redis_client, url, tenant,
+                                    token, blacklist_ttl, max_cache_life,
+                                    source=source)
+
     # Check cache
-    access_info = _retrieve_data_from_cache(redis_client,
-                                            url,
-                                            tenant,
-                                            token)
+    access_info = _check_cached_access_info(_retrieve_data_from_cache(
+        redis_client, url, tenant, token,
+        early_refresh_beta=group.early_refresh_beta,
+        refresh=refresh,
+        serve_stale=_BREAKER is not None and _BREAKER.is_open()), tenant)
+
+    # Signed tokens are checked against the revocation list even when
+    # cached, and validated locally if they are not
+    if _PKI is not None and _PKI.is_signed(token):
+        revoked = _PKI.is_revoked(url, token)
+        if revoked:
+            LOG.debug('Token has been revoked')
+            _incr('pki.revoked')
+            _blacklist_token(redis_client, token, blacklist_ttl)
+            _record_source_failure(redis_client, source)
+            return None
 
-    if access_info is not None:
-        if access_info.will_expire_soon():
-            LOG.info('Token has expired')
-            del access_info
-            access_info = None
+        if access_info is None and revoked is False:
+            access_info = _PKI.verify(url, tenant, token)
+            if access_info is None:
+                _incr('pki.unverified')
+            else:
+                _incr('pki.valid')
+                _send_data_to_cache(redis_client, url, access_info,
+                                    max_cache_life)
 
     # Check if we failed to get it from the cache and
     # retrieve from keystone instead
@@ -471,7 +2537,9 @@ def _get_access_info(redis_client, url, tenant, token, blacklist_ttl,
                                                    tenant,
                                                    token,
                                                    blacklist_ttl,
-                                                   max_cache_life)
+                                                   max_cache_life,
+                                                   source=source)
+        access_info = _check_validated_access_info(access_info, tenant)
     else:
         LOG.debug('Retrieved token from cache.')
 
@@ -483,10 +2551,77 @@ def _get_access_info(redis_client, url, tenant, token, blacklist_ttl,
             del access_info
             access_info = None
 
+    if access_info is not None and _REFRESH_AHEAD is not None:
+        _REFRESH_AHEAD.record(url, tenant, token)
+
     # Return the access data
     return access_info
 
 
+def _identity_env(access_info, tenant):
+    """Build the environment describing the identity of a user
+
+    :param access_info: keystoneclient.access.AccessInfo of the token
+    :param tenant: tenant id requested
+
+    :returns: a dictionary of the HTTP_X_* environment variables to set,
+              None for those to remove, or None if the service catalog
+              could not be encoded
+    """
+    env = dict.fromkeys(IDENTITY_ENV)
+    env['HTTP_X_IDENTITY_STATUS'] = 'Confirmed'
+    env['HTTP_X_USER_ID'] = access_info.user_id
+    env['HTTP_X_USER_NAME'] = access_info.username
+    env['HTTP_X_USER_DOMAIN_ID'] = access_info.user_domain_id
+    env['HTTP_X_USER_DOMAIN_NAME'] = access_info.user_domain_name
+    env['HTTP_X_ROLES'] = ','.join(_role_names(access_info, tenant))
+    utf8_data = _service_catalog_data(access_info)
+    if utf8_data is not None:
+        # Store it as Base64 for transport
+        env['HTTP_X_SERVICE_CATALOG'] = base64.b64encode(utf8_data)
+
+        try:
+            decode_check = base64.b64decode(env['HTTP_X_SERVICE_CATALOG'])
+
+        except Exception:
+            LOG.debug('Failed to decode the data properly')
+            return None
+
+        if decode_check != utf8_data:
+            LOG.debug(
+                'Decode Check: decoded data does not match '
+                'encoded data'
+            )
+            return None
+
+    # Project Scoped V3 or Tenant Scoped v2
+    # This can be assumed since we validated using X_PROJECT_ID
+    # and therefore have at least a v2 Tenant Scoped Token
+    if _token_cache_enabled():
+        # NOTE: The token was checked to be valid for the tenant
+        # requested, which is not necessarily the one it is scoped to.
+        env['HTTP_X_PROJECT_ID'] = tenant
+        if access_info.project_id == tenant:
+            env['HTTP_X_PROJECT_NAME'] = access_info.project_name
+    elif access_info.project_scoped:
+        env['HTTP_X_PROJECT_ID'] = access_info.project_id
+        env['HTTP_X_PROJECT_NAME'] = access_info.project_name
+
+    # Domain-Scoped V3
+    if access_info.domain_scoped:
+        env['HTTP_X_DOMAIN_ID'] = access_info.domain_id
+        env['HTTP_X_DOMAIN_NAME'] = access_info.domain_name
+
+    # Project-Scoped V3 - X_PROJECT_NAME is only unique
+    # within the domain
+    if access_info.project_scoped and (
+            access_info.domain_scoped):
+        env['HTTP_X_PROJECT_DOMAIN_ID'] = access_info.project_domain_id
+        env['HTTP_X_PROJECT_DOMAIN_NAME'] = access_info.project_domain_name
+
+    return env
+
+
 def _validate_client(redis_client, url, tenant, token, env, blacklist_ttl,
                      max_cache_life):
     """Update the env with the access information for the user
@@ -513,7 +2648,18 @@ def _validate_client(redis_client, url, tenant, token, env, blacklist_ttl,
     patch_management_url()
 
     try:
+        source = None
+        group = get_conf()
+        if group.source_failure_limit > 0:
+            source = _client_address(env, group.source_trusted_proxies)
+            if source is not None and _is_source_blocked(
+                    redis_client, source, group.source_failure_limit):
+                _incr('source.blocked')
+                return False
+
         if _is_token_blacklisted(redis_client, token):
+            _incr('blacklist.hit')
+            _record_source_failure(redis_client, source)
             return False
 
         # Try to get the client's access information
@@ -522,78 +2668,33 @@ def _validate_client(redis_client, url, tenant, token, env, blacklist_ttl,
                                        tenant,
                                        token,
                                        blacklist_ttl,
-                                       max_cache_life)
+                                       max_cache_life,
+                                       source=source)
 
         if access_info is None:
             LOG.debug('Unable to get Access info for {0}'.format(tenant))
             return False
 
-        # provided data was valid, insert the information into the environment
-        env['HTTP_X_IDENTITY_STATUS'] = 'Confirmed'
-
-        env['HTTP_X_USER_ID'] = access_info.user_id
-        env['HTTP_X_USER_NAME'] = access_info.username
-        env['HTTP_X_USER_DOMAIN_ID'] = access_info.user_domain_id
-        env['HTTP_X_USER_DOMAIN_NAME'] = access_info.user_domain_name
-        env['HTTP_X_ROLES'] = ','.join(role for role in access_info.role_names)
-        if access_info.has_service_catalog():
-            # Convert the service catalog to JSON
-            service_catalog_data = json.dumps(
-                access_info.service_catalog.catalog)
-
-            # convert service catalog to unicode to try to help
-            # prevent encode/decode errors under python2
-            if six.PY2:  # pragma: no cover
-                u_service_catalog_data = service_catalog_data.decode('utf-8')
-            else:  # pragma: no cover
-                u_service_catalog_data = service_catalog_data
-
-            # Convert the JSON string data to strict UTF-8
-            utf8_data = u_service_catalog_data.encode(
-                encoding='utf-8', errors='strict')
-
-            # Store it as Base64 for transport
-            env['HTTP_X_SERVICE_CATALOG'] = base64.b64encode(utf8_data)
-
-            try:
-                decode_check = base64.b64decode(env['HTTP_X_SERVICE_CATALOG'])
-
-            except Exception:
-                LOG.debug('Failed to decode the data properly')
-                return False
-
-            if decode_check != utf8_data:
-                LOG.debug(
-                    'Decode Check: decoded data does not match '
-                    'encoded data'
-                )
-                return False
-
-        # Project Scoped V3 or Tenant Scoped v2
-        # This can be assumed since we validated using X_PROJECT_ID
-        # and therefore have at least a v2 Tenant Scoped Token
-        if access_info.project_scoped:
-            env['HTTP_X_PROJECT_ID'] = access_info.project_id
-            env['HTTP_X_PROJECT_NAME'] = access_info.project_name
-
-        # Domain-Scoped V3
-        if access_info.domain_scoped:
-            env['HTTP_X_DOMAIN_ID'] = access_info.domain_id
-            env['HTTP_X_DOMAIN_NAME'] = access_info.domain_name
-
-        # Project-Scoped V3 - X_PROJECT_NAME is only unique
-        # within the domain
-        if access_info.project_scoped and (
-                access_info.domain_scoped):
-            env['HTTP_X_PROJECT_DOMAIN_ID'] = access_info.project_domain_id
-            env['HTTP_X_PROJECT_DOMAIN_NAME'] = access_info.project_domain_name
+        identity = _identity_env(access_info, tenant)
+        if identity is None:
+            return False
 
+        # provided data was valid, insert the information into the environment
+        for name, value in identity.items():
+            if value is None:
+                env.pop(name, None)
+            else:
+                env[name] = value
         return True
 
     except exceptions.RequestEntityTooLarge:
         LOG.debug('Request entity too large error from authentication server.')
         raise
 
+    except KeystoneUnavailable:
+        LOG.debug('Authentication server unavailable.')
+        raise
+
     except Exception as ex:
         msg = 'Error while trying to authenticate against {0} - {1}'.format(
             url,
@@ -625,7 +2726,74 @@ def _http_service_unavailable(start_response, delta):
     return []
 
 
-def wrap(app, redis_client):
+def invalidation_app(redis_client):
+    """Creates a WSGI app invalidating the cache entries of tenants and users
+
+    The app answers DELETE requests whose path ends with
+    /tenants/<tenant id> or /users/<user id> with the number of cache
+    entries removed, as JSON. It answers every request, so it is meant
+    to be mounted on a dedicated, restricted route.
+
+    :param redis_client: redis.Redis object connected to the redis cache
+    :returns: a WSGI app
+    """
+    invalidators = {
+        'tenants': invalidate_tenant,
+        'users': invalidate_user,
+    }
+
+    # WSGI callable
+    def app(env, start_response):
+        segments = env.get('PATH_INFO', '').rstrip('/').split('/')
+        invalidate = invalidators.get(segments[-2] if len(segments) > 1
+                                      else None)
+        if invalidate is None or not segments[-1]:
+            start_response('404 Not Found', [('Content-Length', '0')])
+            return []
+
+        if env.get('REQUEST_METHOD') != 'DELETE':
+            start_response('405 Method Not Allowed',
+                           [('Allow', 'DELETE'), ('Content-Length', '0')])
+            return []
+
+        try:
+            deleted = invalidate(redis_client, segments[-1])
+        except Exception as ex:
+            LOG.error('Failed to invalidate cache entries - {0}'.format(ex))
+            return _http_service_unavailable(start_response, None)
+
+        LOG.info('Invalidated {0} cache entries of {1} {2}'.format(
+            deleted, segments[-2], segments[-1]))
+
+        body = json.dumps({'invalidated': deleted}).encode('utf-8')
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+    return app
+
+
+def _setup_stats(group, stats_client=None):
+    """Sets where the statistics of the middleware are reported
+
+    :param group: the eom:auth options
+    :param stats_client: the stats_client given to wrap()
+    """
+    global _STATS
+    global _STAT_PREFIX
+
+    if stats_client is not None:
+        _STATS = stats_client
+        _STAT_PREFIX = 'auth.'
+    elif group['report_metrics']:
+        _STATS = metrics.get_client()
+        _STAT_PREFIX = metrics.stat_prefix() + '.auth.'
+    else:
+        _STATS = stats.NullClient()
+        _STAT_PREFIX = ''
+
+
+def wrap(app, redis_client, stats_client=None):
     """Wrap a WSGI app with Authentication middleware.
 
     Takes configuration from oslo.config.cfg.CONF.
@@ -633,16 +2801,106 @@ def wrap(app, redis_client):
 
     :param app: WSGI app to wrap
     :param redis_client: redis.Redis object connected to the redis cache
+    :param stats_client: object with the statsd.StatsClient interface
+        used to report cache and Keystone statistics, named auth.<stat>.
+        When not given, statistics are reported through the eom.metrics
+        client if the report_metrics option is set.
 
     :returns: a new  WSGI app that wraps the original
     """
+    global _REFRESH_AHEAD
+    global _BREAKER
+    global _BULKHEAD
+    global _RATE_LIMITER
+    global _BLACKLIST_FILTER
+    global _ENDPOINTS
+    global _SERVICE_TOKEN
+    global _PKI
 
     group = _CONF[AUTH_GROUP_NAME]
-    auth_url = group['auth_url']
+
+    _setup_stats(group, stats_client)
+
+    # NOTE: The first url is the one cache entries are stored under,
+    # whichever endpoint validated the token, so that entries survive a
+    # failover.
+    auth_urls = group['auth_url'] or []
+    auth_url = auth_urls[0] if auth_urls else None
     blacklist_ttl = group['blacklist_ttl']
     max_cache_life = group['max_cache_life']
 
-    LOG.debug('Auth URL: {0:}'.format(auth_url))
+    if _REFRESH_AHEAD is not None:
+        _REFRESH_AHEAD.stop()
+        _REFRESH_AHEAD = None
+
+    if group['refresh_ahead']:
+        _REFRESH_AHEAD = RefreshAhead(
+            redis_client, blacklist_ttl, max_cache_life,
+            capacity=group['refresh_ahead_tokens'],
+            margin=group['refresh_ahead_margin'],
+            interval=group['refresh_ahead_interval'],
+            stale_grace=group['stale_grace'])
+
+    _BREAKER = None
+    if group['circuit_breaker_failures'] > 0:
+        _BREAKER = circuit_breaker.CircuitBreaker(
+            group['circuit_breaker_failures'],
+            group['circuit_breaker_reset'])
+
+    if _BLACKLIST_FILTER is not None:
+        _BLACKLIST_FILTER.stop()
+        _BLACKLIST_FILTER = None
+
+    if group['blacklist_local_cache']:
+        longest_blacklisting = max(blacklist_ttl or 0,
+                                   group['blacklist_max_ttl'])
+        _BLACKLIST_FILTER = BlacklistFilter(
+            redis_client,
+            capacity=group['blacklist_local_size'],
+            warmup=longest_blacklisting / 1000.0)
+
+    _BULKHEAD = None
+    if group['keystone_max_concurrency'] > 0:
+        _BULKHEAD = limits.Bulkhead(group['keystone_max_concurrency'])
+
+    _RATE_LIMITER = None
+    if group['keystone_rate'] > 0:
+        if group['keystone_rate_shared']:
+            _RATE_LIMITER = limits.RedisRateLimiter(
+                redis_client, KEYSTONE_CALLS_KEY, group['keystone_rate'])
+        else:
+            _RATE_LIMITER = limits.TokenBucket(group['keystone_rate'],
+                                               group['keystone_burst'])
+
+    _ENDPOINTS = None
+    if len(auth_urls) > 1 or (auth_urls and group['hedge_requests']):
+        _ENDPOINTS = endpoints_util.Endpoints(
+            auth_urls,
+            hedge_percentile=(group['hedge_percentile']
+                              if group['hedge_requests'] else None))
+
+    # NOTE: With v2.0, tokens validate themselves; the service token is
+    # only needed for the PKI revocation list.
+    _SERVICE_TOKEN = None
+    if group['service_username'] and (group['auth_version'] == 'v3' or
+                                      group['pki_validation']):
+        _SERVICE_TOKEN = ServiceToken(
+            group['service_username'],
+            group['service_password'],
+            user_domain_name=group['service_user_domain_name'],
+            project_name=group['service_project_name'],
+            project_domain_name=group['service_project_domain_name'],
+            margin=group['service_token_margin'],
+            auth_version=group['auth_version'])
+
+    _PKI = None
+    if group['pki_validation']:
+        _PKI = PkiValidator(
+            signing_dir=group['pki_signing_dir'],
+            revocation_interval=group['pki_revocation_interval'],
+            hash_algorithms=group['pki_hash_algorithms'])
+
+    LOG.debug('Auth URLs: {0}'.format(', '.join(auth_urls)))
 
     def middleware(env, start_response):
         try:
@@ -670,6 +2928,7 @@ def wrap(app, redis_client):
             return _http_precondition_failed(start_response)
 
         except exceptions.RequestEntityTooLarge as exc:
+            _incr('unavailable')
             LOG.error(
                 'Request too large, client should retry after {0}.'.format(
                     exc.retry_after
@@ -677,4 +2936,13 @@ def wrap(app, redis_client):
             )
             return _http_service_unavailable(start_response, exc.retry_after)
 
+        except KeystoneUnavailable as exc:
+            _incr('unavailable')
+            LOG.error(
+                'Authentication server unavailable, client should retry '
+                'after {0}.'.format(exc.retry_after)
+            )
+            return _http_service_unavailable(start_response,
+                                             str(max(1, exc.retry_after)))
+
     return middleware
@@ -44,6 +44,8 @@ GOV_OPTIONS = [
     )
 ]
 
+BUCKET_KEY_PREFIX = 'eom:gov:'
+
 REDIS_GROUP_NAME = 'eom:redis'
 REDIS_OPTIONS = [
     cfg.StrOpt('host'),
@@ -150,39 +152,47 @@ def _load_project_rates(path):
         return {}
 
 
-def _create_limiter(redis_client):
-    """Creates a closure with the given params for convenience and perf."""
+def _bucket_key(project_id):
+    """Builds the Redis key of the bucket of a project.
 
-    def calc_sleep(project_id, rate):
-        now = time.time()
-        last_time = now
-        count = 1.0
-        new_count = 1.0
+    The project id is the Redis Cluster hash tag of the key, so that
+    every key of a project maps to the same slot.
+    """
+    return '{0}{{{1}}}'.format(BUCKET_KEY_PREFIX, project_id)
 
-        try:
-            lookup = redis_client.hmget(project_id, 'c', 't')
 
-            if lookup is not None:
-                count, last_time = lookup
+def _new_count(lookup, now, rate):
+    """Drains a bucket and counts one more request in it.
 
-                if count is None:
-                    count = float(1.0)
+    :param lookup: the count and time of the last update of the bucket,
+        as read from Redis, either of them None for a new bucket
+    :param float now: current time, in seconds since the epoch
+    :param rate: Rate the bucket is drained at
+    :returns: the new count of the bucket
+    """
+    count, last_time = lookup or (None, None)
+    if not count or not last_time:
+        return 1.0
 
-                if last_time is None:
-                    last_time = now
+    count, last_time = float(count), float(last_time)
 
-            if not all([count, last_time]):
-                raise KeyError
+    drain = (now - last_time) * rate.drain_velocity
+    # note(cabrera): disallow negative counts, increment inline
+    return max(0.0, count - drain) + 1.0
 
-            count, last_time = float(count), float(last_time)
 
-            drain = (now - last_time) * rate.drain_velocity
-            # note(cabrera): disallow negative counts, increment inline
-            new_count = max(0.0, count - drain) + 1.0
-            redis_client.hmset(project_id, {'c': new_count, 't': now})
+def _create_limiter(redis_client):
+    """Creates a closure with the given params for convenience and perf."""
 
-        except KeyError:
-            redis_client.hmset(project_id, {'c': 1.0, 't': now})
+    def calc_sleep(project_id, rate):
+        key = _bucket_key(project_id)
+        now = time.time()
+        new_count = 1.0
+
+        try:
+            lookup = redis_client.hmget(key, 'c', 't')
+            new_count = _new_count(lookup, now, rate)
+            redis_client.hmset(key, {'c': new_count, 't': now})
 
         except redis.exceptions.ConnectionError as ex:
             message = 'Redis Error:{0} for Project-ID:{1}'
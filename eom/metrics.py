@@ -13,20 +13,46 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
 import re
 import socket
 import time
+import weakref
 
 from oslo_config import cfg
 import statsd
 
+from eom.utils import fork
 from eom.utils import log as logging
+from eom.utils import prometheus
+from eom.utils import stats
 
 _CONF = cfg.CONF
 LOG = logging.getLogger(__name__)
 
+_CLIENT = None
+
+# NOTE: The statsd clients whose sockets are reopened after a fork,
+# held weakly so that they are not kept alive for it.
+_STATSD_CLIENTS = weakref.WeakSet()
+
+BACKEND_STATSD = 'statsd'
+BACKEND_PROMETHEUS = 'prometheus'
+
 OPT_GROUP_NAME = 'eom:metrics'
 OPTIONS = [
+    cfg.StrOpt('backend',
+               help=('Where metrics are sent: "statsd" pushes them to a '
+                     'statsd server, "prometheus" keeps them in files '
+                     'under prometheus_dir for scraping.'),
+               required=False,
+               default=BACKEND_STATSD),
+
+    cfg.StrOpt('prometheus_dir',
+               help=('Directory shared by all the workers of a host, used '
+                     'by the prometheus backend.'),
+               required=False),
+
     cfg.StrOpt('address',
                help='host for statsd server.',
                required=True,
@@ -52,15 +78,62 @@ OPTIONS = [
 
     cfg.StrOpt('app_name',
                help="Application name",
-               required=True)
+               required=True),
+
+    cfg.BoolOpt('aggregate',
+                help=('Accumulate metrics in-process and send them to '
+                      'statsd in batches instead of one packet per call.'),
+                required=False,
+                default=False),
+
+    cfg.FloatOpt('flush_interval',
+                 help='Seconds between flushes of aggregated metrics.',
+                 required=False,
+                 default=1.0),
+
+    cfg.StrOpt('flush_mode',
+               help=('How aggregated metrics are flushed: "thread" uses a '
+                     'background thread, "uwsgi" uses a uwsgi timer.'),
+               required=False,
+               default=stats.FLUSH_MODE_THREAD),
+
+    cfg.IntOpt('flush_uwsgi_signal',
+               help='uwsgi signal number used by the "uwsgi" flush mode.',
+               required=False,
+               default=77),
+
+    cfg.BoolOpt('histograms',
+                help=('Keep local latency histograms per request method and '
+                      'API method, and send their percentiles as gauges. '
+                      'Implies aggregate.'),
+                required=False,
+                default=False),
+
+    cfg.ListOpt('histogram_percentiles',
+                help='Percentiles sent for each latency histogram.',
+                required=False,
+                default=['50', '90', '99']),
+
+    cfg.FloatOpt('histogram_relative_accuracy',
+                 help='Relative error of the histogram percentiles.',
+                 required=False,
+                 default=0.01),
+
+    cfg.FloatOpt('timing_sample_rate',
+                 help=('Fraction of requests whose raw latency is still sent '
+                       'to statsd as a timing sample.'),
+                 required=False,
+                 default=1.0)
 ]
 
 
 def configure(config):
     global _CONF
     global LOG
+    global _CLIENT
 
     _CONF = config
+    _CLIENT = None
     _CONF.register_opts(OPTIONS, group=OPT_GROUP_NAME)
 
     logging.register(_CONF, OPT_GROUP_NAME)
@@ -73,65 +146,303 @@ def get_conf():
     return _CONF[OPT_GROUP_NAME]
 
 
-def wrap(app):
-    addr = _CONF[OPT_GROUP_NAME].address
-    port = _CONF[OPT_GROUP_NAME].port
-    keys = _CONF[OPT_GROUP_NAME].path_regexes_keys
-    values = _CONF[OPT_GROUP_NAME].path_regexes_values
-    prefix = _CONF[OPT_GROUP_NAME].prefix
-    app_name = _CONF[OPT_GROUP_NAME].app_name
-
-    regex_strings = zip(keys, values)
-    regex = []
-    for (method, pattern) in regex_strings:
-        regex.append((method, re.compile(pattern)))
-
-    client = statsd.StatsClient(host=addr,
-                                port=port,
-                                prefix=prefix)
+class _ResponseIterator(object):
 
-    # initialize buckets
+    """Wraps a WSGI response iterable to time the body iteration."""
+
+    # NOTE: Hard-code slots to make attribute access faster.
+    __slots__ = (
+        '_response',
+        '_iterator',
+        '_start',
+        '_first_byte',
+        '_bytes',
+        '_report',
+    )
+
+    def __init__(self, response, start, report):
+        """Initializes attributes.
+
+        :param response: iterable returned by the wrapped app
+        :param float start: request start time, in milliseconds
+        :param report: callable taking the time to first byte, the time
+            to last byte and the number of bytes sent, called once
+        """
+        self._response = response
+        self._iterator = iter(response)
+        self._start = start
+        self._first_byte = None
+        self._bytes = 0
+        self._report = report
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self._iterator)
+        except StopIteration:
+            self._done()
+            raise
+
+        if chunk:
+            if self._first_byte is None:
+                self._first_byte = time.time() * 1000
+            self._bytes += len(chunk)
+
+        return chunk
+
+    next = __next__
+
+    def close(self):
+        try:
+            if hasattr(self._response, 'close'):
+                self._response.close()
+        finally:
+            self._done()
+
+    def _done(self):
+        report, self._report = self._report, None
+        if report is None:
+            return
+
+        stop = time.time() * 1000
+        first_byte = self._first_byte if self._first_byte else stop
+        report(first_byte - self._start, stop - self._start, self._bytes)
+
+
+def get_client():
+    """Gets the metrics client shared by the eom middlewares.
+
+    The client is created from the eom:metrics options the first time
+    it is requested, so that every middleware reporting metrics shares
+    one socket and, when aggregating, one flusher.
+
+    :returns: an object with the statsd.StatsClient interface
+    """
+    global _CLIENT
+
+    fork.postfork()
+    if _CLIENT is None:
+        _CLIENT = _create_client(_CONF[OPT_GROUP_NAME])
+
+    return _CLIENT
+
+
+def stat_prefix():
+    """Gets the prefix of the stat names reported for this process.
+
+    :returns: "<app_name>.<hostname>", or just the app_name with the
+        prometheus backend
+    """
+    group = _CONF[OPT_GROUP_NAME]
+    if group.backend == BACKEND_PROMETHEUS:
+        return group.app_name
+
+    # NOTE: The hostname does not change while the process is alive,
+    # so callers should look it up once rather than on every request.
+    return group.app_name + "." + socket.gethostname()
+
+
+def exposition_app():
+    """Creates a WSGI app serving the metrics of the prometheus backend.
+
+    :returns: a WSGI app reporting the metrics of every worker process
+        sharing the configured prometheus_dir
+    """
+    return prometheus.exposition_app(_CONF[OPT_GROUP_NAME].prometheus_dir)
+
+
+def _create_client(group):
+    if group.backend == BACKEND_PROMETHEUS:
+        return prometheus.Client(group.prometheus_dir)
+
+    client = statsd.StatsClient(host=group.address,
+                                port=group.port,
+                                prefix=group.prefix)
+    _STATSD_CLIENTS.add(client)
+
+    if group.aggregate or group.histograms:
+        percentiles = [float(p) for p in group.histogram_percentiles]
+        client = stats.Aggregator(
+            client,
+            flush_interval=group.flush_interval,
+            flush_mode=group.flush_mode,
+            uwsgi_signal=group.flush_uwsgi_signal,
+            percentiles=percentiles,
+            relative_accuracy=group.histogram_relative_accuracy)
+
+    return client
+
+
+def _reopen_socket(client):
+    # NOTE: statsd.StatsClient has no public way to recreate its socket;
+    # closing the inherited one only drops the child's reference to it.
+    sock = client._sock
+    client._sock = socket.socket(sock.family, sock.type)
+    sock.close()
+
+
+def _after_fork():
+    for client in list(_STATSD_CLIENTS):
+        _reopen_socket(client)
+
+
+fork.register(_after_fork)
+
+
+def _path_regexes(group):
+    """Compiles the regexes naming the API methods of the paths.
+
+    :returns: a list of (API method name, compiled regex) pairs
+    """
+    return [(method, re.compile(pattern)) for (method, pattern)
+            in zip(group.path_regexes_keys, group.path_regexes_values)]
+
+
+def _api_method(regex, path):
+    """Names the API method of a path; the last matching regex wins."""
+    api_method = "unknown"
+    for (method, regex_pattern) in regex:
+        if regex_pattern.match(path):
+            api_method = method
+
+    return api_method
+
+
+def _init_buckets(client, base_path, regex):
+    # NOTE: A zero increment creates the bucket in a single packet,
+    # and never makes a Prometheus counter go down.
     for request_method in ["GET", "PUT", "HEAD", "POST", "DELETE", "PATCH"]:
-        for name, regexstr in regex_strings:
+        for name, _ in regex:
             for code in ["2xx", "4xx", "5xx"]:
-                client.incr(app_name + "." + socket.gethostname() +
-                            ".requests." + request_method + "." +
-                            name + "." + code)
-                client.decr(app_name + "." + socket.gethostname() +
+                client.incr(base_path +
                             ".requests." + request_method + "." +
-                            name + "." + code)
+                            name + "." + code, 0)
+
+
+@contextlib.contextmanager
+def _batch(client):
+    """Batches the stats sent within the block into one packet.
+
+    Clients without a pipeline, such as the aggregator or the
+    prometheus client, already avoid a packet per stat and are used
+    as they are.
+    """
+    pipeline = getattr(client, 'pipeline', None)
+    if pipeline is None:
+        yield client
+        return
+
+    with pipeline() as pipe:
+        yield pipe
+
+
+def _content_length(headers):
+    for name, value in headers:
+        if name.lower() == 'content-length':
+            try:
+                return int(value)
+            except ValueError:
+                break
+
+    return 0
+
+
+def _count_status(client, status_path, status_code):
+    if status_code // 100 == 5:
+        client.incr(status_path + ".5xx")
+    elif status_code // 100 == 4:
+        client.incr(status_path + ".4xx")
+    elif status_code // 100 == 2:
+        client.incr(status_path + ".2xx")
+
+
+def _reporter(client, base_path, request_method, api_method,
+              histograms, timing_sample_rate, started):
+    """Creates the callable reporting the status and timing of a response.
+
+    :param list started: the status code and headers passed to
+        start_response, once it is called
+    :returns: a callable taking the time to first byte, the time to
+        last byte and the number of bytes sent
+    """
+    def _report(first_byte, last_byte, sent):
+        latency_path = base_path + ".latency." + request_method
+
+        # NOTE: Without aggregation, the stats of a request would
+        # otherwise cost one packet each.
+        with _batch(client) as batch:
+            if started:
+                status_path = (base_path + ".requests." +
+                               request_method + "." + api_method)
+                _count_status(batch, status_path, started[0])
+
+            if timing_sample_rate > 0:
+                batch.timing(base_path + ".ttfb." + request_method,
+                             first_byte, timing_sample_rate)
+                batch.timing(latency_path, last_byte, timing_sample_rate)
+            if histograms:
+                batch.histogram(latency_path + "." + api_method, last_byte)
+            batch.incr(base_path + ".bytes." + request_method, sent)
+
+    return _report
+
+
+def wrap(app):
+    group = _CONF[OPT_GROUP_NAME]
+    regex = _path_regexes(group)
+    histograms = group.histograms
+    timing_sample_rate = group.timing_sample_rate
+
+    client = get_client()
+    base_path = stat_prefix()
+
+    # initialize buckets
+    _init_buckets(client, base_path, regex)
 
     def middleware(env, start_response):
 
         request_method = env["REQUEST_METHOD"]
-        path = env["PATH_INFO"]
-        hostname = socket.gethostname()
-        api_method = "unknown"
+        api_method = _api_method(regex, env["PATH_INFO"])
 
-        for (method, regex_pattern) in regex:
-            if regex_pattern.match(path):
-                api_method = method
+        # NOTE: The status is counted along with the timing of the
+        # response, so that they are sent together.
+        started = []
 
         def _start_response(status, headers, *args):
-            status_path = (app_name + "." + hostname + ".requests." +
-                           request_method + "." + api_method)
-            status_code = int(status[:3])
-            if status_code / 500 == 1:
-                client.incr(status_path + ".5xx")
-            elif status_code / 400 == 1:
-                client.incr(status_path + ".4xx")
-            elif status_code / 200 == 1:
-                client.incr(status_path + ".2xx")
-
+            started[:] = [int(status[:3]), headers]
             return start_response(status, headers, *args)
 
+        _report = _reporter(client, base_path, request_method, api_method,
+                            histograms, timing_sample_rate, started)
+
         start = time.time() * 1000
-        response = app(env, _start_response)
-        stop = time.time() * 1000
+        try:
+            response = app(env, _start_response)
+        except Exception:
+            elapsed = time.time() * 1000 - start
+            _report(elapsed, elapsed, 0)
+            raise
+
+        # NOTE: A list or tuple body is complete by the time the app
+        # returns, so there is nothing left to time.
+        if isinstance(response, (list, tuple)):
+            elapsed = time.time() * 1000 - start
+            _report(elapsed, elapsed, sum(len(chunk) for chunk in response))
+            return response
+
+        # NOTE: The server only sends a file wrapper efficiently, e.g.
+        # with sendfile(), if it gets it back unwrapped; its sending is
+        # not timed then.
+        file_wrapper = env.get('wsgi.file_wrapper')
+        if (isinstance(file_wrapper, type) and
+                isinstance(response, file_wrapper)):
+            elapsed = time.time() * 1000 - start
+            sent = _content_length(started[1]) if started else 0
+            _report(elapsed, elapsed, sent)
+            return response
 
-        elapsed = stop - start
-        client.timing(app_name + "." + hostname + ".latency." +
-                      request_method, elapsed)
-        return response
+        return _ResponseIterator(response, start, _report)
 
     return middleware
@@ -0,0 +1,238 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""profiler: per-layer timing of a middleware onion.
+
+The profiler wraps every layer of the onion as it is built, and
+records for a sample of the requests how long each layer took,
+both inclusive (the layer and everything inside it) and exclusive
+(the layer alone).
+
+Building a profiled onion looks like:
+
+    app = profiler.build(app, [
+        ('rbac', rbac.wrap),
+        ('auth', lambda app: auth.wrap(app, auth_redis_client)),
+        ('governor', lambda app: governor.wrap(app, redis_client)),
+        ('metrics', metrics.wrap),
+    ])
+
+Layers are listed from the innermost to the outermost; the app itself
+is reported as the "app" layer.
+
+The timings, in milliseconds, are sent through the eom.metrics client
+as <prefix>.profile.<layer>.inclusive and .exclusive. They can also be
+returned to the caller in a Server-Timing header, e.g.:
+
+    Server-Timing: auth;dur=1.930, rbac;dur=0.050, app;dur=12.100
+
+where each duration is the exclusive time of the layer, from the
+outermost to the innermost. Only the time spent in the call to each
+layer is measured, not the iteration of the response body. The
+configuration is given as:
+
+    [eom:profiler]
+    sample_rate = 0.01
+    server_timing = False
+
+"""
+
+import random
+import timeit
+
+from oslo_config import cfg
+
+from eom import metrics
+from eom.utils import log as logging
+
+_CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+ENV_KEY = 'eom.profiler'
+APP_LAYER_NAME = 'app'
+
+OPT_GROUP_NAME = 'eom:profiler'
+OPTIONS = [
+    cfg.FloatOpt(
+        'sample_rate',
+        help='Fraction of the requests that are profiled.',
+        default=0.01
+    ),
+    cfg.BoolOpt(
+        'server_timing',
+        help='Add a Server-Timing header to the profiled responses.',
+        default=False
+    )
+]
+
+# NOTE: timeit.default_timer is the most precise clock available
+# on each platform and python version.
+_timer = timeit.default_timer
+
+
+def configure(config):
+    global _CONF
+    global LOG
+
+    _CONF = config
+    _CONF.register_opts(OPTIONS, group=OPT_GROUP_NAME)
+
+    logging.register(_CONF, OPT_GROUP_NAME)
+    logging.setup(_CONF, OPT_GROUP_NAME)
+    LOG = logging.getLogger(__name__)
+
+
+def get_conf():
+    global _CONF
+    return _CONF[OPT_GROUP_NAME]
+
+
+class _Profile(object):
+
+    """Timings of a single profiled request."""
+
+    __slots__ = (
+        'children',
+        'timings',
+    )
+
+    def __init__(self):
+        # NOTE: One accumulator of the inclusive time of the child
+        # layers for every layer currently on the call stack.
+        self.children = []
+        self.timings = []
+
+
+def _timed(name, app):
+    """Wraps one layer of the onion to record its timings."""
+
+    # WSGI callable
+    def middleware(env, start_response):
+        profile = env.get(ENV_KEY)
+        if profile is None:
+            return app(env, start_response)
+
+        children = profile.children
+        children.append(0.0)
+        start = _timer()
+        try:
+            return app(env, start_response)
+        finally:
+            inclusive = (_timer() - start) * 1000
+            exclusive = inclusive - children.pop()
+            if children:
+                children[-1] += inclusive
+            profile.timings.append((name, inclusive, exclusive))
+
+    return middleware
+
+
+def _server_timing(timings):
+    return ', '.join('{0};dur={1:.3f}'.format(name, exclusive)
+                     for name, inclusive, exclusive in reversed(timings))
+
+
+def _profiled(app, stats_client, prefix):
+    """Wraps the outermost layer to sample and report the requests."""
+    group = _CONF[OPT_GROUP_NAME]
+    sample_rate = group.sample_rate
+    server_timing = group.server_timing
+
+    def _report(timings):
+        for name, inclusive, exclusive in timings:
+            path = prefix + name
+            stats_client.timing(path + '.inclusive', inclusive)
+            stats_client.timing(path + '.exclusive', exclusive)
+
+    # WSGI callable
+    def middleware(env, start_response):
+        if random.random() >= sample_rate:
+            return app(env, start_response)
+
+        profile = _Profile()
+        env[ENV_KEY] = profile
+
+        if not server_timing:
+            try:
+                return app(env, start_response)
+            finally:
+                _report(profile.timings)
+
+        # NOTE: The header can only be added once every layer has
+        # returned, so the call to start_response is held back until
+        # then, unless the app needs to write() before returning.
+        pending = []
+        sent = []
+
+        def _start_response(status, headers, *args):
+            if sent:
+                return start_response(status, headers, *args)
+
+            del pending[:]
+            pending.append((status, headers, args))
+            return _write
+
+        def _write(data):
+            if not sent:
+                status, headers, args = pending.pop()
+                sent.append(start_response(status, headers, *args))
+            return sent[0](data)
+
+        try:
+            response = app(env, _start_response)
+        finally:
+            _report(profile.timings)
+
+        if pending:
+            status, headers, args = pending.pop()
+            headers = list(headers)
+            headers.append(('Server-Timing', _server_timing(profile.timings)))
+            sent.append(start_response(status, headers, *args))
+        elif not sent:
+            # NOTE: Apps that call start_response lazily, while their
+            # body is iterated, are passed through without the header.
+            sent.append(None)
+
+        return response
+
+    return middleware
+
+
+def build(app, layers, stats_client=None):
+    """Builds a middleware onion with every layer profiled.
+
+    Takes configuration from oslo.config.cfg.CONF.
+    Requires profiler.configure() be called first.
+
+    :param app: WSGI app at the core of the onion
+    :param layers: list of (name, wrap) tuples, from the innermost to
+        the outermost layer, where wrap is a callable that takes a WSGI
+        app and returns a new WSGI app that wraps it
+    :param stats_client: object with the statsd.StatsClient interface
+        used to report the timings; by default the eom.metrics client,
+        in which case eom.metrics must be configured
+    :returns: a new WSGI app that wraps the original
+    """
+    if stats_client is None:
+        stats_client = metrics.get_client()
+        prefix = metrics.stat_prefix() + '.profile.'
+    else:
+        prefix = 'profile.'
+
+    wrapped = _timed(APP_LAYER_NAME, app)
+    for name, wrap in layers:
+        wrapped = _timed(name, wrap(wrapped))
+
+    return _profiled(wrapped, stats_client, prefix)
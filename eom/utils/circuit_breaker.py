@@ -0,0 +1,142 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""circuit_breaker: failing fast while a dependency is down.
+
+The breaker starts closed and lets every call through. After a number
+of consecutive failures it opens, and calls are rejected without being
+made. Once reset_timeout seconds have passed, a single trial call is
+let through (half-open): the circuit closes again if it succeeds, and
+opens for another reset_timeout if it fails. A trial call whose outcome
+is not recorded within reset_timeout seconds is given up on, and
+another one is let through.
+
+The state is local to the process.
+"""
+
+import threading
+import timeit
+
+from eom.utils import fork
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+_timer = timeit.default_timer
+
+
+class CircuitBreaker(object):
+
+    """Tracks the failures of calls to a dependency."""
+
+    def __init__(self, failure_threshold, reset_timeout):
+        """Initializes a closed breaker.
+
+        :param int failure_threshold: consecutive failures that open
+            the circuit
+        :param float reset_timeout: seconds the circuit stays open
+            before a trial call is let through
+        """
+        if failure_threshold < 1:
+            raise ValueError('failure_threshold must be at least 1')
+
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = None
+
+        fork.register(self._after_fork)
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and self._elapsed():
+                return HALF_OPEN
+            return self._state
+
+    def is_open(self):
+        """Tells whether calls are being rejected at the moment."""
+        with self._lock:
+            if self._state == CLOSED:
+                return False
+            return not self._elapsed()
+
+    def allow(self):
+        """Decides whether a call may be made now.
+
+        Every call allowed must be followed by a call to either
+        record_success(), record_failure() or cancel().
+
+        :returns: True if the call may be made
+        """
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+
+            # NOTE: The trial call is timed like the open state, so
+            # that a lost trial does not keep the circuit open.
+            if self._elapsed():
+                self._state = HALF_OPEN
+                self._opened_at = _timer()
+                return True
+
+            return False
+
+    def cancel(self):
+        """Gives back a call that was allowed but not made.
+
+        A trial call given back is let through again right away.
+        """
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._state = OPEN
+                self._opened_at = _timer() - self._reset_timeout
+
+    def record_success(self):
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if (self._state == HALF_OPEN or
+                    self._failures >= self._failure_threshold):
+                self._state = OPEN
+                self._opened_at = _timer()
+
+    def retry_after(self):
+        """Seconds until a trial call may be made, 0 when closed."""
+        with self._lock:
+            if self._state == CLOSED:
+                return 0
+            return max(0, self._reset_timeout - (_timer() - self._opened_at))
+
+    def _elapsed(self):
+        return _timer() - self._opened_at >= self._reset_timeout
+
+    def _after_fork(self):
+        # NOTE: The state is kept; a dependency down for the parent is
+        # most likely down for the children too. A trial call made by
+        # the parent will not be reported here, so another is allowed.
+        self._lock = threading.Lock()
+        if self._state == HALF_OPEN:
+            self._state = OPEN
+            self._opened_at = _timer() - self._reset_timeout
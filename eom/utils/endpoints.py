@@ -0,0 +1,147 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""endpoints: latency-aware selection among equivalent endpoints.
+
+Each endpoint is scored by a moving average of the latency of its
+recent replies, failures counting as very slow replies. An endpoint is
+picked out of two drawn at random, the one with the lower score
+winning, except for a small fraction of picks left to chance so that
+an endpoint that recovered gets traffic again.
+
+The latencies of the successful replies are also counted in a
+histogram, from which the delay after which a request is worth
+hedging, i.e. sent again to another endpoint, is derived.
+"""
+
+import random
+import threading
+
+from eom.utils import fork
+from eom.utils import histogram as hist
+
+DEFAULT_DECAY = 0.1
+DEFAULT_EXPLORATION = 0.05
+DEFAULT_HEDGE_PERCENTILE = 95
+
+# NOTE: In seconds, the latency recorded for a failed request.
+FAILURE_LATENCY = 5.0
+
+# NOTE: Latencies are counted in windows of this many samples, so the
+# hedging delay follows changes in the latency of the endpoints; the
+# delay is only known once a window holds at least MIN_SAMPLES.
+WINDOW_SAMPLES = 1000
+MIN_SAMPLES = 20
+
+
+class Endpoints(object):
+
+    """Scores a set of equivalent endpoints by their latency."""
+
+    def __init__(self, urls, decay=DEFAULT_DECAY,
+                 exploration=DEFAULT_EXPLORATION,
+                 hedge_percentile=DEFAULT_HEDGE_PERCENTILE):
+        """Initializes the endpoints.
+
+        :param urls: list of the urls of the endpoints
+        :param float decay: weight of each new latency sample in the
+            moving average of an endpoint, between 0 and 1
+        :param float exploration: fraction of the picks left to chance
+        :param float hedge_percentile: percentile of the latencies,
+            between 0 and 100, after which requests are hedged; None
+            never hedges them
+        """
+        if not urls:
+            raise ValueError('At least one endpoint is required')
+
+        self.urls = list(urls)
+        self.scores = [0.0] * len(self.urls)
+        self._decay = decay
+        self._exploration = exploration
+        self._hedge_quantile = (None if hedge_percentile is None
+                                else hedge_percentile / 100.0)
+
+        self._lock = threading.Lock()
+        self._latencies = hist.LogHistogram()
+        self._previous_latencies = None
+
+        fork.register(self._after_fork)
+
+    def choose(self, exclude=None):
+        """Picks an endpoint.
+
+        :param int exclude: index of an endpoint not to pick, unless it
+            is the only one
+        :returns: the index of the endpoint
+        """
+        candidates = [index for index in range(len(self.urls))
+                      if index != exclude] or [exclude]
+        if len(candidates) == 1:
+            return candidates[0]
+
+        first, second = random.sample(candidates, 2)
+        if random.random() < self._exploration:
+            return first
+
+        if self.scores[second] < self.scores[first]:
+            return second
+        return first
+
+    def observe(self, index, latency, failed=False):
+        """Records the outcome of a request.
+
+        :param int index: index of the endpoint
+        :param float latency: seconds the request took
+        :param bool failed: whether the endpoint failed to answer
+        """
+        if failed:
+            latency = max(latency, FAILURE_LATENCY)
+
+        # NOTE: Unlocked; a lost update only skews the average a bit.
+        score = self.scores[index]
+        self.scores[index] = score + self._decay * (latency - score)
+
+        if failed:
+            return
+
+        with self._lock:
+            self._latencies.add(latency)
+            if self._latencies.count >= WINDOW_SAMPLES:
+                self._previous_latencies = self._latencies
+                self._latencies = hist.LogHistogram()
+
+    def hedge_delay(self):
+        """Seconds after which a request is worth sending again.
+
+        :returns: the delay, or None if requests are not hedged or too
+            few were made so far
+        """
+        if self._hedge_quantile is None:
+            return None
+
+        with self._lock:
+            # NOTE: The last full window is preferred to the one being
+            # filled, which may only hold a few samples.
+            latencies = self._previous_latencies
+            if latencies is None:
+                latencies = self._latencies
+
+            if latencies.count < MIN_SAMPLES:
+                return None
+
+            return latencies.quantile(self._hedge_quantile)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
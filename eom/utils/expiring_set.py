@@ -0,0 +1,99 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""expiring_set: a bounded set whose members expire.
+
+Members are added with a time to live and silently leave the set once
+it has passed. The set holds at most a fixed number of members; when
+it is full, new members are not kept, but the set remembers until when
+it may have missed some, so that may_contain() never answers False for
+a member that was added and has not expired.
+"""
+
+import timeit
+
+_timer = timeit.default_timer
+
+
+class ExpiringSet(object):
+
+    """Set of keys, each with its own expiration."""
+
+    __slots__ = (
+        '_capacity',
+        '_expirations',
+        '_overflow_until',
+    )
+
+    def __init__(self, capacity):
+        """Initializes an empty set.
+
+        :param int capacity: maximum number of members kept
+        """
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+
+        self._capacity = capacity
+        self._expirations = {}
+        self._overflow_until = None
+
+    def __len__(self):
+        return len(self._expirations)
+
+    def __contains__(self, key):
+        expires = self._expirations.get(key)
+        if expires is None:
+            return False
+        if expires <= _timer():
+            del self._expirations[key]
+            return False
+        return True
+
+    def add(self, key, ttl):
+        """Adds a member, or extends its time to live.
+
+        :param key: the member
+        :param float ttl: seconds until the member expires
+        """
+        now = _timer()
+        expires = now + ttl
+        expirations = self._expirations
+
+        if key not in expirations and len(expirations) >= self._capacity:
+            self._purge(now)
+
+        if key in expirations or len(expirations) < self._capacity:
+            expirations[key] = max(expires, expirations.get(key, expires))
+            return
+
+        if self._overflow_until is None or expires > self._overflow_until:
+            self._overflow_until = expires
+
+    def may_contain(self, key):
+        """Tells whether a key may be a member.
+
+        :returns: False only if the key is certainly not a member
+        """
+        if key in self:
+            return True
+
+        return (self._overflow_until is not None and
+                self._overflow_until > _timer())
+
+    def _purge(self, now):
+        expired = [key for key, expires in self._expirations.items()
+                   if expires <= now]
+        for key in expired:
+            del self._expirations[key]
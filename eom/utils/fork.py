@@ -0,0 +1,125 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""fork: reinitialization of process-local state after a fork.
+
+Pre-forking servers (uwsgi, gunicorn --preload) may import the app,
+and so create the eom clients, in a master process that then forks
+the workers. Sockets, locks and buffers inherited that way must not be
+used by the workers, so every module holding such state registers a
+callback here to reset it.
+
+The callbacks are run in the child:
+
+- by os.register_at_fork, when available (Python 3.7+) and the
+  server forks through Python;
+- lazily, when an eom client notices that the PID changed;
+- or explicitly, by calling postfork() from the server's post-fork
+  hook, e.g. with uwsgi:
+
+    from uwsgidecorators import postfork
+    from eom.utils import fork
+
+    postfork(fork.postfork)
+
+Callbacks are run once per process, whichever comes first, and must
+be safe to run more than once.
+
+Bound methods are held by weak references, so registering one does not
+keep its object alive; the callback is dropped along with the object.
+"""
+
+import os
+import threading
+import weakref
+
+from eom.utils import log as logging
+
+LOG = logging.getLogger(__name__)
+
+_CALLBACKS = []
+_LOCK = threading.Lock()
+_PID = os.getpid()
+
+
+def _reference(callback):
+    # NOTE: weakref.WeakMethod does not exist on Python 2.
+    obj = getattr(callback, '__self__', None)
+    if obj is None:
+        # NOTE: Functions and other callables are held as they are.
+        return lambda: callback
+
+    func = callback.__func__
+    obj_ref = weakref.ref(obj)
+
+    def ref():
+        obj = obj_ref()
+        if obj is None:
+            return None
+        return func.__get__(obj, type(obj))
+
+    return ref
+
+
+def register(callback):
+    """Registers a callable to be run, without arguments, after a fork."""
+    with _LOCK:
+        # NOTE: Callbacks of the objects collected since are dropped
+        # here, so that the registry does not grow with them.
+        _CALLBACKS[:] = [ref for ref in _CALLBACKS if ref() is not None]
+        _CALLBACKS.append(_reference(callback))
+
+
+def unregister(callback):
+    """Removes a callable registered before, if any."""
+    with _LOCK:
+        _CALLBACKS[:] = [ref for ref in _CALLBACKS
+                         if ref() is not None and ref() != callback]
+
+
+def postfork():
+    """Runs the registered callbacks if the PID changed since last run.
+
+    Safe to call at any time; it does nothing in the process that
+    created the state or once the callbacks have run.
+    """
+    global _LOCK
+    global _PID
+
+    pid = os.getpid()
+    if pid == _PID:
+        return
+
+    # NOTE: No lock here, since one held by another thread at the time
+    # of the fork would never be released in the child. Two threads of
+    # a child may both get past the check, so callbacks must be safe
+    # to run twice.
+    _PID = pid
+    _LOCK = threading.Lock()
+
+    for ref in list(_CALLBACKS):
+        callback = ref()
+        if callback is None:
+            continue
+
+        try:
+            callback()
+        except Exception as ex:
+            LOG.error('Post-fork callback {0} failed: {1}'.format(
+                callback, ex))
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=postfork)
@@ -0,0 +1,102 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""heavy_hitters: bounded-memory tracking of the most frequent keys.
+
+SpaceSaving keeps a fixed number of counters. A key that is not
+tracked yet takes over the counter of the least frequent key, whose
+count it inherits as its possible overestimation, so that any key
+seen more often than 1/capacity of the time is guaranteed to be
+tracked.
+
+Counts can be decayed periodically so that keys that are not used
+anymore make room for new ones.
+"""
+
+
+class SpaceSaving(object):
+
+    """Approximate counts of the most frequent keys."""
+
+    __slots__ = (
+        '_capacity',
+        '_counts',
+        '_errors',
+    )
+
+    def __init__(self, capacity):
+        """Initializes an empty structure.
+
+        :param int capacity: maximum number of keys tracked
+        """
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+
+        self._capacity = capacity
+        self._counts = {}
+        self._errors = {}
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __contains__(self, key):
+        return key in self._counts
+
+    def add(self, key, count=1):
+        """Counts a key, evicting the least frequent one if needed."""
+        counts = self._counts
+        try:
+            counts[key] += count
+            return
+        except KeyError:
+            pass
+
+        error = 0
+        if len(counts) >= self._capacity:
+            # NOTE: A linear scan, only paid for keys that are not
+            # tracked yet; the capacity is expected to stay small.
+            evicted = min(counts, key=counts.get)
+            error = counts.pop(evicted)
+            del self._errors[evicted]
+
+        counts[key] = error + count
+        self._errors[key] = error
+
+    def discard(self, key):
+        """Stops tracking a key, if tracked."""
+        self._counts.pop(key, None)
+        self._errors.pop(key, None)
+
+    def top(self, n=None):
+        """Lists the most frequent keys.
+
+        :param int n: maximum number of keys listed, all by default
+        :returns: a list of (key, count, error) tuples, from the most
+            frequent key; the true count is between count - error and
+            count
+        """
+        keys = sorted(self._counts, key=self._counts.get, reverse=True)
+        return [(key, self._counts[key], self._errors[key])
+                for key in keys[:n]]
+
+    def decay(self, factor=0.5):
+        """Multiplies every count by a factor, dropping those below 1."""
+        for key in list(self._counts):
+            count = int(self._counts[key] * factor)
+            if count < 1:
+                self.discard(key)
+            else:
+                self._counts[key] = count
+                self._errors[key] = int(self._errors[key] * factor)
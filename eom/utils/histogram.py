@@ -0,0 +1,114 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""histogram: bounded-memory latency histograms.
+
+Values are counted in logarithmically sized buckets, so that any
+quantile can be estimated within a fixed relative error no matter the
+magnitude of the values. The number of buckets is capped; when the cap
+is reached the lowest buckets are merged, which only degrades the
+accuracy of the smallest quantiles.
+"""
+
+import math
+
+DEFAULT_RELATIVE_ACCURACY = 0.01
+DEFAULT_MAX_BUCKETS = 2048
+
+
+class LogHistogram(object):
+
+    """Histogram with logarithmic buckets."""
+
+    __slots__ = (
+        '_gamma',
+        '_log_gamma',
+        '_max_buckets',
+        '_buckets',
+        '_zero_count',
+        'count',
+        'max',
+    )
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY,
+                 max_buckets=DEFAULT_MAX_BUCKETS):
+        """Initializes an empty histogram.
+
+        :param float relative_accuracy: maximum relative error of the
+            quantile estimates, between 0 and 1
+        :param int max_buckets: maximum number of buckets kept
+        """
+        if not 0 < relative_accuracy < 1:
+            raise ValueError('relative_accuracy must be between 0 and 1')
+
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self._max_buckets = max_buckets
+        self._buckets = {}
+        self._zero_count = 0
+        self.count = 0
+        self.max = None
+
+    def add(self, value):
+        """Counts a value. Values <= 0 share a single bucket."""
+        self.count += 1
+        if self.max is None or value > self.max:
+            self.max = value
+
+        if value <= 0:
+            self._zero_count += 1
+            return
+
+        index = int(math.ceil(math.log(value) / self._log_gamma))
+        buckets = self._buckets
+        try:
+            buckets[index] += 1
+        except KeyError:
+            buckets[index] = 1
+            if len(buckets) > self._max_buckets:
+                self._collapse()
+
+    def quantile(self, q):
+        """Estimates the value at quantile q, between 0 and 1.
+
+        :returns: the estimate, or None if the histogram is empty
+        """
+        if self.count == 0:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = self._zero_count
+        if rank < seen:
+            return 0.0
+
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if rank < seen:
+                # NOTE: The midpoint of the bucket, in the relative
+                # sense, is within relative_accuracy of any of its values.
+                value = 2 * self._gamma ** index / (self._gamma + 1)
+                return min(value, self.max)
+
+        return self.max
+
+    def _collapse(self):
+        indexes = sorted(self._buckets)
+        lowest, second = indexes[0], indexes[1]
+        self._buckets[second] += self._buckets.pop(lowest)
+
+
+def percentile_name(percentile):
+    """Builds a metric suffix for a percentile, e.g. 99.9 -> 'p99_9'."""
+    return 'p' + ('%g' % float(percentile)).replace('.', '_')
@@ -0,0 +1,161 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""limits: budgets for calls made to a dependency.
+
+Every limiter here fails fast: a call over the budget is rejected
+right away rather than queued, and the caller is told how long to wait
+before trying again.
+
+- Bulkhead caps the number of concurrent calls made by a process.
+- TokenBucket caps the rate of calls made by a process, allowing
+  bursts up to the size of the bucket.
+- RedisRateLimiter caps the rate of calls made by every process
+  sharing a Redis server, counting them in one-second windows.
+"""
+
+import threading
+import time
+import timeit
+
+from eom.utils import fork
+from eom.utils import log as logging
+
+LOG = logging.getLogger(__name__)
+
+_timer = timeit.default_timer
+
+
+class Bulkhead(object):
+
+    """Caps the number of concurrent calls."""
+
+    def __init__(self, max_concurrent):
+        """Initializes the bulkhead.
+
+        :param int max_concurrent: maximum number of calls in progress
+        """
+        if max_concurrent < 1:
+            raise ValueError('max_concurrent must be at least 1')
+
+        self._max_concurrent = max_concurrent
+        self._semaphore = threading.BoundedSemaphore(max_concurrent)
+
+        fork.register(self._after_fork)
+
+    def acquire(self):
+        """Takes a slot, if any is free, without waiting.
+
+        :returns: True if a slot was taken, and must then be released
+        """
+        return self._semaphore.acquire(False)
+
+    def release(self):
+        self._semaphore.release()
+
+    def _after_fork(self):
+        # NOTE: Calls in progress in the parent are not the child's.
+        self._semaphore = threading.BoundedSemaphore(self._max_concurrent)
+
+
+class TokenBucket(object):
+
+    """Caps the rate of calls made by this process."""
+
+    def __init__(self, rate, burst=None):
+        """Initializes a full bucket.
+
+        :param float rate: tokens added to the bucket per second
+        :param int burst: size of the bucket, rate by default
+        """
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+
+        self._rate = float(rate)
+        self._capacity = float(max(1, burst or rate))
+        self._tokens = self._capacity
+        self._updated = _timer()
+        self._lock = threading.Lock()
+
+        fork.register(self._after_fork)
+
+    def consume(self):
+        """Takes a token from the bucket, if any.
+
+        :returns: 0 if a token was taken, otherwise the number of
+            seconds until the next one
+        """
+        with self._lock:
+            now = _timer()
+            self._tokens = min(self._capacity,
+                               self._tokens +
+                               (now - self._updated) * self._rate)
+            self._updated = now
+
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+
+            return (1 - self._tokens) / self._rate
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+
+class RedisRateLimiter(object):
+
+    """Caps the rate of calls made by every process sharing Redis."""
+
+    def __init__(self, redis_client, key, rate):
+        """Initializes the limiter.
+
+        :param redis_client: redis.Redis object holding the counters
+        :param str key: prefix of the counter keys, which may include a
+            Redis Cluster hash tag
+        :param float rate: calls allowed per second
+        """
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+
+        self._redis_client = redis_client
+        self._key = key
+        self._limit = max(1, int(rate))
+
+    def consume(self):
+        """Counts a call in the current window.
+
+        Calls are allowed when Redis cannot be reached, since the
+        limiter must not make the dependency unreachable as well.
+
+        :returns: 0 if the call is allowed, otherwise the number of
+            seconds until the next window
+        """
+        now = time.time()
+        window = int(now)
+        key = '{0}:{1}'.format(self._key, window)
+
+        try:
+            pipe = self._redis_client.pipeline(transaction=False)
+            pipe.incr(key)
+            pipe.pexpire(key, 2000)
+            count = pipe.execute()[0]
+        except Exception as ex:
+            LOG.warn('Failed to count call - {0}'.format(ex))
+            return 0
+
+        if count <= self._limit:
+            return 0
+
+        return window + 1 - now
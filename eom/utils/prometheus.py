@@ -0,0 +1,532 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""prometheus: multiprocess-safe Prometheus metrics.
+
+Every worker process writes its samples to its own memory-mapped file
+inside a directory shared by all the workers on the host. Since each
+file has a single writer, updates need no cross-process locking; a
+thread lock is enough. The exposition app reads every file in the
+directory and merges the samples, so a scrape of any worker reports
+the totals for the host.
+
+Files are named <type>_<pid>.db. Each one starts with an 8-byte
+header holding the number of bytes used, followed by entries made of
+a 4-byte key length, the UTF-8 key padded to a multiple of 8 bytes,
+and an 8-byte double.
+
+Once a process is gone, its counters and histograms are added to the
+<type>_archive.db files and its files removed, its gauges being
+dropped. Processes do so when they exit normally; collect() does it
+for those that no longer exist, and mark_process_dead() for a given
+one.
+
+The Client has the same interface as statsd.StatsClient, so it can be
+used by eom.metrics in its place. Dotted statsd names are turned into
+Prometheus metric names, counters become counters suffixed with
+_total, gauges become per-process gauges and timings become histograms
+in seconds. Since statsd names carry no labels, the parts of the name
+that would be labels, such as the route or status class, are kept in
+the metric name.
+"""
+
+import atexit
+import contextlib
+import errno
+import fcntl
+import mmap
+import os
+import random
+import re
+import struct
+import threading
+import weakref
+
+import six
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# NOTE: In seconds, as recommended for Prometheus.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, float('inf'))
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_INITIAL_SIZE = 1024 * 16
+_HEADER = struct.Struct('i4x')
+_KEY_LENGTH = struct.Struct('i')
+_VALUE = struct.Struct('d')
+
+_INVALID_NAME_CHARS = re.compile('[^a-zA-Z0-9_:]+')
+
+ARCHIVE = 'archive'
+_LOCK_FILE = '.lock'
+
+# NOTE: Archived at exit, held weakly so that they are not kept alive
+# for it.
+_CLIENTS = weakref.WeakSet()
+
+
+def metric_name(stat):
+    """Converts a statsd-style name to a valid Prometheus name."""
+    name = _INVALID_NAME_CHARS.sub('_', stat).strip('_')
+    if not name or name[0].isdigit():
+        name = '_' + name
+    return name
+
+
+def counter_name(stat):
+    """Converts a statsd-style name to a Prometheus counter name."""
+    name = metric_name(stat)
+    if not name.endswith('_total'):
+        name += '_total'
+    return name
+
+
+def _sampled(rate):
+    """Samples an update made at a rate, as statsd clients do.
+
+    :returns: the weight of the update, or 0 if it is dropped
+    """
+    if rate >= 1:
+        return 1
+    if random.random() > rate:
+        return 0
+    return 1.0 / rate
+
+
+def _format_float(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class MmapedFile(object):
+
+    """A file of float values keyed by string, memory-mapped."""
+
+    def __init__(self, path):
+        self._path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self._fd).st_size
+        if size == 0:
+            size = _INITIAL_SIZE
+            os.ftruncate(self._fd, size)
+
+        self._capacity = size
+        self._map = mmap.mmap(self._fd, size)
+        self._used = _HEADER.unpack_from(self._map, 0)[0]
+        if self._used == 0:
+            self._used = _HEADER.size
+            _HEADER.pack_into(self._map, 0, self._used)
+
+        self._positions = {}
+        for key, value, position in _read_entries(self._map, self._used):
+            self._positions[key] = position
+
+    def add(self, key, amount):
+        position = self._position(key)
+        value = _VALUE.unpack_from(self._map, position)[0]
+        _VALUE.pack_into(self._map, position, value + amount)
+
+    def set(self, key, value):
+        _VALUE.pack_into(self._map, self._position(key), value)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    def _position(self, key):
+        try:
+            return self._positions[key]
+        except KeyError:
+            return self._append(key)
+
+    def _append(self, key):
+        encoded = key.encode('utf-8')
+        padded = len(encoded) + (-(_KEY_LENGTH.size + len(encoded)) % 8)
+        entry_size = _KEY_LENGTH.size + padded + _VALUE.size
+
+        while self._used + entry_size > self._capacity:
+            self._capacity *= 2
+            os.ftruncate(self._fd, self._capacity)
+            self._map.close()
+            self._map = mmap.mmap(self._fd, self._capacity)
+
+        offset = self._used
+        _KEY_LENGTH.pack_into(self._map, offset, len(encoded))
+        offset += _KEY_LENGTH.size
+        self._map[offset:offset + len(encoded)] = encoded
+        offset += padded
+        _VALUE.pack_into(self._map, offset, 0.0)
+
+        # NOTE: Publish the new size last, so that a concurrent reader
+        # never sees a partially written entry.
+        self._used += entry_size
+        _HEADER.pack_into(self._map, 0, self._used)
+
+        self._positions[key] = offset
+        return offset
+
+
+def _read_entries(data, used):
+    offset = _HEADER.size
+    while offset < used:
+        length = _KEY_LENGTH.unpack_from(data, offset)[0]
+        offset += _KEY_LENGTH.size
+        key = bytes(data[offset:offset + length]).decode('utf-8')
+        offset += length + (-(_KEY_LENGTH.size + length) % 8)
+        value = _VALUE.unpack_from(data, offset)[0]
+        yield key, value, offset
+        offset += _VALUE.size
+
+
+def read_file(path):
+    """Reads the entries of a metrics file.
+
+    :returns: a list of (key, value) tuples
+    """
+    with open(path, 'rb') as fd:
+        data = fd.read()
+
+    if len(data) < _HEADER.size:
+        return []
+
+    used = _HEADER.unpack_from(data, 0)[0]
+    return [(key, value) for key, value, position
+            in _read_entries(data, used)]
+
+
+class Client(object):
+
+    """Records metrics to this process's files in a shared directory."""
+
+    def __init__(self, directory, buckets=DEFAULT_BUCKETS):
+        """Initializes the client.
+
+        Files are opened lazily, on the first update made by each
+        process, so a client created before a fork is safe to use in
+        the children.
+
+        :param str directory: directory shared by all workers of a host
+        :param buckets: upper bounds of the histogram buckets, in
+            seconds; infinity is added when missing
+        """
+        buckets = sorted(buckets)
+        if not buckets or buckets[-1] != float('inf'):
+            buckets.append(float('inf'))
+
+        self._directory = directory
+        self._buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._files = {}
+        self._histograms = set()
+
+        _CLIENTS.add(self)
+
+    def incr(self, stat, count=1, rate=1):
+        # NOTE: Sampled updates stand for 1 / rate of them, as they do
+        # for a statsd server.
+        weight = _sampled(rate)
+        if weight:
+            self._update(COUNTER, counter_name(stat), count * weight,
+                         add=True)
+
+    def decr(self, stat, count=1, rate=1):
+        # NOTE: Prometheus counters never go down; a decrement can only
+        # be used to balance an increment, so it is simply ignored.
+        pass
+
+    def gauge(self, stat, value, rate=1, delta=False):
+        self._update(GAUGE, metric_name(stat), value, add=delta)
+
+    def timing(self, stat, delta, rate=1):
+        weight = _sampled(rate)
+        if weight:
+            self.observe(metric_name(stat) + '_seconds', delta / 1000.0,
+                         weight)
+
+    def histogram(self, stat, value):
+        self.timing(stat, value)
+
+    def observe(self, name, value, weight=1):
+        """Records a value in the histogram with the given name.
+
+        :param weight: number of samples the value stands for
+        """
+        for bound in self._buckets:
+            if value <= bound:
+                break
+
+        with self._lock:
+            histogram = self._file(HISTOGRAM)
+            if name not in self._histograms:
+                # NOTE: Every bucket is written once, so that every
+                # bound is exposed, even those no sample fell under.
+                for other in self._buckets:
+                    histogram.add(_bucket_key(name, other), 0)
+                self._histograms.add(name)
+
+            histogram.add(_bucket_key(name, bound), weight)
+            histogram.add(name + '_sum', value * weight)
+            histogram.add(name + '_count', weight)
+
+    def archive(self):
+        """Archives the metrics of this process, which is exiting.
+
+        Does nothing in a process that recorded nothing.
+        """
+        with self._lock:
+            if self._pid != os.getpid() or not self._files:
+                return
+
+            for metrics_file in self._files.values():
+                metrics_file.close()
+            self._files = {}
+            self._histograms = set()
+
+            mark_process_dead(self._directory, self._pid)
+
+    def _update(self, kind, name, value, add):
+        with self._lock:
+            if add:
+                self._file(kind).add(name, value)
+            else:
+                self._file(kind).set(name, value)
+
+    def _file(self, kind):
+        pid = os.getpid()
+        if pid != self._pid:
+            # NOTE: After a fork the inherited files belong to the
+            # parent; drop them without writing anything.
+            self._files = {}
+            self._histograms = set()
+            self._pid = pid
+
+        try:
+            return self._files[kind]
+        except KeyError:
+            self._files[kind] = MmapedFile(_path(self._directory, kind, pid))
+            return self._files[kind]
+
+
+def _archive_all():
+    for client in list(_CLIENTS):
+        try:
+            client.archive()
+        except Exception:
+            # NOTE: Left to collect(), once this process is gone.
+            pass
+
+
+atexit.register(_archive_all)
+
+
+def _bucket_key(name, bound):
+    return '{0}_bucket\x00{1}'.format(name, _format_float(bound))
+
+
+def _path(directory, kind, pid):
+    return os.path.join(directory, '{0}_{1}.db'.format(kind, pid))
+
+
+@contextlib.contextmanager
+def _locked(directory):
+    """Holds the lock of a directory, shared by every process."""
+    fd = os.open(os.path.join(directory, _LOCK_FILE),
+                 os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # NOTE: Closing the file releases the lock.
+        os.close(fd)
+
+
+def _is_alive(pid):
+    try:
+        os.kill(int(pid), 0)
+    except ValueError:
+        return False
+    except OSError as ex:
+        return ex.errno == errno.EPERM
+    return True
+
+
+def _archive(directory, pid):
+    for kind in (COUNTER, HISTOGRAM):
+        path = _path(directory, kind, pid)
+        if not os.path.exists(path):
+            continue
+
+        samples = read_file(path)
+        if samples:
+            archive = MmapedFile(_path(directory, kind, ARCHIVE))
+            try:
+                for key, value in samples:
+                    archive.add(key, value)
+            finally:
+                archive.close()
+        os.remove(path)
+
+    path = _path(directory, GAUGE, pid)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def mark_process_dead(directory, pid):
+    """Archives the metrics of a process that is gone.
+
+    Its counters and histograms are added to the archive files, which
+    keep being reported, and its files are removed; its gauges are
+    dropped. Meant for process managers that know when a worker died,
+    e.g. from the child_exit hook of gunicorn, since collect() only
+    notices once the pid no longer exists.
+
+    :param str directory: directory shared by all workers of a host
+    :param pid: pid of the process
+    """
+    with _locked(directory):
+        _archive(directory, pid)
+
+
+def _list_files(directory):
+    """Lists the metric files of a directory, archiving dead processes.
+
+    :returns: a list of (kind, pid, path) tuples
+    """
+    files = []
+    archived = False
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.db'):
+            continue
+
+        kind, _, pid = filename[:-len('.db')].partition('_')
+        if pid != ARCHIVE and not _is_alive(pid):
+            _archive(directory, pid)
+            archived = True
+            continue
+
+        files.append((kind, pid, os.path.join(directory, filename)))
+
+    if archived:
+        return _list_files(directory)
+    return files
+
+
+def collect(directory):
+    """Merges the metric files of every process in a directory.
+
+    The metrics of processes that no longer exist are archived first.
+
+    :returns: the metrics in the Prometheus text exposition format
+    """
+    counters = {}
+    gauges = {}
+    histograms = {}
+
+    # NOTE: Locked so that no metric is counted both in the files of a
+    # process and in the archive while it is being archived.
+    with _locked(directory):
+        for kind, pid, path in _list_files(directory):
+            for key, value in read_file(path):
+                if kind == COUNTER:
+                    counters[key] = counters.get(key, 0.0) + value
+                elif kind == GAUGE:
+                    gauges.setdefault(key, []).append((pid, value))
+                elif kind == HISTOGRAM:
+                    histograms[key] = histograms.get(key, 0.0) + value
+
+    lines = []
+    for name in sorted(counters):
+        lines.append('# TYPE {0} counter'.format(name))
+        lines.append('{0} {1}'.format(name, _format_float(counters[name])))
+
+    for name in sorted(gauges):
+        lines.append('# TYPE {0} gauge'.format(name))
+        for pid, value in gauges[name]:
+            lines.append('{0}{{pid="{1}"}} {2}'.format(
+                name, pid, _format_float(value)))
+
+    lines.extend(_render_histograms(histograms))
+
+    return '\n'.join(lines) + '\n'
+
+
+def _render_histograms(samples):
+    families = {}
+    for key, value in samples.items():
+        if '\x00' in key:
+            name, bound = key.split('\x00')
+            name = name[:-len('_bucket')]
+            families.setdefault(name, {}).setdefault(
+                'buckets', {})[float(bound)] = value
+        elif key.endswith('_sum'):
+            families.setdefault(key[:-len('_sum')], {})['sum'] = value
+        elif key.endswith('_count'):
+            families.setdefault(key[:-len('_count')], {})['count'] = value
+
+    lines = []
+    for name in sorted(families):
+        family = families[name]
+        lines.append('# TYPE {0} histogram'.format(name))
+
+        # NOTE: Buckets are stored as plain counts and made
+        # cumulative here, as the exposition format requires. The
+        # +Inf bucket always holds every sample.
+        cumulative = 0.0
+        count = family.get('count', 0.0)
+        buckets = family.get('buckets', {})
+        for bound in sorted(buckets):
+            if bound == float('inf'):
+                continue
+            cumulative += buckets[bound]
+            lines.append('{0}_bucket{{le="{1}"}} {2}'.format(
+                name, _format_float(bound), _format_float(cumulative)))
+
+        lines.append('{0}_bucket{{le="+Inf"}} {1}'.format(
+            name, _format_float(count)))
+        lines.append('{0}_sum {1}'.format(
+            name, _format_float(family.get('sum', 0.0))))
+        lines.append('{0}_count {1}'.format(name, _format_float(count)))
+
+    return lines
+
+
+def exposition_app(directory):
+    """Creates a WSGI app that serves the metrics of a directory.
+
+    The app answers every request, so it is meant to be mounted on a
+    dedicated route, e.g. as the backdoor of eom.bastion for an
+    unrestricted /metrics route.
+
+    :param str directory: directory shared by all workers of a host
+    :returns: a WSGI app
+    """
+
+    # WSGI callable
+    def app(env, start_response):
+        body = collect(directory)
+        if isinstance(body, six.text_type):
+            body = body.encode('utf-8')
+
+        start_response('200 OK', [('Content-Type', CONTENT_TYPE),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+    return app
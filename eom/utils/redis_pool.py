@@ -13,8 +13,63 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+"""redis_pool: shared Redis connection pools.
+
+Pools are kept in a registry keyed by the name of the config group
+they are built from, so every client created for a group shares the
+same pool and the number of connections per process stays bounded.
+
+The pool options below can be registered on any group holding Redis
+settings, e.g.:
+
+    [eom:redis]
+    host = 127.0.0.1
+    port = 6379
+    max_connections = 50
+    blocking = True
+    blocking_timeout = 0.5
+    socket_timeout = 0.25
+    socket_connect_timeout = 0.25
+    socket_keepalive = True
+    health_check_interval = 30
+
+Options left unset are not passed to redis-py, so its defaults apply.
+
+When report_metrics is set, the pool and its clients report through
+the eom.metrics client, under <prefix>.redis.<name>, where the name is
+"auth" for eom:auth_redis and "governor" for eom:redis:
+
+- pool.wait: time spent getting a connection from the pool, in ms
+- pool.in_use and pool.idle: gauges of the pool's connections
+- connections.created: connections made by the pool
+- connections.closed: sockets closed, on errors or disconnects
+- command.<name>: latency of each command, e.g. command.get, in ms
+
+Commands queued on a pipeline are not timed individually.
+
+ReplicatedClient spreads the reads of a client over replicas of its
+server, each given its own pool with get_pool(node=...).
+
+Setting cluster connects to a Redis Cluster instead, discovered from
+the startup_nodes (by default host:port); the pool options then apply
+to the pool of each node, but no metrics are reported.
+"""
+
+import random
+import threading
+import timeit
+
 from oslo_config import cfg
 import redis
+from redis import connection
+
+try:
+    from redis import cluster as redis_cluster
+except ImportError:  # pragma: no cover
+    redis_cluster = None
+
+from eom import metrics
+from eom.utils import fork
 
 _CONF = cfg.CONF
 
@@ -24,10 +79,487 @@ OPTIONS = [
     cfg.StrOpt('port'),
 ]
 
+POOL_OPTIONS = [
+    cfg.IntOpt(
+        'max_connections',
+        help='Maximum number of connections kept by the pool.'
+    ),
+    cfg.BoolOpt(
+        'blocking',
+        default=False,
+        help=(
+            'Wait for a connection to be released when max_connections '
+            'is reached, instead of failing right away.'
+        )
+    ),
+    cfg.FloatOpt(
+        'blocking_timeout',
+        default=20,
+        help=(
+            'Seconds to wait for a connection when blocking is set, '
+            'after which redis.ConnectionError is raised.'
+        )
+    ),
+    cfg.StrOpt(
+        'unix_socket_path',
+        help='Path of a unix socket to connect to, instead of host:port.'
+    ),
+    cfg.FloatOpt(
+        'socket_timeout',
+        help='Seconds to wait for the reply to a command.'
+    ),
+    cfg.FloatOpt(
+        'socket_connect_timeout',
+        help='Seconds to wait for a connection to be established.'
+    ),
+    cfg.BoolOpt(
+        'socket_keepalive',
+        help='Enable TCP keepalive on the connections.'
+    ),
+    cfg.IntOpt(
+        'health_check_interval',
+        help=(
+            'Seconds a connection may stay idle before it is checked with '
+            'a PING when next used. Requires redis-py 3.3 or later.'
+        )
+    ),
+    cfg.BoolOpt(
+        'report_metrics',
+        default=False,
+        help=(
+            'Report pool usage and command latency through the '
+            'eom:metrics client. Requires eom.metrics to be configured.'
+        )
+    ),
+    cfg.BoolOpt(
+        'cluster',
+        default=False,
+        help=(
+            'Connect to a Redis Cluster rather than a single server. '
+            'Requires redis-py 4.1 or later.'
+        )
+    ),
+    cfg.ListOpt(
+        'startup_nodes',
+        default=[],
+        help=(
+            'host:port of the nodes used to discover a Redis Cluster; '
+            'defaults to host and port.'
+        )
+    ),
+]
+
 _CONF.register_opts(OPTIONS, group=REDIS_GROUP_NAME)
+_CONF.register_opts(POOL_OPTIONS, group=REDIS_GROUP_NAME)
 
+_POOLS = {}
+_CLUSTERS = {}
+_POOLS_LOCK = threading.Lock()
+
+# NOTE: Names under which the pool of each group reports metrics;
+# other groups use the last part of their name.
+_STATS_NAMES = {
+    REDIS_GROUP_NAME: 'governor',
+    'eom:auth_redis': 'auth',
+}
+
+_timer = timeit.default_timer
+
+DEFAULT_LATENCY_DECAY = 0.1
+DEFAULT_EXPLORATION = 0.05
+
+# NOTE: In seconds; the latency recorded for a replica that failed.
+FAILURE_LATENCY = 1.0
+
+
+class _StatsConnectionMixin(object):
+
+    """Counts the sockets closed by a connection."""
+
+    stats_client = None
+    stats_prefix = ''
+
+    def disconnect(self, *args, **kwargs):
+        closing = getattr(self, '_sock', None) is not None
+        super(_StatsConnectionMixin, self).disconnect(*args, **kwargs)
+        if closing:
+            self.stats_client.incr(self.stats_prefix + 'connections.closed')
+
+
+class _StatsPoolMixin(object):
+
+    """Reports the usage of a connection pool."""
+
+    def __init__(self, stats_client, stats_prefix, **kwargs):
+        self.stats_client = stats_client
+        self.stats_prefix = stats_prefix
+
+        # NOTE: Connections are created by the pool from a class and
+        # keyword arguments, so the stats go on a subclass, made with
+        # the metaclass of the connection class (ABCMeta in redis-py 4+).
+        connection_class = kwargs.get('connection_class',
+                                      connection.Connection)
+        kwargs['connection_class'] = type(connection_class)(
+            'Stats' + connection_class.__name__,
+            (_StatsConnectionMixin, connection_class),
+            {'stats_client': stats_client, 'stats_prefix': stats_prefix})
+
+        super(_StatsPoolMixin, self).__init__(**kwargs)
+
+    def get_connection(self, *args, **kwargs):
+        start = _timer()
+        conn = super(_StatsPoolMixin, self).get_connection(*args, **kwargs)
+        self.stats_client.timing(self.stats_prefix + 'pool.wait',
+                                 (_timer() - start) * 1000)
+        self._report_usage()
+        return conn
+
+    def release(self, connection):
+        super(_StatsPoolMixin, self).release(connection)
+        self._report_usage()
+
+    def make_connection(self):
+        conn = super(_StatsPoolMixin, self).make_connection()
+        self.stats_client.incr(self.stats_prefix + 'connections.created')
+        return conn
+
+    def _report_usage(self):
+        idle, in_use = self._usage()
+        self.stats_client.gauge(self.stats_prefix + 'pool.idle', idle)
+        self.stats_client.gauge(self.stats_prefix + 'pool.in_use', in_use)
+
+
+class StatsConnectionPool(_StatsPoolMixin, redis.ConnectionPool):
+
+    """redis.ConnectionPool reporting its usage."""
+
+    def _usage(self):
+        return (len(self._available_connections),
+                len(self._in_use_connections))
+
+
+class StatsBlockingConnectionPool(_StatsPoolMixin,
+                                  redis.BlockingConnectionPool):
+
+    """redis.BlockingConnectionPool reporting its usage."""
+
+    def _usage(self):
+        # NOTE: The queue is filled with None placeholders for the
+        # connections that have not been made yet.
+        idle = sum(1 for conn in list(self.pool.queue) if conn is not None)
+        return idle, len(self._connections) - idle
+
+
+class StatsRedis(redis.Redis):
+
+    """redis.Redis reporting the latency of every command."""
+
+    def execute_command(self, *args, **options):
+        start = _timer()
+        try:
+            return super(StatsRedis, self).execute_command(*args, **options)
+        finally:
+            pool = self.connection_pool
+            name = str(args[0]).lower().replace(' ', '_')
+            pool.stats_client.timing(pool.stats_prefix + 'command.' + name,
+                                     (_timer() - start) * 1000)
+
+
+class ReplicatedClient(object):
+
+    """Reads from the fastest of a set of replicas.
+
+    GET is sent to a replica picked by the latency of its recent
+    replies, out of two drawn at random, and is retried on the primary
+    when the replica fails or misses the key, since the key may not
+    have been replicated yet. Every other command goes to the primary.
+    """
+
+    def __init__(self, primary, replicas, decay=DEFAULT_LATENCY_DECAY,
+                 exploration=DEFAULT_EXPLORATION):
+        """Initializes the client.
+
+        :param primary: redis.Redis connected to the primary
+        :param replicas: list of redis.Redis connected to the replicas
+        :param float decay: weight of each new latency sample in the
+            moving average of a replica, between 0 and 1
+        :param float exploration: fraction of the reads sent to a
+            random replica, so slow replicas get a chance to recover
+        """
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.latencies = [0.0] * len(self.replicas)
+        self._decay = decay
+        self._exploration = exploration
+
+    def __getattr__(self, name):
+        return getattr(self.primary, name)
+
+    def get(self, name):
+        """Gets a key, from the primary if the replica misses it."""
+        value = self.get_from_replica(name)
+        if value is None:
+            value = self.primary.get(name)
+        return value
+
+    def get_from_replica(self, name):
+        """Gets a key from a replica, which may miss recent writes.
+
+        The primary is only used if the replica fails.
+        """
+        index = self._choose()
+        start = _timer()
+        try:
+            value = self.replicas[index].get(name)
+        except redis.RedisError:
+            # NOTE: Counts as a slow reply, so the replica is avoided
+            # until exploration finds it healthy again.
+            self._observe(index, FAILURE_LATENCY)
+            return self.primary.get(name)
+
+        self._observe(index, _timer() - start)
+        return value
+
+    def _choose(self):
+        count = len(self.replicas)
+        if count == 1:
+            return 0
+
+        first = random.randrange(count)
+        second = random.randrange(count - 1)
+        if second >= first:
+            second += 1
+
+        if random.random() < self._exploration:
+            return first
+
+        if self.latencies[second] < self.latencies[first]:
+            return second
+        return first
+
+    def _observe(self, index, latency):
+        # NOTE: Unlocked; a lost update only skews the average a bit.
+        average = self.latencies[index]
+        self.latencies[index] = average + self._decay * (latency - average)
+
+
+def register_pool_options(config, group_name):
+    """Registers the pool options on a config group.
+
+    :raises ImportError: if the installed redis-py lacks a feature the
+        group enables; see check_pool_options()
+    """
+    config.register_opts(POOL_OPTIONS, group=group_name)
+    check_pool_options(config, group_name)
+
+
+def check_pool_options(config, group_name):
+    """Checks that the installed redis-py supports the pool options.
+
+    :raises ImportError: if health_check_interval is set with
+        redis-py < 3.3, or cluster with redis-py < 4.1
+    """
+    group = config[group_name]
+
+    # NOTE: Older versions reject the argument only when the first
+    # connection is made, far from the configuration at fault.
+    if (group['health_check_interval'] is not None and
+            not hasattr(connection.Connection, 'check_health')):
+        raise ImportError('{0}: health_check_interval requires redis-py '
+                          '3.3 or later.'.format(group_name))
+
+    if group['cluster'] and redis_cluster is None:
+        raise ImportError('{0}: cluster requires redis-py 4.1 or '
+                          'later.'.format(group_name))
+
+
+def _pool_kwargs(group):
+    kwargs = {}
+
+    if group['unix_socket_path']:
+        kwargs['path'] = group['unix_socket_path']
+        kwargs['connection_class'] = connection.UnixDomainSocketConnection
+    else:
+        kwargs['host'] = group['host']
+        kwargs['port'] = group['port']
+
+    for name in ('max_connections', 'socket_timeout',
+                 'socket_connect_timeout', 'socket_keepalive',
+                 'health_check_interval'):
+        if group[name] is not None:
+            kwargs[name] = group[name]
+
+    if group['blocking']:
+        kwargs['timeout'] = group['blocking_timeout']
+
+    return kwargs
+
+
+def _parse_node(node):
+    host, _, port = node.strip().rpartition(':')
+    return host, int(port)
+
+
+def get_pool(group_name=REDIS_GROUP_NAME, config=None, node=None,
+             **kwargs):
+    """Gets the shared connection pool for a config group.
+
+    The pool is created on the first call for the group; later calls
+    return the same pool and ignore their extra arguments. Use
+    make_client() to get a client of the pool.
+
+    :param str group_name: config group holding host, port and the
+        pool options
+    :param config: oslo.config object holding the group, by default
+        oslo.config.cfg.CONF
+    :param str node: host:port of another server, e.g. a replica,
+        to connect to with the options of the group; it gets a pool
+        of its own
+    :param kwargs: extra arguments for the pool, e.g. db or password,
+        which take precedence over the ones built from the group
+    :returns: a redis.ConnectionPool, or a redis.BlockingConnectionPool
+        when the blocking option is set; one that reports its usage
+        when the report_metrics option is set
+    """
+    key = (group_name, node)
+
+    fork.postfork()
+    try:
+        return _POOLS[key]
+    except KeyError:
+        pass
+
+    config = config or _CONF
+    check_pool_options(config, group_name)
+    group = config[group_name]
+
+    with _POOLS_LOCK:
+        if key not in _POOLS:
+            pool_kwargs = _pool_kwargs(group)
+            if node is not None:
+                pool_kwargs.pop('path', None)
+                pool_kwargs.pop('connection_class', None)
+                pool_kwargs['host'], pool_kwargs['port'] = _parse_node(node)
+            pool_kwargs.update(kwargs)
+
+            if group['report_metrics']:
+                if group['blocking']:
+                    pool_class = StatsBlockingConnectionPool
+                else:
+                    pool_class = StatsConnectionPool
+
+                stats_name = _STATS_NAMES.get(group_name,
+                                              group_name.split(':')[-1])
+                pool_kwargs['stats_client'] = metrics.get_client()
+                pool_kwargs['stats_prefix'] = '{0}.redis.{1}.'.format(
+                    metrics.stat_prefix(), stats_name)
+
+            elif group['blocking']:
+                pool_class = redis.BlockingConnectionPool
+            else:
+                pool_class = redis.ConnectionPool
+
+            _POOLS[key] = pool_class(**pool_kwargs)
+
+        return _POOLS[key]
+
+
+def make_client(pool):
+    """Creates a client of a pool returned by get_pool().
+
+    :returns: a redis.Redis, timing its commands if the pool reports
+        its usage
+    """
+    if isinstance(pool, _StatsPoolMixin):
+        return StatsRedis(connection_pool=pool)
 
-def get_client():
-    group = _CONF[REDIS_GROUP_NAME]
-    pool = redis.ConnectionPool(host=group['host'], port=group['port'], db=0)
     return redis.Redis(connection_pool=pool)
+
+
+def _startup_nodes(group):
+    nodes = group['startup_nodes'] or [
+        '{0}:{1}'.format(group['host'], group['port'])]
+
+    return [redis_cluster.ClusterNode(*_parse_node(node)) for node in nodes]
+
+
+def get_cluster_client(group_name=REDIS_GROUP_NAME, config=None, **kwargs):
+    """Gets the shared Redis Cluster client for a config group.
+
+    Like get_pool(), the client is created on the first call for the
+    group and later calls ignore their extra arguments.
+
+    :param str group_name: config group holding the startup_nodes and
+        the pool options
+    :param config: oslo.config object holding the group, by default
+        oslo.config.cfg.CONF
+    :param kwargs: extra arguments for the client, e.g. password
+    :returns: a redis.cluster.RedisCluster
+    """
+    if redis_cluster is None:
+        raise ImportError('Redis Cluster support requires redis-py 4.1 '
+                          'or later.')
+
+    fork.postfork()
+    try:
+        return _CLUSTERS[group_name]
+    except KeyError:
+        pass
+
+    config = config or _CONF
+    check_pool_options(config, group_name)
+    group = config[group_name]
+
+    with _POOLS_LOCK:
+        if group_name not in _CLUSTERS:
+            client_kwargs = _pool_kwargs(group)
+            for name in ('host', 'port', 'path', 'connection_class',
+                         'timeout'):
+                client_kwargs.pop(name, None)
+            client_kwargs.update(kwargs)
+
+            _CLUSTERS[group_name] = redis_cluster.RedisCluster(
+                startup_nodes=_startup_nodes(group), **client_kwargs)
+
+        return _CLUSTERS[group_name]
+
+
+def reset():
+    """Disconnects and forgets every pool in the registry."""
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+        _POOLS.clear()
+        clusters = list(_CLUSTERS.values())
+        _CLUSTERS.clear()
+
+    for pool in pools:
+        pool.disconnect()
+
+    for client in clusters:
+        client.disconnect_connection_pools()
+
+
+def _after_fork():
+    global _POOLS_LOCK
+
+    # NOTE: The connections belong to the parent; they are dropped
+    # without being closed, which would shut them down for the parent
+    # too. The pools themselves are kept, since clients hold on to them.
+    _POOLS_LOCK = threading.Lock()
+    for pool in list(_POOLS.values()):
+        pool.reset()
+
+    for client in list(_CLUSTERS.values()):
+        for node in client.get_nodes():
+            if node.redis_connection is not None:
+                node.redis_connection.connection_pool.reset()
+
+
+fork.register(_after_fork)
+
+
+def get_client():
+    if _CONF[REDIS_GROUP_NAME]['cluster']:
+        return get_cluster_client(REDIS_GROUP_NAME)
+
+    return make_client(get_pool(REDIS_GROUP_NAME, db=0))
@@ -0,0 +1,294 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""stats: in-process aggregation of statsd metrics.
+
+The Aggregator exposes the same interface as statsd.StatsClient
+(incr, decr, timing, gauge), but instead of sending a UDP packet for
+every call it accumulates the values in memory and periodically
+flushes them through a statsd pipeline, which packs many metrics into
+each packet.
+
+Flushing is done either from a daemon thread or, when running under
+uwsgi, from a uwsgi timer signal.
+
+Values recorded with histogram() are kept in a local LogHistogram per
+stat and only their percentiles are sent, as gauges, on every flush.
+"""
+
+import atexit
+import random
+import threading
+import weakref
+
+from eom.utils import fork
+from eom.utils import histogram as hist
+from eom.utils import log as logging
+
+LOG = logging.getLogger(__name__)
+
+FLUSH_MODE_THREAD = 'thread'
+FLUSH_MODE_UWSGI = 'uwsgi'
+FLUSH_MODES = (FLUSH_MODE_THREAD, FLUSH_MODE_UWSGI)
+
+DEFAULT_PERCENTILES = (50, 90, 99)
+
+# NOTE: Flushed at exit, held weakly so that they are not kept alive
+# for it.
+_AGGREGATORS = weakref.WeakSet()
+
+
+def _send_timing(pipe, stat, delta, rate):
+    """Sends a timing sample that was already sampled."""
+    if rate >= 1:
+        pipe.timing(stat, delta)
+        return
+
+    # NOTE: The statsd client samples every timing it sends; this one
+    # was kept already, so only its rate is reported.
+    pipe._send_stat(stat, '{0:0.6f}|ms|@{1}'.format(delta, rate), 1)
+
+
+class NullClient(object):
+
+    """Metrics client that discards everything."""
+
+    def incr(self, stat, count=1, rate=1):
+        pass
+
+    def decr(self, stat, count=1, rate=1):
+        pass
+
+    def timing(self, stat, delta, rate=1):
+        pass
+
+    def gauge(self, stat, value, rate=1, delta=False):
+        pass
+
+    def histogram(self, stat, value):
+        pass
+
+
+class Aggregator(object):
+
+    """Accumulates statsd metrics and flushes them in batches."""
+
+    def __init__(self, client, flush_interval=1.0,
+                 flush_mode=FLUSH_MODE_THREAD, uwsgi_signal=None,
+                 percentiles=DEFAULT_PERCENTILES,
+                 relative_accuracy=hist.DEFAULT_RELATIVE_ACCURACY):
+        """Initializes the aggregator.
+
+        :param client: statsd.StatsClient used to send the batches
+        :param float flush_interval: seconds between flushes
+        :param str flush_mode: either 'thread' or 'uwsgi'
+        :param int uwsgi_signal: uwsgi signal number used for the
+            flush timer when flush_mode is 'uwsgi'
+        :param percentiles: percentiles, between 0 and 100, reported
+            for each histogram
+        :param float relative_accuracy: relative error of the
+            histogram percentiles
+        """
+        if flush_mode not in FLUSH_MODES:
+            raise ValueError('Unknown flush mode: {0}'.format(flush_mode))
+
+        self._client = client
+        self._flush_interval = flush_interval
+        self._flush_mode = flush_mode
+        self._uwsgi_signal = uwsgi_signal
+
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timers = {}
+        self._gauges = {}
+        self._histograms = {}
+
+        self._percentiles = [(hist.percentile_name(p), float(p) / 100)
+                             for p in percentiles]
+        self._relative_accuracy = relative_accuracy
+
+        self._flusher = None
+        self._stop = threading.Event()
+
+        if flush_mode == FLUSH_MODE_UWSGI:
+            self._register_uwsgi_timer()
+
+        _AGGREGATORS.add(self)
+        fork.register(self._after_fork)
+
+    def incr(self, stat, count=1, rate=1):
+        """Increments a counter."""
+        if rate < 1:
+            if random.random() > rate:
+                return
+            count = count / float(rate)
+
+        self._ensure_flusher()
+        with self._lock:
+            self._counters[stat] = self._counters.get(stat, 0) + count
+
+    def decr(self, stat, count=1, rate=1):
+        """Decrements a counter."""
+        self.incr(stat, -count, rate)
+
+    def timing(self, stat, delta, rate=1):
+        """Records a timing sample, in milliseconds.
+
+        Samples are kept according to `rate`, which is reported along
+        with them on flush.
+        """
+        if rate < 1 and random.random() > rate:
+            return
+
+        self._ensure_flusher()
+        with self._lock:
+            try:
+                self._timers[stat].append((delta, rate))
+            except KeyError:
+                self._timers[stat] = [(delta, rate)]
+
+    def gauge(self, stat, value, rate=1, delta=False):
+        """Sets a gauge, or adjusts it when delta is True."""
+        self._ensure_flusher()
+        with self._lock:
+            if delta:
+                value += self._gauges.get(stat, 0)
+            self._gauges[stat] = value
+
+    def histogram(self, stat, value):
+        """Counts a value in the local histogram for a stat.
+
+        On flush, the percentiles and the maximum of the values
+        recorded since the previous flush are sent as gauges named
+        <stat>.p50, <stat>.p99, <stat>.max and so on.
+        """
+        self._ensure_flusher()
+        with self._lock:
+            try:
+                self._histograms[stat].add(value)
+            except KeyError:
+                histogram = hist.LogHistogram(self._relative_accuracy)
+                histogram.add(value)
+                self._histograms[stat] = histogram
+
+    def flush(self):
+        """Sends everything accumulated so far as batched packets."""
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            timers, self._timers = self._timers, {}
+            gauges, self._gauges = self._gauges, {}
+            histograms, self._histograms = self._histograms, {}
+
+        for stat, histogram in histograms.items():
+            for name, q in self._percentiles:
+                gauges[stat + '.' + name] = histogram.quantile(q)
+            gauges[stat + '.max'] = histogram.max
+
+        if not (counters or timers or gauges):
+            return
+
+        try:
+            with self._client.pipeline() as pipe:
+                # NOTE: Zero-valued counters are still sent so that
+                # buckets get initialized on the statsd side.
+                for stat, count in counters.items():
+                    pipe.incr(stat, count)
+
+                for stat, samples in timers.items():
+                    for delta, rate in samples:
+                        _send_timing(pipe, stat, delta, rate)
+
+                for stat, value in gauges.items():
+                    pipe.gauge(stat, value)
+
+        except Exception as ex:
+            LOG.warn('Failed to flush metrics: {0}'.format(ex))
+
+    def stop(self):
+        """Stops the flusher thread, if any, and flushes.
+
+        No flusher thread is started again afterwards; what is recorded
+        from then on is only sent by explicit flushes.
+        """
+        self._stop.set()
+        self.flush()
+
+    def _after_fork(self):
+        # NOTE: The lock may have been held by the parent's flusher
+        # at the time of the fork, and the values accumulated so far
+        # are the parent's to send.
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timers = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._flusher = None
+
+    def _ensure_flusher(self):
+        # NOTE: The thread is started lazily so that it is created in
+        # the process that records metrics rather than in a parent
+        # that may fork afterwards (threads do not survive a fork).
+        if self._flush_mode != FLUSH_MODE_THREAD or self._stop.is_set():
+            return
+
+        flusher = self._flusher
+        if flusher is not None and flusher.is_alive():
+            return
+
+        # NOTE: A flusher that is not alive anymore is the first sign
+        # of a fork, so the inherited state, lock included, is reset
+        # before it is used.
+        if flusher is not None:
+            fork.postfork()
+
+        with self._lock:
+            if self._stop.is_set():
+                return
+
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+
+            self._flusher = threading.Thread(target=self._run,
+                                             name='eom-stats-flusher')
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def _run(self):
+        while not self._stop.wait(self._flush_interval):
+            self.flush()
+
+    def _register_uwsgi_timer(self):
+        try:
+            import uwsgi
+        except ImportError:
+            raise ImportError('The uwsgi flush mode requires a uwsgi '
+                              'server process.')
+
+        def _flush(signum):
+            self.flush()
+
+        # NOTE: Target every worker, since each one has its own
+        # aggregator to flush.
+        uwsgi.register_signal(self._uwsgi_signal, 'workers', _flush)
+        uwsgi.add_timer(self._uwsgi_signal,
+                        max(1, int(self._flush_interval)))
+
+
+def _flush_all():
+    for aggregator in list(_AGGREGATORS):
+        aggregator.flush()
+
+
+atexit.register(_flush_all)
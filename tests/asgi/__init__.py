@@ -0,0 +1,25 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import unittest
+
+# NOTE: Checked before importing the helpers, which older interpreters
+# cannot parse.
+if sys.version_info < (3, 7):
+    raise unittest.SkipTest('The ASGI middlewares require Python 3.7')
+
+from tests.asgi.base import app  # noqa
+from tests.asgi.base import TestCase  # noqa
@@ -0,0 +1,86 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+from tests import util
+
+
+async def app(scope, receive, send):
+    await send({'type': 'http.response.start', 'status': 204,
+                'headers': []})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+class Response(object):
+
+    def __init__(self):
+        self.status = None
+        self.headers = {}
+        self.body = b''
+
+
+class TestCase(util.TestCase):
+
+    def setUp(self):
+        super(TestCase, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def create_scope(self, path, roles=None, project_id=None,
+                     auth_token=None, method='GET', headers=None):
+        pairs = list(headers or [])
+
+        if auth_token is not None:
+            pairs.append(('x-auth-token', auth_token))
+
+        if project_id is not None:
+            pairs.append(('x-project-id', project_id))
+
+        if roles is not None:
+            if not isinstance(roles, str):
+                roles = ','.join(roles or [])
+
+            pairs.append(('x-roles', roles))
+
+        return {
+            'type': 'http',
+            'method': method,
+            'path': path,
+            'headers': [(name.encode('latin-1'), value.encode('latin-1'))
+                        for (name, value) in pairs],
+            'client': ('127.0.0.1', 54321),
+        }
+
+    def request(self, app, scope):
+        response = Response()
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                response.status = message['status']
+                response.headers = dict(
+                    (name.decode('latin-1'), value.decode('latin-1'))
+                    for (name, value) in message.get('headers', []))
+            elif message['type'] == 'http.response.body':
+                response.body += message.get('body', b'')
+
+        self.run_async(app(scope, receive, send))
+        return response
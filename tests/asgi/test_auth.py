@@ -0,0 +1,373 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import base64
+import copy
+import datetime
+
+import ddt
+from fakeredis import aioredis
+from keystoneclient import access
+from keystoneclient import exceptions
+import mock
+import requests
+
+from eom.asgi import auth as asgi_auth
+from eom import auth
+from eom.utils import limits
+from tests import asgi
+from tests import util
+from tests.util.statsd_recording_client import RecordingStatsdClient
+
+
+def _expires(hours):
+    expires = datetime.datetime.utcnow() + datetime.timedelta(hours=hours)
+    return expires.isoformat() + 'Z'
+
+
+def v2_token_body(tenant, token, hours=1):
+    return {
+        'access': {
+            'token': {
+                'id': token,
+                'expires': _expires(hours),
+                'tenant': {'id': tenant, 'name': 'tenant_name'},
+            },
+            'user': {
+                'id': 'user_id',
+                'name': 'user_name',
+                'roles': [{'name': 'member'}],
+            },
+            'serviceCatalog': [{
+                'type': 'object-store',
+                'name': 'swift',
+                'endpoints': [{'publicURL': 'http://swift.example.com'}],
+            }],
+        },
+    }
+
+
+def v3_token_body(project_id, hours=1):
+    return {
+        'token': {
+            'methods': ['token'],
+            'expires_at': _expires(hours),
+            'user': {
+                'id': 'user_id',
+                'name': 'user_name',
+                'domain': {'id': 'default', 'name': 'Default'},
+            },
+            'project': {
+                'id': project_id,
+                'name': 'project_name',
+                'domain': {'id': 'default', 'name': 'Default'},
+            },
+            'roles': [{'id': 'role_id', 'name': 'member'}],
+        },
+    }
+
+
+def keystone_response(status_code, body=None):
+    response = mock.Mock(status_code=status_code, headers={})
+    response.json.return_value = body
+    return response
+
+
+@ddt.ddt
+class TestAuth(asgi.TestCase):
+
+    def setUp(self):
+        super(TestAuth, self).setUp()
+        auth.configure(util.CONF)
+        self.redis_client = aioredis.FakeRedis()
+        self.addCleanup(lambda: self.run_async(self.redis_client.flushall()))
+
+        self.tenant = '172839405'
+        self.token = 'AaBbCcDdEeFf'
+        self.stats_client = RecordingStatsdClient()
+        self.scopes = []
+
+    def _set_conf(self, name, value):
+        auth._CONF.set_override(name, value, auth.AUTH_GROUP_NAME)
+        self.addCleanup(auth._CONF.clear_override, name,
+                        auth.AUTH_GROUP_NAME)
+
+    def _wrap(self):
+        async def app(scope, receive, send):
+            self.scopes.append(scope)
+            await asgi.app(scope, receive, send)
+
+        return asgi_auth.wrap(app, self.redis_client,
+                              stats_client=self.stats_client)
+
+    def _request(self, app, headers=None):
+        scope = self.create_scope('/v2/vault', project_id=self.tenant,
+                                  auth_token=self.token, headers=headers)
+        return self.request(app, scope)
+
+    def _counters(self):
+        return [line.split(':')[0] for line in self.stats_client.lines
+                if line.endswith('|c')]
+
+    @ddt.data(
+        {'auth_token': 'token'},
+        {'project_id': 'tenant'},
+    )
+    def test_missing_headers(self, headers):
+        scope = self.create_scope('/v2/vault', **headers)
+        self.assertEqual(self.request(self._wrap(), scope).status, 412)
+
+    def test_valid_token_v2(self):
+        app = self._wrap()
+        body = v2_token_body(self.tenant, self.token)
+        access_info = access.AccessInfoV2(**copy.deepcopy(body['access']))
+
+        with mock.patch('eom.auth._validate_token_v2') as mock_validate:
+            mock_validate.return_value = access.AccessInfoV2(
+                **copy.deepcopy(body['access']))
+
+            # NOTE: Identity headers sent by the client are replaced, or
+            # removed when the token has none.
+            response = self._request(app, headers=[('x-roles', 'admin'),
+                                                   ('x-domain-id', 'forged')])
+            self.assertEqual(response.status, 204)
+
+            # NOTE: Rescoped through keystoneclient, as by eom.auth
+            mock_validate.assert_called_once_with(
+                auth.get_conf().auth_url[0], self.tenant, self.token)
+
+            # Served from the cache
+            self.assertEqual(self._request(app).status, 204)
+            self.assertEqual(mock_validate.call_count, 1)
+
+        headers = dict((name.decode('latin-1'), value)
+                       for (name, value) in self.scopes[0]['headers'])
+        self.assertEqual(headers['x-identity-status'], b'Confirmed')
+        self.assertEqual(headers['x-user-id'], b'user_id')
+        self.assertEqual(headers['x-roles'], b'member')
+        # NOTE: Encoded as by eom.auth
+        self.assertEqual(base64.b64decode(headers['x-service-catalog']),
+                         auth._service_catalog_data(access_info))
+        self.assertEqual(
+            [name for (name, _) in self.scopes[0]['headers']].count(
+                b'x-roles'), 1)
+        self.assertNotIn('x-domain-id', headers)
+
+        counters = self._counters()
+        self.assertIn('auth.keystone.valid', counters)
+        self.assertIn('auth.cache.hit', counters)
+
+    def test_valid_token_v3(self):
+        self._set_conf('auth_version', 'v3')
+        self._set_conf('alternate_validation', True)
+        app = self._wrap()
+
+        with mock.patch('requests.request') as mock_request:
+            mock_request.return_value = keystone_response(
+                200, v3_token_body(self.tenant))
+
+            self.assertEqual(self._request(app).status, 204)
+
+            args, kwargs = mock_request.call_args
+            self.assertEqual(args[0], 'GET')
+            self.assertTrue(args[1].endswith('/auth/tokens?nocatalog'))
+            self.assertEqual(kwargs['headers']['X-Auth-Token'], self.token)
+            self.assertEqual(kwargs['headers']['X-Subject-Token'],
+                             self.token)
+
+            mock_request.return_value = keystone_response(
+                200, v3_token_body('another_project'))
+            scope = self.create_scope('/v2/vault', project_id='other',
+                                      auth_token='other_token')
+            self.assertEqual(self.request(app, scope).status, 401)
+
+    @ddt.data(401, 404)
+    def test_invalid_token_is_blacklisted(self, status_code):
+        self._set_conf('auth_version', 'v3')
+        app = self._wrap()
+
+        with mock.patch('requests.request') as mock_request:
+            mock_request.return_value = keystone_response(status_code)
+
+            self.assertEqual(self._request(app).status, 401)
+            self.assertEqual(self._request(app).status, 401)
+            self.assertEqual(mock_request.call_count, 1)
+
+        blacklisted = self.run_async(self.redis_client.get(
+            auth._blacklist_cache_key(self.token)))
+        self.assertIsNotNone(blacklisted)
+        self.assertIn('auth.blacklist.hit', self._counters())
+
+    def test_keystone_throttled(self):
+        app = self._wrap()
+
+        with mock.patch('eom.auth._validate_token_v2') as mock_validate:
+            mock_validate.side_effect = exceptions.AuthorizationFailure(
+                'Authorization Failed: Request Entity Too Large (HTTP 413)')
+            response = self._request(app)
+
+        self.assertEqual(response.status, 503)
+        self.assertEqual(response.headers['retry-after'], '60')
+
+    def test_circuit_breaker(self):
+        self._set_conf('circuit_breaker_failures', 1)
+        app = self._wrap()
+
+        # NOTE: Reported by keystoneclient as a failed authorization
+        with mock.patch('eom.auth._validate_token_v2') as mock_validate:
+            mock_validate.side_effect = exceptions.AuthorizationFailure(
+                'Authorization Failed: Unable to establish connection to '
+                'http://keystone/v2.0/tokens')
+
+            self.assertEqual(self._request(app).status, 401)
+            response = self._request(app)
+            self.assertEqual(mock_validate.call_count, 1)
+
+        self.assertEqual(response.status, 503)
+        self.assertIn('retry-after', response.headers)
+        self.assertIn('auth.keystone.error', self._counters())
+        self.assertIn('auth.keystone.rejected', self._counters())
+
+    def test_keystone_call_budget_spent_last(self):
+        keystone = asgi_auth._Keystone(self.redis_client,
+                                       auth._CONF[auth.AUTH_GROUP_NAME])
+        keystone._rate_limiter = mock.Mock()
+        keystone._rate_limiter.consume.return_value = 2.5
+
+        def retrieve():
+            return self.run_async(keystone.retrieve('url', self.tenant,
+                                                    self.token, 5, 30))
+
+        keystone._bulkhead = limits.Bulkhead(1)
+        keystone._bulkhead.acquire()
+        self.assertRaises(auth.KeystoneUnavailable, retrieve)
+        keystone._bulkhead.release()
+        keystone._rate_limiter.consume.assert_not_called()
+
+        keystone.breaker = mock.Mock()
+        keystone.breaker.is_open.return_value = False
+        keystone.breaker.allow.return_value = True
+        self.assertRaises(auth.KeystoneUnavailable, retrieve)
+        keystone.breaker.cancel.assert_called_once_with()
+        self.assertTrue(keystone._bulkhead.acquire())
+
+    def test_cancelled_call_opens_circuit(self):
+        self._set_conf('circuit_breaker_failures', 1)
+        app = self._wrap()
+
+        async def cancelled(*args):
+            raise asyncio.CancelledError()
+
+        with mock.patch.object(asgi_auth._Keystone, '_request', cancelled):
+            self.assertRaises(asyncio.CancelledError, self._request, app)
+
+        with mock.patch('requests.request') as mock_request:
+            self.assertEqual(self._request(app).status, 503)
+            self.assertFalse(mock_request.called)
+
+    def test_endpoint_failover(self):
+        self._set_conf('auth_url', ['http://first/v2.0', 'http://second/v2.0'])
+        app = self._wrap()
+        body = v2_token_body(self.tenant, self.token)
+
+        def validate(url, tenant, token):
+            if url.startswith('http://first'):
+                raise requests.ConnectionError()
+            return access.AccessInfoV2(**copy.deepcopy(body['access']))
+
+        # NOTE: The first endpoint is picked first.
+        with mock.patch('random.sample', side_effect=lambda c, k: c[:k]):
+            with mock.patch('random.random', return_value=1.0):
+                with mock.patch('eom.auth._validate_token_v2',
+                                side_effect=validate):
+                    self.assertEqual(self._request(app).status, 204)
+
+        self.assertIn('auth.keystone.failover', self._counters())
+        self.assertIn('auth.keystone.valid', self._counters())
+
+    def test_cache_index(self):
+        self._set_conf('cache_index', True)
+        app = self._wrap()
+
+        body = v2_token_body(self.tenant, self.token)
+        with mock.patch('eom.auth._validate_token_v2') as mock_validate:
+            mock_validate.return_value = access.AccessInfoV2(
+                **body['access'])
+            self.assertEqual(self._request(app).status, 204)
+
+        cache_key = auth._access_cache_key(self.tenant, self.token,
+                                           auth.get_conf().auth_url[0])
+        indexed = self.run_async(self.redis_client.zrange(
+            auth._tenant_index_key(self.tenant), 0, -1))
+        self.assertEqual(indexed, [cache_key.encode('utf-8')])
+
+    def test_source_failure_limit(self):
+        self._set_conf('source_failure_limit', 1)
+        app = self._wrap()
+
+        with mock.patch('eom.auth._validate_token_v2') as mock_validate:
+            mock_validate.side_effect = exceptions.Unauthorized(
+                http_status=401)
+            self.assertEqual(self._request(app).status, 401)
+
+            self.token = 'another_token'
+            self.assertEqual(self._request(app).status, 401)
+            self.assertEqual(mock_validate.call_count, 1)
+
+        self.assertIn('auth.source.blocked', self._counters())
+
+    @ddt.data('refresh_ahead', 'blacklist_local_cache', 'pki_validation',
+              'hedge_requests')
+    def test_unsupported_option(self, name):
+        self._set_conf(name, True)
+        self.assertRaises(ValueError, self._wrap)
+
+    def test_service_token_renewed(self):
+        self._set_conf('auth_version', 'v3')
+        self._set_conf('service_username', 'service')
+        self._set_conf('service_password', 'secret')
+        app = self._wrap()
+
+        service_tokens = ['revoked', 'renewed']
+
+        def service_auth(url, json=None, headers=None):
+            resp = keystone_response(201, v3_token_body(None))
+            resp.headers = {'X-Subject-Token': service_tokens.pop(0)}
+            return resp
+
+        def request(method, url, headers=None, json=None):
+            if headers['X-Auth-Token'] == 'revoked':
+                return keystone_response(401)
+            return keystone_response(200, v3_token_body(self.tenant))
+
+        with mock.patch('requests.post', side_effect=service_auth):
+            with mock.patch('requests.request',
+                            side_effect=request) as mock_request:
+                self.assertEqual(self._request(app).status, 204)
+                self.assertEqual(mock_request.call_count, 2)
+
+        self.assertEqual(service_tokens, [])
+
+    def test_passes_other_scopes(self):
+        scope = {'type': 'websocket', 'headers': []}
+        seen = []
+
+        async def app(scope, receive, send):
+            seen.append(scope)
+
+        self.run_async(asgi_auth.wrap(app, self.redis_client)(scope, None,
+                                                              None))
+        self.assertEqual(seen, [scope])
@@ -0,0 +1,70 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ddt
+
+from eom.asgi import bastion as asgi_bastion
+from eom.asgi import common
+from eom import bastion
+from tests import asgi
+from tests import util
+
+
+async def gated(scope, receive, send):
+    await common.respond(send, 403)
+
+
+@ddt.ddt
+class TestBastion(asgi.TestCase):
+
+    def setUp(self):
+        super(TestBastion, self).setUp()
+        bastion.configure(util.CONF)
+        self.bastion = asgi_bastion.wrap(asgi.app, gated)
+
+    def tearDown(self):
+        super(TestBastion, self).tearDown()
+        bastion._CONF.clear_override('gate_headers', bastion.OPT_GROUP_NAME)
+
+    def _expect(self, path, headers, code):
+        # NOTE: 204 means the backdoor was used, 403 that the gate was
+        # hit, and 404 that a forwarded client tried the backdoor.
+        scope = self.create_scope(path, headers=headers)
+        self.assertEqual(self.request(self.bastion, scope).status, code)
+
+    def test_restricted_route_hits_gate(self):
+        self._expect('/v1', [], 403)
+
+    def test_route_unrestricted_and_gate_headers_present_returns_404(self):
+        self._expect('/v1/health', [('x-forwarded-for', 'taco')], 404)
+
+    def test_route_unrestricted_and_no_gate_headers_returns_204(self):
+        self._expect('/v1/health', [], 204)
+
+    @ddt.data('/v1/healthy', '/health')
+    def test_restrict_close_match_route_hits_gate(self, route):
+        self._expect(route, [('x-forwarded-for', 'taco')], 403)
+
+    def test_multiple_gate_headers(self):
+        bastion._CONF.set_override(
+            'gate_headers',
+            ['HTTP_X_FORWARDED_FOR', 'HTTP_USER_AGENT'],
+            bastion.OPT_GROUP_NAME
+        )
+        self.bastion = asgi_bastion.wrap(asgi.app, gated)
+
+        self._expect('/v1/health', [('x-forwarded-for', 'taco')], 204)
+        self._expect('/v1/health', [('x-forwarded-for', 'taco'),
+                                    ('user-agent', 'lb')], 404)
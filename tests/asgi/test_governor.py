@@ -0,0 +1,104 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from fakeredis import aioredis
+import mock
+import redis
+
+from eom.asgi import governor as asgi_governor
+from eom import governor
+from tests import asgi
+from tests import util
+
+
+async def hmget_unreachable(*args):
+    raise redis.exceptions.ConnectionError()
+
+
+class TestGovernor(asgi.TestCase):
+
+    def setUp(self):
+        super(TestGovernor, self).setUp()
+        governor.configure(util.CONF)
+        self.redis_client = aioredis.FakeRedis()
+        self.addCleanup(lambda: self.run_async(self.redis_client.flushall()))
+
+        # NOTE: Throttled requests are not slowed down in the tests.
+        governor._CONF.set_override('throttle_milliseconds', 0,
+                                    governor.GOV_GROUP_NAME)
+        self.addCleanup(governor._CONF.clear_override,
+                        'throttle_milliseconds', governor.GOV_GROUP_NAME)
+
+        self.governor = asgi_governor.wrap(asgi.app, self.redis_client)
+
+    def _request(self, path, project_id='1234', method='GET'):
+        scope = self.create_scope(path, project_id=project_id, method=method)
+        return self.request(self.governor, scope).status
+
+    def test_missing_project_id(self):
+        self.assertEqual(self._request('/v1', project_id=None), 400)
+
+    @mock.patch('time.time')
+    def test_route_specific_rate(self, mock_time):
+        mock_time.return_value = 1000.0
+
+        # NOTE: GET .../messages is limited by the get_messages rule,
+        # rather than by the default one.
+        statuses = [self._request('/v1/queues/fizbit/messages')
+                    for _ in range(350 + 1)]
+        self.assertEqual(statuses[-2], 204)
+        self.assertEqual(statuses[-1], 429)
+
+        lookup = self.run_async(self.redis_client.hmget(
+            governor._bucket_key('1234'), 'c', 't'))
+        self.assertEqual(float(lookup[0]), 351.0)
+
+    @mock.patch('time.time')
+    def test_project_specific_rate(self, mock_time):
+        mock_time.return_value = 1000.0
+
+        statuses = [self._request('/v1', project_id='281928')
+                    for _ in range(260 + 1)]
+        self.assertEqual(statuses[-2], 204)
+        self.assertEqual(statuses[-1], 429)
+
+    def test_draining(self):
+        rate = governor.Rate({'name': 'r', 'limit': 2,
+                              'drain_velocity': 1.0})
+        check_limit = asgi_governor._create_limiter(self.redis_client)
+
+        with mock.patch('time.time') as mock_time:
+            mock_time.return_value = 1000.0
+            self.run_async(check_limit('42', rate))
+            self.run_async(check_limit('42', rate))
+            self.assertRaises(governor.HardLimitError, self.run_async,
+                              check_limit('42', rate))
+
+            mock_time.return_value = 1003.0
+            self.run_async(check_limit('42', rate))
+
+    def test_redis_errors_let_requests_through(self):
+        rate = governor.Rate({'name': 'r', 'limit': 0,
+                              'drain_velocity': 1.0})
+        redis_client = mock.Mock()
+        redis_client.hmget = hmget_unreachable
+        check_limit = asgi_governor._create_limiter(redis_client)
+
+        # NOTE: The count starts over at 1 when Redis is unreachable.
+        self.assertRaises(governor.HardLimitError, self.run_async,
+                          check_limit('42', rate))
+
+        rate.limit = 1
+        self.run_async(check_limit('42', rate))
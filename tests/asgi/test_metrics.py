@@ -0,0 +1,88 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+
+from eom.asgi import metrics as asgi_metrics
+from eom import metrics
+from tests import asgi
+from tests import util
+from tests.util.statsd_recording_client import RecordingStatsdClient
+
+
+async def streaming_app(scope, receive, send):
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': []})
+    await send({'type': 'http.response.body', 'body': b'abc',
+                'more_body': True})
+    await send({'type': 'http.response.body', 'body': b'de'})
+
+
+async def failing_app(scope, receive, send):
+    await send({'type': 'http.response.start', 'status': 500,
+                'headers': []})
+    raise RuntimeError('boom')
+
+
+class TestMetrics(asgi.TestCase):
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        metrics.configure(util.CONF)
+        self.client = RecordingStatsdClient()
+        metrics._CLIENT = self.client
+        self.base_path = 'example_app.{0}'.format(socket.gethostname())
+
+    def tearDown(self):
+        super(TestMetrics, self).tearDown()
+        metrics._CLIENT = None
+
+    def _stats(self, kind):
+        suffix = '|' + kind
+        return dict(line[:-len(suffix)].split(':')
+                    for line in self.client.lines if line.endswith(suffix))
+
+    def test_buckets_initialized(self):
+        asgi_metrics.wrap(asgi.app)
+        counters = self._stats('c')
+        self.assertEqual(
+            counters[self.base_path + '.requests.PUT.*.5xx'], '0')
+
+    def test_streamed_response(self):
+        app = asgi_metrics.wrap(streaming_app)
+        del self.client.packets[:]
+
+        response = self.request(app, self.create_scope('/', method='GET'))
+        self.assertEqual(response.body, b'abcde')
+
+        counters = self._stats('c')
+        self.assertEqual(counters[self.base_path + '.requests.GET.*.2xx'], '1')
+        self.assertEqual(counters[self.base_path + '.bytes.GET'], '5')
+
+        timings = self._stats('ms')
+        self.assertIn(self.base_path + '.ttfb.GET', timings)
+        self.assertIn(self.base_path + '.latency.GET', timings)
+
+    def test_failed_response_reported(self):
+        app = asgi_metrics.wrap(failing_app)
+        del self.client.packets[:]
+
+        scope = self.create_scope('/', method='DELETE')
+        self.assertRaises(RuntimeError, self.request, app, scope)
+
+        counters = self._stats('c')
+        self.assertEqual(
+            counters[self.base_path + '.requests.DELETE.*.5xx'], '1')
+        self.assertEqual(counters[self.base_path + '.bytes.DELETE'], '0')
@@ -0,0 +1,58 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ddt
+
+from eom.asgi import rbac as asgi_rbac
+from eom import rbac
+from tests import asgi
+from tests import util
+
+
+@ddt.ddt
+class TestRBAC(asgi.TestCase):
+
+    def setUp(self):
+        super(TestRBAC, self).setUp()
+        rbac.configure(util.CONF)
+        self.rbac = asgi_rbac.wrap(asgi.app)
+
+    def _request(self, path, roles=None, method='GET'):
+        scope = self.create_scope(path, roles=roles, method=method)
+        return self.request(self.rbac, scope).status
+
+    def test_unknown_path_skips_rbac(self):
+        self.assertEqual(self._request('/v1/unknown'), 204)
+
+    def test_missing_roles(self):
+        self.assertEqual(self._request('/v1/queues'), 403)
+
+    @ddt.data('GET', 'HEAD', 'OPTIONS')
+    def test_read_routes(self, method):
+        self.assertEqual(self._request('/v1/queues', 'observer', method), 204)
+        self.assertEqual(self._request('/v1/queues', 'nobody', method), 403)
+
+    def test_unsupported_method(self):
+        self.assertEqual(self._request('/v1/queues', 'admin', 'TRACE'), 403)
+
+    def test_passes_other_scopes(self):
+        scope = {'type': 'lifespan'}
+        seen = []
+
+        async def app(scope, receive, send):
+            seen.append(scope)
+
+        self.run_async(asgi_rbac.wrap(app)(scope, None, None))
+        self.assertEqual(seen, [scope])
@@ -0,0 +1,81 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests against a local Redis Cluster.
+
+Start a cluster, e.g. with the create-cluster script shipped with
+Redis (utils/create-cluster), and point the tests at its nodes:
+
+    EOM_TEST_REDIS_CLUSTER=127.0.0.1:30001,127.0.0.1:30002 nosetests \\
+        tests/functional/test_redis_cluster.py
+"""
+
+import os
+
+from testtools import testcase
+
+from eom import auth
+from eom import governor
+from eom.utils import redis_pool
+from tests import util
+
+NODES = os.environ.get('EOM_TEST_REDIS_CLUSTER')
+
+
+@testcase.skipIf(not NODES, 'EOM_TEST_REDIS_CLUSTER is not set')
+class TestRedisCluster(util.TestCase):
+
+    def setUp(self):
+        super(TestRedisCluster, self).setUp()
+        auth.configure(util.CONF)
+        self.addCleanup(redis_pool.reset)
+
+        for group in (redis_pool.REDIS_GROUP_NAME, auth.REDIS_GROUP_NAME):
+            self._set_override('cluster', True, group)
+            self._set_override('startup_nodes', NODES.split(','), group)
+
+    def _set_override(self, name, override, group):
+        util.CONF.set_override(name, override, group)
+        self.addCleanup(util.CONF.clear_override, name, group)
+
+    def test_token_keys_pipeline_together(self):
+        redis_client = auth.get_auth_redis_client()
+        token = 'cl4st3r3dt0k3n'
+        cache_key = auth._cache_key('1234', token, 'myurl')
+        blacklist_key = auth._blacklist_cache_key(token)
+        self.addCleanup(redis_client.delete, cache_key)
+        self.addCleanup(redis_client.delete, blacklist_key)
+
+        self.assertEqual(redis_client.keyslot(cache_key),
+                         redis_client.keyslot(blacklist_key))
+
+        self.assertTrue(auth._blacklist_token(redis_client, token, 5000))
+        self.assertTrue(auth._is_token_blacklisted(redis_client, token))
+
+        # NOTE: Multi-key commands fail across slots in a cluster.
+        self.assertEqual(redis_client.mget([blacklist_key, cache_key])[1],
+                         None)
+
+    def test_governor_bucket(self):
+        redis_client = redis_pool.get_client()
+        key = governor._bucket_key('8675309')
+        self.addCleanup(redis_client.delete, key)
+
+        limiter = governor._create_limiter(redis_client)
+        rate = governor.Rate({'name': 'cluster', 'limit': 10,
+                              'drain_velocity': 1})
+        limiter('8675309', rate)
+
+        self.assertEqual(float(redis_client.hget(key, 'c')), 1.0)
@@ -18,25 +18,41 @@ import base64
 import datetime
 import hashlib
 import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
 from wsgiref import simple_server
 
 import ddt
 import fakeredis
 from keystoneclient import access
+from keystoneclient.common import cms
 from keystoneclient import exceptions
 import mock
 import msgpack.exceptions
+import redis
 import simplejson as json
 import six
 
 from eom import auth
+from eom import metrics
+from eom.utils import circuit_breaker
+from eom.utils import endpoints
+from eom.utils import limits
+from eom.utils import redis_pool
+from eom.utils import stats
 import tests
 from tests.mocks import servicecatalog
 from tests import util
+from tests.util.statsd_recording_client import RecordingStatsdClient
 
 
 LOG = logging.getLogger(__name__)
 auth.configure(util.CONF)
+metrics.configure(util.CONF)
 
 
 def run_server(app, host, port):
@@ -44,17 +60,6 @@ def run_server(app, host, port):
     httpd.serve_forever()
 
 
-# Monkey patch the FakeRedis so we can expire data - even if it does nothing
-def fakeredis_pexpireat(self, key, when):
-    pass
-fakeredis.FakeRedis.pexpireat = fakeredis_pexpireat
-
-
-def fakeredis_pexpire(self, key, ttl):
-    pass
-fakeredis.FakeRedis.pexpire = fakeredis_pexpire
-
-
 def fakeredis_connection():
     return fakeredis.FakeRedis()
 
@@ -112,6 +117,29 @@ class fake_access_data(object):
         return self.result
 
 
+def v3_token_body(project_id, hours=1):
+    now = datetime.datetime.utcnow()
+    return {
+        'token': {
+            'methods': ['token'],
+            'issued_at': now.isoformat() + 'Z',
+            'expires_at': (now + datetime.timedelta(hours=hours))
+            .isoformat() + 'Z',
+            'user': {
+                'id': 'user_id',
+                'name': 'user_name',
+                'domain': {'id': 'default', 'name': 'Default'},
+            },
+            'project': {
+                'id': project_id,
+                'name': 'project_name',
+                'domain': {'id': 'default', 'name': 'Default'},
+            },
+            'roles': [{'id': 'role_id', 'name': 'member'}],
+        },
+    }
+
+
 @ddt.ddt
 class TestAuth(util.TestCase):
 
@@ -161,12 +189,10 @@ class TestAuth(util.TestCase):
         value_input = 'fr4nkb3t4p3t3r'
         value_hash = hashlib.sha1()
         if six.PY3:
-            value_hash.update('blacklist'.encode('utf-8'))
             value_hash.update(value_input.encode('utf-8'))
         else:
-            value_hash.update('blacklist')
             value_hash.update(value_input)
-        value_output = value_hash.hexdigest()
+        value_output = 'eom:auth:{%s}:blacklist' % value_hash.hexdigest()
 
         test_result = auth._blacklist_cache_key(
             value_input
@@ -174,6 +200,20 @@ class TestAuth(util.TestCase):
         self.assertNotEqual(value_input, test_result)
         self.assertEqual(value_output, test_result)
 
+    def test_token_keys_share_hash_tag(self):
+        token = 'fr4nkb3t4p3t3r'
+        blacklist_key = auth._blacklist_cache_key(token)
+        cache_key = auth._cache_key('1234', token, 'myurl')
+
+        self.assertTrue(cache_key.startswith('eom:auth:{'))
+        self.assertNotEqual(blacklist_key, cache_key)
+        self.assertEqual(blacklist_key.split('}')[0],
+                         cache_key.split('}')[0])
+
+        other_key = auth._cache_key('1234', 'an0th3rt0k3n', 'myurl')
+        self.assertNotEqual(cache_key.split('}')[0],
+                            other_key.split('}')[0])
+
     def test_blacklist_insertion(self):
         token = 'h0t3l4lph4tang0'
         bttl = 5
@@ -185,16 +225,6 @@ class TestAuth(util.TestCase):
                                     use_bin_type=True,
                                     encoding='utf-8')
 
-        # Redis fails to expire ttl
-        with mock.patch(
-                'fakeredis.FakeRedis.pexpire') as MockRedisExpire:
-            MockRedisExpire.side_effect = Exception(
-                'mock redis expire failure')
-            redis_error = auth._blacklist_token(redis_client,
-                                                token,
-                                                bttl)
-            self.assertFalse(redis_error)
-
         # Redis fails to set the data
         with mock.patch(
                 'fakeredis.FakeRedis.set') as MockRedisSet:
@@ -213,32 +243,965 @@ class TestAuth(util.TestCase):
             auth._blacklist_cache_key(token)
         )
         self.assertIsNotNone(stored_data)
+        ttl = redis_client.pttl(auth._blacklist_cache_key(token))
+        self.assertTrue(0 < ttl <= bttl)
         self.assertEqual(stored_data, packed_data)
         stored_data_original = msgpack.unpackb(stored_data, encoding='utf-8')
         self.assertEqual(True, stored_data_original)
 
     @ddt.data(
-        (datetime.datetime.max, 500, True),
-        ((datetime.datetime.utcnow() + datetime.timedelta(seconds=50)),
-         500, False),
-        ((datetime.datetime.utcnow() + datetime.timedelta(seconds=500)),
-         50, True)
+        (1, 5),
+        (2, 10),
+        (4, 40),
+        (10, 1000),
+        (1000, 1000),
+    )
+    @ddt.unpack
+    def test_get_blacklist_ttl(self, strikes, expected_ttl):
+        self.assertEqual(auth._get_blacklist_ttl(5, 1000, strikes),
+                         expected_ttl)
+
+    def test_blacklist_backoff(self):
+        auth._CONF.set_override('blacklist_max_ttl', 60000,
+                                auth.AUTH_GROUP_NAME)
+        self.addCleanup(auth._CONF.clear_override, 'blacklist_max_ttl',
+                        auth.AUTH_GROUP_NAME)
+
+        token = 'r3p34t0ff3nd3r'
+        redis_client = fakeredis_connection()
+        for _ in range(3):
+            self.assertTrue(auth._blacklist_token(redis_client, token, 1000))
+
+        self.assertTrue(auth._is_token_blacklisted(redis_client, token))
+        ttl = redis_client.pttl(auth._blacklist_cache_key(token))
+        self.assertTrue(3000 < ttl <= 4000)
+
+        strikes_key = auth._strikes_cache_key(token)
+        self.assertEqual(redis_client.get(strikes_key), b'3')
+        self.assertTrue(60000 < redis_client.pttl(strikes_key) <= 64000)
+
+    def test_blacklist_strikes_expire(self):
+        auth._CONF.set_override('blacklist_max_ttl', 60000,
+                                auth.AUTH_GROUP_NAME)
+        self.addCleanup(auth._CONF.clear_override, 'blacklist_max_ttl',
+                        auth.AUTH_GROUP_NAME)
+
+        token = 'r3p34t0ff3nd3r'
+        redis_client = fakeredis_connection()
+        pipeline = redis_client.pipeline
+
+        # NOTE: The entry is not stored, after the strike was counted.
+        def failing_pipeline(transaction=True):
+            pipe = pipeline(transaction=transaction)
+            if not transaction:
+                pipe.execute = mock.Mock(
+                    side_effect=redis.exceptions.ConnectionError())
+            return pipe
+
+        with mock.patch.object(redis_client, 'pipeline', failing_pipeline):
+            self.assertFalse(auth._blacklist_token(redis_client, token,
+                                                   1000))
+
+        strikes_key = auth._strikes_cache_key(token)
+        self.assertEqual(redis_client.get(strikes_key), b'1')
+        self.assertTrue(0 < redis_client.pttl(strikes_key) <= 120000)
+
+    @ddt.data(
+        ({'HTTP_X_FORWARDED_FOR': '10.0.0.1, 10.0.0.2',
+          'REMOTE_ADDR': '10.0.0.3'}, 1, '10.0.0.2'),
+        ({'HTTP_X_FORWARDED_FOR': '10.0.0.1, 10.0.0.2',
+          'REMOTE_ADDR': '10.0.0.3'}, 2, '10.0.0.1'),
+        ({'HTTP_X_FORWARDED_FOR': '10.0.0.1, 10.0.0.2',
+          'REMOTE_ADDR': '10.0.0.3'}, 0, '10.0.0.3'),
+        ({'HTTP_X_FORWARDED_FOR': '10.0.0.1',
+          'REMOTE_ADDR': '10.0.0.3'}, 2, '10.0.0.3'),
+        ({'REMOTE_ADDR': '10.0.0.3'}, 1, '10.0.0.3'),
+        ({}, 1, None),
+    )
+    @ddt.unpack
+    def test_client_address(self, env, trusted_proxies, expected):
+        self.assertEqual(auth._client_address(env, trusted_proxies), expected)
+
+    def test_source_failure_limit(self):
+        auth._CONF.set_override('source_failure_limit', 2,
+                                auth.AUTH_GROUP_NAME)
+        self.addCleanup(auth._CONF.clear_override, 'source_failure_limit',
+                        auth.AUTH_GROUP_NAME)
+
+        redis_client = fakeredis_connection()
+        env = {'HTTP_X_FORWARDED_FOR': '10.0.0.1'}
+
+        def validate(token, address='10.0.0.1'):
+            return auth._validate_client(
+                redis_client, 'url', '42', token,
+                {'HTTP_X_FORWARDED_FOR': address}, 5000, 30)
+
+        with mock.patch(
+                'keystoneclient.v2_0.client.Client') as MockKeystoneClient:
+            MockKeystoneClient.side_effect = exceptions.Unauthorized(
+                'Mock - invalid token')
+
+            self.assertFalse(validate('b4d1'))
+            # Blacklisted tokens count as well
+            self.assertFalse(validate('b4d1'))
+            self.assertEqual(MockKeystoneClient.call_count, 1)
+
+            self.assertFalse(validate('b4d2'))
+            self.assertEqual(MockKeystoneClient.call_count, 1)
+
+            # Other clients are still checked
+            self.assertFalse(validate('b4d2', '10.0.0.9'))
+            self.assertEqual(MockKeystoneClient.call_count, 2)
+
+        cache_key = auth._source_cache_key(env['HTTP_X_FORWARDED_FOR'])
+        self.assertEqual(redis_client.get(cache_key), b'2')
+        self.assertTrue(0 < redis_client.ttl(cache_key) <= 60)
+
+    def _wait_for(self, condition):
+        for _ in range(500):
+            if condition():
+                return True
+            time.sleep(0.01)
+        return False
+
+    def test_blacklist_filter(self):
+        redis_client = fakeredis_connection()
+
+        local = auth.BlacklistFilter(redis_client, warmup=0)
+        self.addCleanup(local.stop)
+        other = auth.BlacklistFilter(redis_client, warmup=3600)
+        self.addCleanup(other.stop)
+
+        token_hash = auth._token_hash('b4dt0k3n')
+
+        # Known once subscribed
+        self.assertTrue(self._wait_for(
+            lambda: not local.may_contain(token_hash)))
+
+        # Not until every blacklisting may have been heard of
+        self.assertTrue(other.may_contain('n0tbl4ckl1st3d'))
+
+        other.publish(token_hash, 5000)
+        self.assertTrue(self._wait_for(
+            lambda: local.may_contain(token_hash)))
+        self.assertFalse(local.may_contain(auth._token_hash('g00dt0k3n')))
+
+    def test_blacklist_lookup_skipped_by_filter(self):
+        redis_client = fakeredis_connection()
+        blacklist_filter = mock.Mock()
+        blacklist_filter.may_contain.return_value = False
+
+        with mock.patch.object(auth, '_BLACKLIST_FILTER', blacklist_filter):
+            auth._blacklist_token(redis_client, 'b4dt0k3n', 5000)
+            blacklist_filter.publish.assert_called_once_with(
+                auth._token_hash('b4dt0k3n'), 5000)
+
+            with mock.patch.object(redis_client, 'get') as MockGet:
+                self.assertFalse(
+                    auth._is_token_blacklisted(redis_client, 'b4dt0k3n'))
+                self.assertFalse(MockGet.called)
+
+            blacklist_filter.may_contain.return_value = True
+            self.assertTrue(
+                auth._is_token_blacklisted(redis_client, 'b4dt0k3n'))
+
+    def test_blacklist_lookup_stays_on_replica(self):
+        token = 'r3pl1c4t3dt0k3n'
+        primary = fakeredis_connection()
+        replica = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+        replicated = redis_pool.ReplicatedClient(primary, [replica])
+
+        # NOTE: Written to the primary, not replicated yet.
+        auth._blacklist_token(replicated, token, 5000)
+
+        self.assertTrue(auth._is_token_blacklisted(primary, token))
+        self.assertFalse(auth._is_token_blacklisted(replicated, token))
+
+    def test_epoch_milliseconds(self):
+        expires = datetime.datetime(2014, 10, 1, 12, 30, 15, 250999)
+        self.assertEqual(auth._epoch_milliseconds(expires), 1412166615250)
+
+        class UtcMinusTwo(datetime.tzinfo):
+
+            def utcoffset(self, dt):
+                return datetime.timedelta(hours=-2)
+
+            def dst(self, dt):
+                return datetime.timedelta(0)
+
+        self.assertEqual(
+            auth._epoch_milliseconds(
+                datetime.datetime(2014, 10, 1, 10, 30, 15, 250999,
+                                  tzinfo=UtcMinusTwo())),
+            1412166615250)
+
+        self.assertGreater(auth._epoch_milliseconds(datetime.datetime.max),
+                           auth._epoch_milliseconds(expires))
+
+    @ddt.data(
+        (3600, 500, 500000),
+        (50, 500, 50000),
+        (-10, 500, -10000),
+    )
+    @ddt.unpack
+    def test_cache_ttl(self, expires_in, max_cache_life, expected_ttl):
+        with mock.patch('time.time') as mock_time:
+            mock_time.return_value = 1412166615.25
+            expires_ms = 1412166615250 + expires_in * 1000
+            self.assertEqual(auth._get_cache_ttl(expires_ms, max_cache_life),
+                             expected_ttl)
+
+    @ddt.data(
+        ('2030-01-01T00:00:00Z', True),
+        ('2010-01-01T00:00:00Z', False),
     )
     @ddt.unpack
-    def test_expiration_time(self, time_to_check,
-                             slop, slop_makes_younger_time):
-        auth_time = auth._get_expiration_time(time_to_check, slop)
-        if slop_makes_younger_time:
-            self.assertLess(auth_time, time_to_check)
+    def test_store_data_to_cache_expiry(self, expires, cached):
+        url = 'myfakeurl'
+        access_data = access.AccessInfoV2(
+            token={'id': 't0k3n', 'expires': expires, 'tenant': {'id': '42'}},
+            user={'id': 'us3r'})
+        cache_key = auth._cache_key('42', 't0k3n', url)
+
+        redis_client = fakeredis_connection()
+        self.assertEqual(auth._send_data_to_cache(redis_client, url,
+                                                  access_data,
+                                                  self.default_max_cache_life),
+                         cached)
+
+        if cached:
+            ttl = redis_client.pttl(cache_key)
+            self.assertTrue(0 < ttl <= self.default_max_cache_life * 1000)
         else:
-            self.assertEqual(auth_time, time_to_check)
+            self.assertFalse(redis_client.exists(cache_key))
+
+    @ddt.data(
+        (0, 2000, 1000, 0.5, False),
+        (1.0, 2000, 1000, 0.5, False),
+        (1.0, 500, 1000, 0.5, True),
+        (1.0, 1500, 1000, 0.9, True),
+        (1.0, 1500, 1000, 0.1, False),
+        (1.0, -1, 0, 0.5, True),
+    )
+    @ddt.unpack
+    def test_should_refresh_early(self, beta, expires_in_ms, delta_ms,
+                                  rand, expected):
+        with mock.patch('time.time') as mock_time:
+            mock_time.return_value = 1000.0
+            with mock.patch('random.random') as mock_random:
+                mock_random.return_value = rand
+                self.assertEqual(
+                    auth._should_refresh_early(1000000 + expires_in_ms,
+                                               delta_ms, beta),
+                    expected)
+
+    def test_retrieve_cache_data_early_refresh(self):
+        url = 'myfakeurl'
+        access_data = access.AccessInfoV2(
+            token={'id': 't0k3n', 'expires': '2030-01-01T00:00:00Z',
+                   'tenant': {'id': '42'}},
+            user={'id': 'us3r'})
+
+        redis_client = fakeredis_connection()
+        auth._send_data_to_cache(redis_client, url, access_data,
+                                 self.default_max_cache_life, 250)
+
+        def retrieve(**kwargs):
+            return auth._retrieve_data_from_cache(redis_client, url, '42',
+                                                  't0k3n', **kwargs)
+
+        with mock.patch('eom.auth._should_refresh_early') as MockRefresh:
+            MockRefresh.return_value = False
+            self.assertEqual(retrieve(early_refresh_beta=1.0), access_data)
+
+            args, kwargs = MockRefresh.call_args
+            expires_ms, delta_ms, beta = args
+            self.assertEqual(delta_ms, 250)
+            self.assertEqual(beta, 1.0)
+            self.assertAlmostEqual(
+                expires_ms / 1000.0,
+                time.time() + self.default_max_cache_life, delta=5)
+
+            # Refreshed by the request itself
+            MockRefresh.return_value = True
+            refreshed = mock.Mock()
+            refresh = mock.Mock(return_value=refreshed)
+            self.assertEqual(retrieve(early_refresh_beta=1.0,
+                                      refresh=refresh),
+                             refreshed)
+            refresh.assert_called_once_with()
+
+            # Refreshed in the background, or failed to refresh
+            refresh = mock.Mock(return_value=None)
+            self.assertEqual(retrieve(early_refresh_beta=1.0,
+                                      refresh=refresh),
+                             access_data)
+            refresh.assert_called_once_with()
+
+            # Not refreshed at all
+            self.assertEqual(retrieve(early_refresh_beta=1.0), access_data)
+
+    def test_failed_early_refresh_serves_cache(self):
+        url = 'myfakeurl'
+        access_data = access.AccessInfoV2(
+            token={'id': 't0k3n', 'expires': '2030-01-01T00:00:00Z',
+                   'tenant': {'id': '42'}},
+            user={'id': 'us3r'})
+
+        redis_client = fakeredis_connection()
+        auth._send_data_to_cache(redis_client, url, access_data,
+                                 self.default_max_cache_life, 250)
+
+        with mock.patch('eom.auth._should_refresh_early') as MockRefresh:
+            MockRefresh.return_value = True
+            with mock.patch('eom.auth._retrieve_data_from_keystone') as (
+                    MockRetrieveKeystoneData):
+                MockRetrieveKeystoneData.side_effect = (
+                    auth.KeystoneUnavailable(30))
+                access_info = auth._get_access_info(
+                    redis_client, url, '42', 't0k3n', 5, 30)
+
+        self.assertEqual(access_info, access_data)
+        MockRetrieveKeystoneData.assert_called_once_with(
+            redis_client, url, '42', 't0k3n', 5, 30, source=None)
+
+    def test_refresh_in_background(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def blocking_refresh(*args, **kwargs):
+            started.set()
+            release.wait(5)
+
+        with mock.patch('eom.auth._retrieve_data_from_keystone') as (
+                MockRetrieveKeystoneData):
+            MockRetrieveKeystoneData.side_effect = blocking_refresh
+
+            auth._refresh_in_background('redis', 'url', '42', 't0k3n', 5, 30)
+            self.assertTrue(started.wait(5))
+
+            # Already in progress
+            auth._refresh_in_background('redis', 'url', '42', 't0k3n', 5, 30)
+            release.set()
+
+            for _ in range(100):
+                if not auth._REFRESHING:
+                    break
+                time.sleep(0.01)
+
+        self.assertEqual(auth._REFRESHING, {})
+        MockRetrieveKeystoneData.assert_called_once_with(
+            'redis', 'url', '42', 't0k3n', 5, 30, source=None)
+
+    def test_refresh_in_background_times_out(self):
+        key = auth._access_cache_key('42', 't0k3n', 'url')
+        stuck = auth._access_cache_key('43', 't0k3n', 'url')
+        self.addCleanup(auth._REFRESHING.clear)
+
+        with mock.patch('eom.auth.threading.Thread') as MockThread:
+            # A refresh whose thread never ran is given up
+            auth._REFRESHING[key] = time.time() - auth.REFRESH_TIMEOUT
+            auth._REFRESHING[stuck] = time.time() - auth.REFRESH_TIMEOUT
+            auth._refresh_in_background('redis', 'url', '42', 't0k3n', 5, 30)
+            self.assertEqual(MockThread.call_count, 1)
+            self.assertEqual(list(auth._REFRESHING), [key])
+
+            # No token is kept
+            self.assertNotIn('t0k3n', key)
+
+    def test_refresh_ahead(self):
+        url = 'myfakeurl'
+        redis_client = fakeredis_connection()
+        access_data = access.AccessInfoV2(
+            token={'id': 't0k3n', 'expires': '2030-01-01T00:00:00Z',
+                   'tenant': {'id': '42'}},
+            user={'id': 'us3r'})
+
+        worker = auth.RefreshAhead(redis_client, 5, 3600, capacity=10,
+                                   margin=60, interval=3600)
+        self.addCleanup(worker.stop)
+
+        # Expiring soon, expiring later and missing entries
+        redis_client.set(auth._cache_key('42', 'soon', url), b'x', px=5000)
+        redis_client.set(auth._cache_key('42', 'later', url), b'x',
+                         px=3600000)
+        for token in ('soon', 'soon', 'later', 'missing'):
+            worker.record(url, '42', token)
+
+        with mock.patch('eom.auth._retrieve_data_from_keystone') as (
+                MockRetrieveKeystoneData):
+            MockRetrieveKeystoneData.return_value = access_data
+
+            self.assertEqual(worker.refresh(), 1)
+
+        MockRetrieveKeystoneData.assert_called_once_with(
+            redis_client, url, '42', 'soon', 5, 3600)
+        self.assertIn(('42', 'soon', url), worker._hitters)
+
+    def test_refresh_ahead_forgets_expiring_tokens(self):
+        url = 'myfakeurl'
+        redis_client = fakeredis_connection()
+        expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=30)
+        access_data = access.AccessInfoV2(
+            token={'id': 't0k3n', 'expires': expires.isoformat() + 'Z',
+                   'tenant': {'id': '42'}},
+            user={'id': 'us3r'})
+
+        worker = auth.RefreshAhead(redis_client, 5, 3600, capacity=10,
+                                   margin=60, interval=3600)
+        self.addCleanup(worker.stop)
+
+        for token in ('t0k3n', 'inv4lid'):
+            redis_client.set(auth._cache_key('42', token, url), b'x',
+                             px=5000)
+            worker.record(url, '42', token)
+            worker.record(url, '42', token)
+
+        with mock.patch('eom.auth._retrieve_data_from_keystone') as (
+                MockRetrieveKeystoneData):
+            MockRetrieveKeystoneData.side_effect = (
+                lambda client, url, tenant, token, *args:
+                    access_data if token == 't0k3n' else None)
+
+            self.assertEqual(worker.refresh(), 2)
+
+        self.assertEqual(len(worker._hitters), 0)
+
+    def test_get_access_info_records_refresh_ahead(self):
+        access_data = access.AccessInfoV2(
+            token={'id': 't0k3n', 'expires': '2030-01-01T00:00:00Z',
+                   'tenant': {'id': '42'}},
+            user={'id': 'us3r'})
+        worker = mock.Mock()
+
+        with mock.patch.object(auth, '_REFRESH_AHEAD', worker):
+            with mock.patch('eom.auth._retrieve_data_from_cache') as (
+                    MockRetrieveCacheData):
+                MockRetrieveCacheData.return_value = access_data
+
+                auth._get_access_info('redis', 'url', '42', 't0k3n', 5, 30)
+
+                MockRetrieveCacheData.return_value = None
+                with mock.patch('eom.auth._retrieve_data_from_keystone') as (
+                        MockRetrieveKeystoneData):
+                    MockRetrieveKeystoneData.return_value = None
+                    auth._get_access_info('redis', 'url', '42', 'b4d', 5, 30)
+
+        worker.record.assert_called_once_with('url', '42', 't0k3n')
+
+    def test_retrieve_cache_data_stale(self):
+        auth._CONF.set_override('stale_grace', 60, auth.AUTH_GROUP_NAME)
+        self.addCleanup(auth._CONF.clear_override, 'stale_grace',
+                        auth.AUTH_GROUP_NAME)
+
+        url = 'myfakeurl'
+        access_data = access.AccessInfoV2(
+            token={'id': 't0k3n', 'expires': '2030-01-01T00:00:00Z',
+                   'tenant': {'id': '42'}},
+            user={'id': 'us3r'})
+
+        redis_client = fakeredis_connection()
+        auth._send_data_to_cache(redis_client, url, access_data, 1)
+
+        # Kept for max_cache_life plus the grace period
+        ttl = redis_client.pttl(auth._cache_key('42', 't0k3n', url))
+        self.assertTrue(60000 < ttl <= 61000)
+
+        def retrieve(**kwargs):
+            return auth._retrieve_data_from_cache(redis_client, url, '42',
+                                                  't0k3n', **kwargs)
+
+        self.assertEqual(retrieve(), access_data)
+
+        now = time.time()
+        with mock.patch.object(auth, 'time') as MockTime:
+            MockTime.time.return_value = now + 5
+            self.assertIsNone(retrieve())
+            self.assertEqual(retrieve(serve_stale=True), access_data)
+
+    def test_cache_record_catalog(self):
+        url = 'myfakeurl'
+        access_data = access.AccessInfoV2(
+            token={'id': 't0k3n', 'expires': '2030-01-01T00:00:00Z',
+                   'tenant': {'id': '42', 'name': 'project'}},
+            user={'id': 'us3r', 'name': 'user', 'roles': []},
+            serviceCatalog=[{'type': 'object-store', 'endpoints': []}])
+        catalog_data = json.dumps(access_data).encode('utf-8')
+
+        redis_client = fakeredis_connection()
+        cache_key = auth._cache_key('42', 't0k3n', url)
+        auth._send_data_to_cache(redis_client, url, access_data, 60)
+
+        # The catalog is stored apart, encoded as forwarded
+        record = msgpack.unpackb(redis_client.get(cache_key), raw=False)
+        self.assertEqual(record[0], auth.CACHE_RECORD_VERSION)
+        self.assertNotIn('serviceCatalog', record[3])
+        self.assertEqual(record[3]['user'], access_data['user'])
+        self.assertEqual(record[4], catalog_data)
+
+        cached = auth._retrieve_data_from_cache(redis_client, url, '42',
+                                                't0k3n')
+        self.assertEqual(cached.user_id, 'us3r')
+        self.assertEqual(cached.project_id, '42')
+        self.assertEqual(auth._service_catalog_data(cached), catalog_data)
+
+        with mock.patch('eom.auth._get_access_info') as MockGetAccessInfo:
+            MockGetAccessInfo.return_value = cached
+            env = {}
+            self.assertTrue(auth._validate_client(redis_client, url, '42',
+                                                  't0k3n', env, 5, 60))
+            self.assertEqual(env['HTTP_X_SERVICE_CATALOG'],
+                             base64.b64encode(catalog_data))
+            self.assertEqual(env['HTTP_X_PROJECT_NAME'], 'project')
+
+        # Expired entries are not decoded any further
+        now = time.time()
+        with mock.patch.object(auth, 'time') as MockTime:
+            with mock.patch('eom.auth._load_access_info') as MockLoad:
+                MockTime.time.return_value = now + 120
+                self.assertIsNone(auth._retrieve_data_from_cache(
+                    redis_client, url, '42', 't0k3n'))
+                MockLoad.assert_not_called()
+
+        # Entries of the previous version are still read
+        redis_client.set(cache_key, msgpack.packb(
+            [1, int(now * 1000) + 60000, 0, dict(access_data)],
+            use_bin_type=True))
+        cached = auth._retrieve_data_from_cache(redis_client, url, '42',
+                                                't0k3n')
+        self.assertEqual(cached, access_data)
+        self.assertEqual(auth._service_catalog_data(cached), catalog_data)
+
+    def test_cache_index(self):
+        auth._CONF.set_override('cache_index', True, auth.AUTH_GROUP_NAME)
+        self.addCleanup(auth._CONF.clear_override, 'cache_index',
+                        auth.AUTH_GROUP_NAME)
+
+        url = 'myfakeurl'
+        redis_client = fakeredis_connection()
+
+        def cache(token, tenant, user, role_tenants=()):
+            access_data = access.AccessInfoV2(
+                token={'id': token, 'expires': '2030-01-01T00:00:00Z',
+                       'tenant': {'id': tenant}},
+                user={'id': user, 'roles': [{'tenantId': role_tenant}
+                                            for role_tenant in role_tenants]})
+            self.assertTrue(auth._send_data_to_cache(redis_client, url,
+                                                     access_data, 60))
+
+        def cached(token, tenant):
+            return auth._retrieve_data_from_cache(redis_client, url, tenant,
+                                                  token) is not None
+
+        index_key = auth._tenant_index_key('42')
+        redis_client.execute_command('ZADD', index_key, 1, 'expired')
+        cache('t0k3n_a', '42', 'us3r_1', role_tenants=['43'])
+        cache('t0k3n_b', '42', 'us3r_2')
+        cache('t0k3n_c', '7', 'us3r_1')
+        cache('t0k3n_d', '8', 'us3r_3', role_tenants=['43'])
+
+        # Expired keys are dropped, and indexes expire with their keys
+        self.assertEqual(redis_client.zcard(index_key), 2)
+        self.assertTrue(55000 < redis_client.pttl(index_key) <= 60000)
+
+        # The life of an index is only ever extended
+        user_index_key = auth._user_index_key('us3r_2')
+        redis_client.pexpire(user_index_key, 120000)
+        cache('t0k3n_e', '9', 'us3r_2')
+        self.assertTrue(115000 < redis_client.pttl(user_index_key))
+
+        self.assertEqual(auth.invalidate_user(redis_client, 'us3r_1'), 2)
+        self.assertFalse(cached('t0k3n_a', '42'))
+        self.assertFalse(cached('t0k3n_c', '7'))
+        self.assertTrue(cached('t0k3n_b', '42'))
+
+        self.assertEqual(auth.invalidate_tenant(redis_client, '42'), 1)
+        self.assertFalse(cached('t0k3n_b', '42'))
+        self.assertEqual(redis_client.zcard(index_key), 0)
+
+        # Tokens with a role on the tenant
+        self.assertEqual(auth.invalidate_tenant(redis_client, '43'), 1)
+        self.assertFalse(cached('t0k3n_d', '8'))
+        self.assertEqual(auth.invalidate_tenant(redis_client, '43'), 0)
+
+    def test_invalidation_app(self):
+        redis_client = fakeredis_connection()
+
+        def request(method, path):
+            app = auth.invalidation_app(redis_client)
+            response = {}
+
+            def start_response(status, headers):
+                response['status'] = status
+
+            body = b''.join(app({'REQUEST_METHOD': method,
+                                 'PATH_INFO': path}, start_response))
+            return response['status'], body
+
+        with mock.patch('eom.auth.invalidate_user') as MockInvalidate:
+            MockInvalidate.return_value = 3
+            status, body = request('DELETE', '/admin/users/us3r/')
+            self.assertEqual(status, '200 OK')
+            self.assertEqual(json.loads(body), {'invalidated': 3})
+            MockInvalidate.assert_called_once_with(redis_client, 'us3r')
+
+            MockInvalidate.side_effect = Exception('mock redis error')
+            status, body = request('DELETE', '/admin/users/us3r')
+            self.assertEqual(status, '503 Service Unavailable')
+
+        status, body = request('DELETE', '/admin/tenants/42')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(json.loads(body), {'invalidated': 0})
+
+        self.assertEqual(request('GET', '/admin/tenants/42')[0],
+                         '405 Method Not Allowed')
+        self.assertEqual(request('DELETE', '/admin/projects/42')[0],
+                         '404 Not Found')
+        self.assertEqual(request('DELETE', '/admin/tenants/')[0],
+                         '404 Not Found')
+        self.assertEqual(request('DELETE', '')[0], '404 Not Found')
+
+    def test_circuit_breaker(self):
+        auth._CONF.set_override('circuit_breaker_failures', 2,
+                                auth.AUTH_GROUP_NAME)
+        self.addCleanup(auth._CONF.clear_override, 'circuit_breaker_failures',
+                        auth.AUTH_GROUP_NAME)
+        self.addCleanup(setattr, auth, '_BREAKER', None)
+
+        redis_client = fakeredis_connection()
+        app = auth.wrap(tests.util.app, redis_client)
+        env = {
+            'HTTP_X_AUTH_TOKEN': 't0k3n',
+            'HTTP_X_PROJECT_ID': '42'
+        }
+        responses = []
+
+        def start_response(status, headers, exc_info=None):
+            responses.append((status, dict(headers)))
+
+        with mock.patch(
+                'keystoneclient.v2_0.client.Client') as MockKeystoneClient:
+            MockKeystoneClient.side_effect = Exception('Mock - timeout')
+
+            for _ in range(3):
+                app(dict(env), start_response)
+
+        self.assertEqual(MockKeystoneClient.call_count, 2)
+        self.assertEqual([status for status, headers in responses],
+                         ['401 Unauthorized', '401 Unauthorized',
+                          '503 Service Unavailable'])
+        self.assertEqual(responses[-1][1]['Retry-After'], '30')
+
+        # Cached tokens are still served, even if stale
+        with mock.patch('eom.auth._retrieve_data_from_cache') as (
+                MockRetrieveCacheData):
+            MockRetrieveCacheData.return_value = None
+            self.assertRaises(auth.KeystoneUnavailable,
+                              auth._get_access_info,
+                              redis_client, 'url', '42', 't0k3n', 5, 30)
+
+            args, kwargs = MockRetrieveCacheData.call_args
+            self.assertTrue(kwargs['serve_stale'])
+
+    def test_unreachable_keystone_opens_circuit(self):
+        breaker = circuit_breaker.CircuitBreaker(1, 30)
+        redis_client = fakeredis_connection()
+
+        # NOTE: keystoneclient wraps connection errors the same way it
+        # does rejected tokens.
+        with mock.patch('eom.auth._request_keystone') as MockRequest:
+            MockRequest.side_effect = exceptions.AuthorizationFailure(
+                'Authorization Failed: Unable to establish connection to '
+                'http://keystone/v2.0/tokens')
+            self.assertIsNone(auth._call_keystone(
+                redis_client, 'url', '42', 't0k3n', 5, 30, breaker,
+                source='10.0.0.1'))
+
+        self.assertTrue(breaker.is_open())
+        self.assertFalse(auth._is_token_blacklisted(redis_client, 't0k3n'))
+        self.assertIsNone(redis_client.get(
+            auth._source_cache_key('10.0.0.1')))
+
+    def test_unknown_token_keeps_circuit_closed(self):
+        auth._CONF.set_override('alternate_validation', True,
+                                auth.AUTH_GROUP_NAME)
+        self.addCleanup(auth._CONF.clear_override, 'alternate_validation',
+                        auth.AUTH_GROUP_NAME)
+        breaker = circuit_breaker.CircuitBreaker(1, 30)
+        redis_client = fakeredis_connection()
+
+        with mock.patch('requests.get') as MockGet:
+            MockGet.return_value = mock.Mock(status_code=404, headers={},
+                                             text='')
+            MockGet.return_value.json.return_value = {}
+            self.assertIsNone(auth._call_keystone(
+                redis_client, 'url', '42', 't0k3n', 5, 30, breaker))
+
+        self.assertFalse(breaker.is_open())
+        self.assertTrue(auth._is_token_blacklisted(redis_client, 't0k3n'))
+
+    def test_keystone_call_budget(self):
+        self.addCleanup(setattr, auth, '_BULKHEAD', None)
+        self.addCleanup(setattr, auth, '_RATE_LIMITER', None)
+
+        def retrieve():
+            return auth._retrieve_data_from_keystone(
+                'redis', 'url', '42', 't0k3n', 5, 30)
+
+        with mock.patch('eom.auth._call_keystone') as MockCallKeystone:
+            MockCallKeystone.return_value = None
+
+            auth._BULKHEAD = limits.Bulkhead(1)
+            self.assertIsNone(retrieve())
+
+            # Every slot taken
+            auth._BULKHEAD.acquire()
+            exc = self.assertRaises(auth.KeystoneUnavailable, retrieve)
+            self.assertEqual(exc.retry_after, 1)
+            auth._BULKHEAD.release()
+
+            auth._RATE_LIMITER = mock.Mock()
+            auth._RATE_LIMITER.consume.return_value = 2.5
+            exc = self.assertRaises(auth.KeystoneUnavailable, retrieve)
+            self.assertEqual(exc.retry_after, 3)
+
+            # The slot was released after each call
+            auth._RATE_LIMITER.consume.return_value = 0
+            self.assertIsNone(retrieve())
+
+        self.assertEqual(MockCallKeystone.call_count, 2)
+
+    def test_keystone_call_budget_spent_last(self):
+        self.addCleanup(setattr, auth, '_BULKHEAD', None)
+        self.addCleanup(setattr, auth, '_RATE_LIMITER', None)
+        self.addCleanup(setattr, auth, '_BREAKER', None)
+
+        def retrieve():
+            return auth._retrieve_data_from_keystone(
+                'redis', 'url', '42', 't0k3n', 5, 30)
+
+        auth._RATE_LIMITER = mock.Mock()
+        auth._RATE_LIMITER.consume.return_value = 2.5
+
+        # Calls turned away by the bulkhead do not use up the budget
+        auth._BULKHEAD = limits.Bulkhead(1)
+        auth._BULKHEAD.acquire()
+        self.assertRaises(auth.KeystoneUnavailable, retrieve)
+        auth._BULKHEAD.release()
+        auth._RATE_LIMITER.consume.assert_not_called()
+
+        # Rejected by the budget, the slot is released and the trial
+        # call of the circuit breaker given back
+        auth._BREAKER = mock.Mock()
+        auth._BREAKER.is_open.return_value = False
+        auth._BREAKER.allow.return_value = True
+        self.assertRaises(auth.KeystoneUnavailable, retrieve)
+        self.assertEqual(auth._RATE_LIMITER.consume.call_count, 1)
+        auth._BREAKER.cancel.assert_called_once_with()
+        self.assertTrue(auth._BULKHEAD.acquire())
+
+    @ddt.data(
+        (False, limits.TokenBucket),
+        (True, limits.RedisRateLimiter),
+    )
+    @ddt.unpack
+    def test_keystone_call_budget_options(self, shared, limiter_class):
+        overrides = {
+            'keystone_max_concurrency': 4,
+            'keystone_rate': 10.0,
+            'keystone_rate_shared': shared,
+        }
+        for name, value in overrides.items():
+            auth._CONF.set_override(name, value, auth.AUTH_GROUP_NAME)
+            self.addCleanup(auth._CONF.clear_override, name,
+                            auth.AUTH_GROUP_NAME)
+        self.addCleanup(setattr, auth, '_BULKHEAD', None)
+        self.addCleanup(setattr, auth, '_RATE_LIMITER', None)
+
+        auth.wrap(tests.util.app, fakeredis_connection())
+
+        self.assertIsInstance(auth._BULKHEAD, limits.Bulkhead)
+        self.assertIsInstance(auth._RATE_LIMITER, limiter_class)
+
+    def test_token_cache(self):
+        for name in ('token_cache', 'alternate_validation'):
+            auth._CONF.set_override(name, True, auth.AUTH_GROUP_NAME)
+            self.addCleanup(auth._CONF.clear_override, name,
+                            auth.AUTH_GROUP_NAME)
+
+        url = 'myfakeurl'
+        access_data = access.AccessInfoV2(
+            token={'id': 't0k3n', 'expires': '2030-01-01T00:00:00Z',
+                   'tenant': {'id': '42', 'name': 'fourty-two'}},
+            user={'id': 'us3r',
+                  'roles': [{'name': 'admin', 'tenantId': '43'},
+                            {'name': 'member'}]})
+
+        redis_client = fakeredis_connection()
+        auth._send_data_to_cache(redis_client, url, access_data,
+                                 self.default_max_cache_life)
+
+        # A single entry, for the token alone
+        self.assertEqual(redis_client.keys(),
+                         [auth._token_cache_key('t0k3n', url).encode()])
+
+        with mock.patch('eom.auth._retrieve_data_from_keystone') as (
+                MockRetrieveKeystoneData):
+            MockRetrieveKeystoneData.return_value = access_data
+
+            # NOTE: Only the roles given on the tenant requested, or on
+            # none, are forwarded.
+            for tenant, roles in (('42', 'member'), ('43', 'admin,member')):
+                env = {'HTTP_X_PROJECT_ID': tenant,
+                       'HTTP_X_PROJECT_NAME': 'forged'}
+                self.assertTrue(auth._validate_client(
+                    redis_client, url, tenant, 't0k3n', env, 5, 30))
+                self.assertEqual(env['HTTP_X_PROJECT_ID'], tenant)
+                self.assertEqual(env['HTTP_X_ROLES'], roles)
+            self.assertNotIn('HTTP_X_PROJECT_NAME', env)
+            self.assertFalse(MockRetrieveKeystoneData.called)
+
+            # Neither the scope of the token nor one of its roles
+            self.assertIsNone(auth._get_access_info(
+                redis_client, url, '44', 't0k3n', 5, 30))
+            self.assertEqual(MockRetrieveKeystoneData.call_count, 1)
+
+    def test_token_cache_v2_rescoping(self):
+        auth._CONF.set_override('token_cache', True, auth.AUTH_GROUP_NAME)
+        self.addCleanup(auth._CONF.clear_override, 'token_cache',
+                        auth.AUTH_GROUP_NAME)
+
+        # NOTE: Keystone scopes the token to each tenant it is validated
+        # for, so that they must not share an entry.
+        self.assertFalse(auth._token_cache_enabled())
+        self.assertNotEqual(auth._access_cache_key('42', 't0k3n', 'url'),
+                            auth._access_cache_key('43', 't0k3n', 'url'))
+
+        auth._CONF.set_override('auth_version', 'v3', auth.AUTH_GROUP_NAME)
+        self.addCleanup(auth._CONF.clear_override, 'auth_version',
+                        auth.AUTH_GROUP_NAME)
+        self.assertTrue(auth._token_cache_enabled())
+        self.assertEqual(auth._access_cache_key('42', 't0k3n', 'url'),
+                         auth._access_cache_key('43', 't0k3n', 'url'))
+
+    def test_identity_env_removes_forged_headers(self):
+        access_data = access.AccessInfoV2(
+            token={'id': 't0k3n', 'expires': '2030-01-01T00:00:00Z'},
+            user={'id': 'us3r', 'name': 'user', 'roles': []})
+
+        redis_client = fakeredis_connection()
+        with mock.patch('eom.auth._retrieve_data_from_keystone') as (
+                MockRetrieveKeystoneData):
+            MockRetrieveKeystoneData.return_value = access_data
+
+            env = {'HTTP_X_PROJECT_ID': '42',
+                   'HTTP_X_PROJECT_NAME': 'forged',
+                   'HTTP_X_DOMAIN_ID': 'forged',
+                   'HTTP_X_SERVICE_CATALOG': 'forged'}
+            self.assertTrue(auth._validate_client(
+                redis_client, 'url', '42', 't0k3n', env, 5, 30))
+
+        # NOTE: The token is not scoped to any project.
+        for name in ('HTTP_X_PROJECT_ID', 'HTTP_X_PROJECT_NAME',
+                     'HTTP_X_DOMAIN_ID', 'HTTP_X_SERVICE_CATALOG'):
+            self.assertNotIn(name, env)
+        self.assertEqual(env['HTTP_X_USER_ID'], 'us3r')
+
+    def _set_endpoints(self, urls, **kwargs):
+        balancer = endpoints.Endpoints(urls, exploration=0, **kwargs)
+        self.addCleanup(setattr, auth, '_ENDPOINTS', None)
+        auth._ENDPOINTS = balancer
+        return balancer
+
+    def test_request_keystone_endpoints(self):
+        balancer = self._set_endpoints(['slow', 'fast'],
+                                       hedge_percentile=None)
+        balancer.scores = [1.0, 0.001]
+
+        with mock.patch('eom.auth._validate_token') as MockValidateToken:
+            MockValidateToken.return_value = 'access'
+            self.assertEqual(auth._request_keystone('url', '42', 't0k3n'),
+                             'access')
+            MockValidateToken.assert_called_once_with('fast', '42', 't0k3n')
+
+            # Another endpoint once, when one fails
+            MockValidateToken.reset_mock()
+            MockValidateToken.side_effect = [
+                exceptions.ConnectionRefused('Mock - down'), 'access']
+            self.assertEqual(auth._request_keystone('url', '42', 't0k3n'),
+                             'access')
+            self.assertEqual([args[0] for args, kwargs
+                              in MockValidateToken.call_args_list],
+                             ['fast', 'slow'])
+            self.assertGreater(balancer.scores[1], 0.1)
+
+            # Not when the token is invalid
+            MockValidateToken.reset_mock()
+            MockValidateToken.side_effect = exceptions.Unauthorized(
+                'Mock - invalid token')
+            self.assertRaises(exceptions.Unauthorized,
+                              auth._request_keystone, 'url', '42', 't0k3n')
+            self.assertEqual(MockValidateToken.call_count, 1)
+
+    def test_request_keystone_hedged(self):
+        balancer = self._set_endpoints(['slow', 'fast'])
+        for _ in range(endpoints.MIN_SAMPLES):
+            balancer.observe(1, 0.01)
+        balancer.scores = [0.0, 1.0]
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def validate_token(url, tenant, token):
+            if url == 'slow':
+                release.wait(5)
+            return url
+
+        with mock.patch('eom.auth._validate_token') as MockValidateToken:
+            MockValidateToken.side_effect = validate_token
+            self.assertEqual(auth._request_keystone('url', '42', 't0k3n'),
+                             'fast')
+
+    def test_request_keystone_hedged_failure(self):
+        balancer = self._set_endpoints(['down', 'up'])
+        for _ in range(endpoints.MIN_SAMPLES):
+            balancer.observe(1, 1.0)
+        balancer.scores = [0.0, 1.0]
+
+        def validate_token(url, tenant, token):
+            if url == 'down':
+                raise exceptions.ConnectionRefused('Mock - down')
+            return url
+
+        # Failed before the hedging delay
+        with mock.patch('eom.auth._validate_token') as MockValidateToken:
+            MockValidateToken.side_effect = validate_token
+            self.assertEqual(auth._request_keystone('url', '42', 't0k3n'),
+                             'up')
+
+    def test_auth_urls_option(self):
+        auth._CONF.set_override('auth_url', ['first', 'second'],
+                                auth.AUTH_GROUP_NAME)
+        self.addCleanup(auth._CONF.clear_override, 'auth_url',
+                        auth.AUTH_GROUP_NAME)
+        self.addCleanup(setattr, auth, '_ENDPOINTS', None)
+
+        with mock.patch('eom.auth._validate_client') as MockValidateClient:
+            MockValidateClient.return_value = False
+            app = auth.wrap(tests.util.app, fakeredis_connection())
+            app({'HTTP_X_AUTH_TOKEN': 't0k3n', 'HTTP_X_PROJECT_ID': '42'},
+                lambda status, headers: None)
+
+        # Cached under the first url, whichever validates the token
+        args, kwargs = MockValidateClient.call_args
+        self.assertEqual(args[1], 'first')
+        self.assertEqual(auth._ENDPOINTS.urls, ['first', 'second'])
+        self.assertIsNone(auth._ENDPOINTS.hedge_delay())
 
     def test_store_data_to_cache(self):
         url = 'myfakeurl'
         tenant_id = '0987654321'
         token = 'fedcbaFEDCBA'
-        key_data = (tenant_id, token, url)
-        key_value = auth._tuple_to_cache_key(key_data)
+        key_value = auth._cache_key(tenant_id, token, url)
 
         redis_client = fakeredis_connection()
 
@@ -248,17 +1211,6 @@ class TestAuth(util.TestCase):
                                     use_bin_type=True,
                                     encoding='utf-8')
 
-        # Redis fails the expiration time
-        with mock.patch(
-                'fakeredis.FakeRedis.pexpireat') as MockRedisExpire:
-            MockRedisExpire.side_effect = Exception(
-                'mock redis expire failure')
-            redis_error = auth._send_data_to_cache(redis_client,
-                                                   url,
-                                                   access_data,
-                                                   self.default_max_cache_life)
-            self.assertFalse(redis_error)
-
         # Redis fails to set the data
         with mock.patch(
                 'fakeredis.FakeRedis.set') as MockRedisSet:
@@ -286,8 +1238,7 @@ class TestAuth(util.TestCase):
         url = 'myurl'
         tenant_id = '123456890'
         token = 'ABCDEFabcdef'
-        key_data = (tenant_id, token, url)
-        key_value = auth._tuple_to_cache_key(key_data)
+        key_value = auth._cache_key(tenant_id, token, url)
 
         data = fake_catalog(tenant_id, token)
         data_packed = msgpack.packb(data, encoding='utf-8', use_bin_type=True)
@@ -546,6 +1497,187 @@ class TestAuth(util.TestCase):
                     self.default_max_cache_life
                 )
 
+    def _set_conf(self, name, value):
+        auth._CONF.set_override(name, value, auth.AUTH_GROUP_NAME)
+        self.addCleanup(auth._CONF.clear_override, name,
+                        auth.AUTH_GROUP_NAME)
+
+    def test_retrieve_keystone_v3(self):
+        redis_client = fakeredis_connection()
+        tenant_id = '172839405'
+        token = 'AaBbCcDdEeFf'
+        self._set_conf('auth_version', 'v3')
+
+        with mock.patch('requests.get') as mock_requests:
+            mock_requests.return_value.status_code = 200
+            mock_requests.return_value.json.return_value = (
+                v3_token_body(tenant_id))
+
+            access_info = auth._retrieve_data_from_keystone(
+                redis_client, 'myurl/', tenant_id, token, 5,
+                self.default_max_cache_life)
+
+            self.assertIsInstance(access_info, access.AccessInfoV3)
+            self.assertEqual(access_info.auth_token, token)
+            self.assertEqual(access_info.project_id, tenant_id)
+
+            # Tokens validate themselves without service credentials
+            args, kwargs = mock_requests.call_args
+            self.assertEqual(args[0], 'myurl/auth/tokens')
+            self.assertEqual(kwargs['headers']['X-Auth-Token'], token)
+            self.assertEqual(kwargs['headers']['X-Subject-Token'], token)
+
+            # Cached as v3
+            cached = auth._retrieve_data_from_cache(
+                redis_client, 'myurl/', tenant_id, token)
+            self.assertIsInstance(cached, access.AccessInfoV3)
+            self.assertEqual(cached, access_info)
+            self.assertEqual(cached.auth_token, token)
+
+            self._set_conf('alternate_validation', True)
+            auth._retrieve_data_from_keystone(
+                redis_client, 'myurl', tenant_id, token, 5,
+                self.default_max_cache_life)
+            args, kwargs = mock_requests.call_args
+            self.assertEqual(args[0], 'myurl/auth/tokens?nocatalog')
+
+    @ddt.data(
+        (404, None),
+        (200, 'another_project'),
+    )
+    @ddt.unpack
+    def test_retrieve_keystone_v3_invalid(self, status_code, project_id):
+        redis_client = fakeredis_connection()
+        tenant_id = '172839405'
+        token = 'AaBbCcDdEeFf'
+        self._set_conf('auth_version', 'v3')
+
+        with mock.patch('requests.get') as mock_requests:
+            mock_requests.return_value.status_code = status_code
+            mock_requests.return_value.json.return_value = (
+                v3_token_body(project_id))
+
+            access_info = auth._retrieve_data_from_keystone(
+                redis_client, 'myurl', tenant_id, token, 5000,
+                self.default_max_cache_life)
+
+        self.assertIsNone(access_info)
+        self.assertTrue(auth._is_token_blacklisted(redis_client, token))
+
+    def test_retrieve_keystone_v3_service_token(self):
+        tenant_id = '172839405'
+        token = 'AaBbCcDdEeFf'
+        self._set_conf('auth_version', 'v3')
+        self.addCleanup(setattr, auth, '_SERVICE_TOKEN', None)
+        auth._SERVICE_TOKEN = auth.ServiceToken(
+            'service', 'secret', project_name='service')
+
+        service_tokens = ['revoked', 'renewed']
+
+        def post(url, json=None, headers=None):
+            self.assertEqual(url, 'myurl/auth/tokens?nocatalog')
+            self.assertEqual(
+                json['auth']['identity']['password']['user']['name'],
+                'service')
+            self.assertEqual(json['auth']['scope']['project']['name'],
+                             'service')
+            resp = mock.Mock(status_code=201)
+            resp.headers = {'X-Subject-Token': service_tokens.pop(0)}
+            resp.json.return_value = v3_token_body('service')
+            return resp
+
+        def get(url, headers=None):
+            self.assertEqual(headers['X-Subject-Token'], token)
+            resp = mock.Mock()
+            resp.status_code = (401 if headers['X-Auth-Token'] == 'revoked'
+                                else 200)
+            resp.json.return_value = v3_token_body(tenant_id)
+            return resp
+
+        with mock.patch('requests.post') as mock_post:
+            with mock.patch('requests.get') as mock_get:
+                mock_post.side_effect = post
+                mock_get.side_effect = get
+
+                for _ in range(2):
+                    access_info = auth._validate_token(
+                        'myurl', tenant_id, token)
+                    self.assertEqual(access_info.project_id, tenant_id)
+
+                # Renewed once, when rejected, then reused
+                self.assertEqual(mock_post.call_count, 2)
+                self.assertEqual(mock_get.call_count, 3)
+
+                # Credentials rejected
+                auth._SERVICE_TOKEN.invalidate('renewed')
+                mock_post.side_effect = None
+                mock_post.return_value.status_code = 401
+                self.assertRaises(auth.ServiceAuthenticationFailed,
+                                  auth._validate_token,
+                                  'myurl', tenant_id, token)
+
+    def test_service_token_renewal(self):
+        service_token = auth.ServiceToken('service', 'secret', margin=300)
+
+        with mock.patch('requests.post') as mock_post:
+            mock_post.return_value.status_code = 201
+            mock_post.return_value.headers = {'X-Subject-Token': 'svc'}
+
+            # Expiring within the margin
+            mock_post.return_value.json.return_value = (
+                v3_token_body(None, hours=0.05))
+            self.assertEqual(service_token.get('myurl'), 'svc')
+            self.assertEqual(service_token.get('myurl'), 'svc')
+            self.assertEqual(mock_post.call_count, 2)
+            args, kwargs = mock_post.call_args
+            self.assertNotIn('scope', kwargs['json']['auth'])
+
+            mock_post.return_value.json.return_value = (
+                v3_token_body(None))
+            service_token.get('myurl')
+            service_token.get('myurl')
+            self.assertEqual(mock_post.call_count, 3)
+
+            mock_post.return_value.json.return_value = {}
+            service_token.invalidate('svc')
+            self.assertRaises(exceptions.InvalidResponse,
+                              service_token.get, 'myurl')
+
+    def test_service_token_v2(self):
+        service_token = auth.ServiceToken('service', 'secret',
+                                          project_name='service',
+                                          auth_version='v2.0')
+
+        with mock.patch('requests.post') as mock_post:
+            mock_post.return_value.status_code = 200
+            mock_post.return_value.json.return_value = {
+                'access': {
+                    'token': {
+                        'id': 'svc',
+                        'expires': '2030-01-01T00:00:00Z',
+                    },
+                    'user': {'id': 'us3r'},
+                },
+            }
+            self.assertEqual(service_token.get('myurl'), 'svc')
+
+            args, kwargs = mock_post.call_args
+            self.assertEqual(args, ('myurl/tokens',))
+            self.assertEqual(kwargs['json'], {
+                'auth': {
+                    'passwordCredentials': {
+                        'username': 'service',
+                        'password': 'secret',
+                    },
+                    'tenantName': 'service',
+                },
+            })
+
+            mock_post.return_value.json.return_value = {}
+            service_token.invalidate('svc')
+            self.assertRaises(exceptions.InvalidResponse,
+                              service_token.get, 'myurl')
+
     def test_get_access_info(self):
         url = 'myurl'
         tenant_id = '172839405'
@@ -895,3 +2027,316 @@ class TestAuth(util.TestCase):
             MockValidateClient.side_effect = [True]
             self.auth(env_valid, self.start_response)
             self.assertEqual(self.status, '204 No Content')
+
+
+class TestAuthMetrics(util.TestCase):
+
+    def setUp(self):
+        super(TestAuthMetrics, self).setUp()
+        self.redis_client = fakeredis_connection()
+        self.client = RecordingStatsdClient()
+        self.auth = auth.wrap(tests.util.app, self.redis_client,
+                              stats_client=self.client)
+
+        self.url = 'myurl'
+        self.tenant_id = '172839405'
+        self.token = 'AbCdEfGhIjKlMnOpQrStUvWxYz'
+
+    def tearDown(self):
+        super(TestAuthMetrics, self).tearDown()
+        self.redis_client.flushall()
+        auth._STATS = stats.NullClient()
+        auth._STAT_PREFIX = ''
+        metrics._CLIENT = None
+
+    def start_response(self, status, headers, exc_info=None):
+        self.status = status
+
+    def _retrieve_from_keystone(self):
+        return auth._retrieve_data_from_keystone(self.redis_client,
+                                                 self.url,
+                                                 self.tenant_id,
+                                                 self.token,
+                                                 5, 30)
+
+    def test_blacklist_hit(self):
+        auth._blacklist_token(self.redis_client, self.token, 5000)
+
+        result = auth._validate_client(self.redis_client, self.url,
+                                       self.tenant_id, self.token, {},
+                                       5, 30)
+        self.assertFalse(result)
+        self.assertEqual(self.client.lines, ['auth.blacklist.hit:1|c'])
+
+    def test_cache_hit_and_miss(self):
+        auth._retrieve_data_from_cache(self.redis_client, self.url,
+                                       self.tenant_id, self.token)
+        self.assertEqual(self.client.lines, ['auth.cache.miss:1|c'])
+
+        cache_key = auth._cache_key(self.tenant_id, self.token, self.url)
+        self.redis_client.set(cache_key, b'invalid')
+
+        auth._retrieve_data_from_cache(self.redis_client, self.url,
+                                       self.tenant_id, self.token)
+        self.assertEqual(self.client.lines[1:], ['auth.cache.error:1|c'])
+
+        access_data = access.AccessInfoV2(
+            token={'id': self.token, 'expires': '2030-01-01T00:00:00Z',
+                   'tenant': {'id': self.tenant_id}})
+        auth._send_data_to_cache(self.redis_client, self.url, access_data,
+                                 60)
+
+        self.assertIsNotNone(auth._retrieve_data_from_cache(
+            self.redis_client, self.url, self.tenant_id, self.token))
+        self.assertEqual(self.client.lines[2:], ['auth.cache.hit:1|c'])
+
+        # Expired entries are misses
+        now = time.time()
+        with mock.patch.object(auth, 'time') as MockTime:
+            MockTime.time.return_value = now + 120
+            self.assertIsNone(auth._retrieve_data_from_cache(
+                self.redis_client, self.url, self.tenant_id, self.token))
+        self.assertEqual(self.client.lines[3:], ['auth.cache.miss:1|c'])
+
+    def test_keystone_outcomes(self):
+        with mock.patch(
+                'keystoneclient.v2_0.client.Client') as MockKeystoneClient:
+            MockKeystoneClient.side_effect = exceptions.Unauthorized(
+                'Mock - invalid token')
+            self.assertIsNone(self._retrieve_from_keystone())
+
+            MockKeystoneClient.side_effect = exceptions.AuthorizationFailure(
+                'Authorization Failed: Request Entity Too Large (HTTP 413)')
+            self.assertRaises(exceptions.RequestEntityTooLarge,
+                              self._retrieve_from_keystone)
+
+            MockKeystoneClient.side_effect = Exception('Mock - error')
+            self.assertIsNone(self._retrieve_from_keystone())
+
+        counters = [line for line in self.client.lines
+                    if line.endswith('|c')]
+        self.assertEqual(counters, ['auth.keystone.invalid:1|c',
+                                    'auth.keystone.throttled:1|c',
+                                    'auth.keystone.error:1|c'])
+
+        timings = [line for line in self.client.lines
+                   if line.endswith('|ms')]
+        self.assertEqual(len(timings), 3)
+        for timing in timings:
+            self.assertTrue(timing.startswith('auth.keystone.latency:'))
+
+    def test_token_expiring_soon(self):
+        access_info = mock.Mock()
+        access_info.will_expire_soon.return_value = True
+
+        with mock.patch('eom.auth._retrieve_data_from_cache') as MockCache:
+            MockCache.return_value = access_info
+            with mock.patch(
+                    'eom.auth._retrieve_data_from_keystone') as MockKeystone:
+                MockKeystone.return_value = None
+                auth._get_access_info(self.redis_client, self.url,
+                                      self.tenant_id, self.token, 5, 30)
+
+        self.assertEqual(self.client.lines, ['auth.token.expiring:1|c'])
+
+    def test_unavailable(self):
+        env = {
+            'HTTP_X_AUTH_TOKEN': self.token,
+            'HTTP_X_PROJECT_ID': self.tenant_id
+        }
+
+        with mock.patch(
+                'eom.auth._validate_client') as MockValidateClient:
+            MockValidateClient.side_effect = exceptions.RequestEntityTooLarge(
+                'Mock - request entity too large')
+            self.auth(env, self.start_response)
+
+        self.assertEqual(self.status, '503 Service Unavailable')
+        self.assertEqual(self.client.lines, ['auth.unavailable:1|c'])
+
+    def test_report_metrics_option(self):
+        auth._CONF.set_override('report_metrics', True, auth.AUTH_GROUP_NAME)
+        self.addCleanup(auth._CONF.clear_override, 'report_metrics',
+                        auth.AUTH_GROUP_NAME)
+
+        metrics._CLIENT = self.client
+        auth.wrap(tests.util.app, self.redis_client)
+
+        auth._retrieve_data_from_cache(self.redis_client, self.url,
+                                       self.tenant_id, self.token)
+        self.assertEqual(self.client.lines,
+                         [metrics.stat_prefix() + '.auth.cache.miss:1|c'])
+
+    def test_no_metrics_by_default(self):
+        auth.wrap(tests.util.app, self.redis_client)
+
+        auth._retrieve_data_from_cache(self.redis_client, self.url,
+                                       self.tenant_id, self.token)
+        self.assertEqual(self.client.lines, [])
+
+
+class TestPki(util.TestCase):
+
+    def setUp(self):
+        super(TestPki, self).setUp()
+        self.redis_client = fakeredis_connection()
+        self.addCleanup(self.redis_client.flushall)
+
+        self.pki_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.pki_dir)
+        try:
+            self._openssl('req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                          '-keyout', 'ca.key', '-out', 'ca.pem',
+                          '-days', '1', '-subj', '/CN=ca')
+            self._openssl('req', '-newkey', 'rsa:2048', '-nodes',
+                          '-keyout', 'signing.key', '-out', 'signing.csr',
+                          '-subj', '/CN=signing')
+            self._openssl('x509', '-req', '-in', 'signing.csr',
+                          '-CA', 'ca.pem', '-CAkey', 'ca.key',
+                          '-CAcreateserial', '-out', 'signing.pem',
+                          '-days', '1')
+        except OSError:
+            self.skipTest('openssl is not available')
+
+        for name in ('auth_version', 'pki_validation'):
+            self.addCleanup(auth._CONF.clear_override, name,
+                            auth.AUTH_GROUP_NAME)
+        auth._CONF.set_override('auth_version', 'v3', auth.AUTH_GROUP_NAME)
+        auth._CONF.set_override('pki_validation', True,
+                                auth.AUTH_GROUP_NAME)
+        self.addCleanup(setattr, auth, '_PKI', None)
+        self.addCleanup(setattr, auth, '_SERVICE_TOKEN', None)
+        auth.wrap(tests.util.app, self.redis_client)
+        auth._SERVICE_TOKEN = mock.Mock()
+        auth._SERVICE_TOKEN.get.return_value = 'service_token'
+
+        self.revoked = []
+        patcher = mock.patch('requests.get')
+        self.mock_get = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.mock_get.side_effect = self._keystone
+
+        patcher = mock.patch('eom.auth._retrieve_data_from_keystone')
+        self.mock_keystone = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.mock_keystone.return_value = None
+
+    def _openssl(self, *args):
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(('openssl',) + args, cwd=self.pki_dir,
+                                  stdout=devnull, stderr=devnull)
+
+    def _file(self, name):
+        return os.path.join(self.pki_dir, name)
+
+    def _sign(self, data):
+        return cms.cms_sign_text(json.dumps(data), self._file('signing.pem'),
+                                 self._file('signing.key'))
+
+    def _keystone(self, url, headers=None):
+        resp = mock.Mock(status_code=200)
+        if url == 'myurl/OS-SIMPLE-CERT/certificates':
+            resp.text = open(self._file('signing.pem')).read()
+        elif url == 'myurl/OS-SIMPLE-CERT/ca':
+            resp.text = open(self._file('ca.pem')).read()
+        elif url == 'myurl/auth/tokens/OS-PKI/revoked':
+            self.assertEqual(headers['X-Auth-Token'], 'service_token')
+            resp.json.return_value = {
+                'signed': self._sign({'revoked': self.revoked})}
+        else:
+            resp.status_code = 404
+        return resp
+
+    def _get_access_info(self, tenant, token):
+        return auth._get_access_info(self.redis_client, 'myurl', tenant,
+                                     token, 5000, 30)
+
+    def test_signed_token(self):
+        token = cms.cms_to_token(self._sign(v3_token_body('42')))
+        self.assertTrue(auth._PKI.is_signed(token))
+        self.assertFalse(auth._PKI.is_signed('AaBbCcDdEeFf'))
+
+        access_info = self._get_access_info('42', token)
+        self.assertIsInstance(access_info, access.AccessInfoV3)
+        self.assertEqual(access_info.project_id, '42')
+        self.assertEqual(access_info.auth_token, token)
+        self.mock_keystone.assert_not_called()
+
+        # Cached, the certificates being fetched once
+        self.assertEqual(
+            auth._retrieve_data_from_cache(self.redis_client, 'myurl',
+                                           '42', token),
+            access_info)
+        compressed = cms.pkiz_sign(json.dumps(v3_token_body('42')),
+                                   self._file('signing.pem'),
+                                   self._file('signing.key'))
+        self.assertIsNotNone(self._get_access_info('42', compressed))
+        self.assertEqual(
+            len([args for args, kwargs in self.mock_get.call_args_list
+                 if 'CERT' in args[0]]),
+            2)
+
+    def test_signed_token_not_verified(self):
+        # Scoped to another project
+        token = cms.cms_to_token(self._sign(v3_token_body('24')))
+        self.assertIsNone(self._get_access_info('42', token))
+        self.mock_keystone.assert_called_once_with(
+            self.redis_client, 'myurl', '42', token, 5000, 30, source=None)
+
+        # Unknown signer
+        self.mock_keystone.reset_mock()
+        token = cms.cms_to_token(
+            cms.cms_sign_text(json.dumps(v3_token_body('42')),
+                              self._file('ca.pem'), self._file('ca.key')))
+        self._get_access_info('42', token)
+        self.assertEqual(self.mock_keystone.call_count, 1)
+
+    def test_signed_token_revoked(self):
+        token = cms.cms_to_token(self._sign(v3_token_body('42')))
+        self.assertIsNotNone(self._get_access_info('42', token))
+
+        self.revoked.append({'id': cms.cms_hash_token(token)})
+        auth._PKI._checked_at = None
+        self.assertIsNone(self._get_access_info('42', token))
+        self.assertTrue(auth._is_token_blacklisted(self.redis_client, token))
+        self.mock_keystone.assert_not_called()
+
+    def test_fetched_without_lock(self):
+        def keystone(url, headers=None):
+            # NOTE: Fails when the lock is held by the fetching thread.
+            self.assertTrue(auth._PKI._lock.acquire(False))
+            auth._PKI._lock.release()
+            return self._keystone(url, headers=headers)
+
+        self.mock_get.side_effect = keystone
+        token = cms.cms_to_token(self._sign(v3_token_body('42')))
+        self.assertIsNotNone(self._get_access_info('42', token))
+        self.assertEqual(self.mock_get.call_count, 3)
+
+    def test_service_token_v2(self):
+        for name in ('service_username', 'service_password'):
+            self.addCleanup(auth._CONF.clear_override, name,
+                            auth.AUTH_GROUP_NAME)
+        auth._CONF.set_override('auth_version', 'v2.0',
+                                auth.AUTH_GROUP_NAME)
+        auth._CONF.set_override('service_username', 'service',
+                                auth.AUTH_GROUP_NAME)
+        auth._CONF.set_override('service_password', 'secret',
+                                auth.AUTH_GROUP_NAME)
+
+        auth.wrap(tests.util.app, self.redis_client)
+        self.assertIsInstance(auth._SERVICE_TOKEN, auth.ServiceToken)
+
+        # Not needed to validate tokens otherwise
+        auth._CONF.set_override('pki_validation', False,
+                                auth.AUTH_GROUP_NAME)
+        auth.wrap(tests.util.app, self.redis_client)
+        self.assertIsNone(auth._SERVICE_TOKEN)
+
+    def test_revocation_list_unavailable(self):
+        auth._SERVICE_TOKEN = None
+        token = cms.cms_to_token(self._sign(v3_token_body('42')))
+        self.assertIsNone(auth._PKI.is_revoked('myurl', token))
+
+        self._get_access_info('42', token)
+        self.assertEqual(self.mock_keystone.call_count, 1)
@@ -0,0 +1,115 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import testtools
+
+from eom.utils import circuit_breaker
+
+
+class TestCircuitBreaker(testtools.TestCase):
+
+    def setUp(self):
+        super(TestCircuitBreaker, self).setUp()
+        self.now = 1000.0
+        patcher = mock.patch.object(circuit_breaker, '_timer',
+                                    lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.breaker = circuit_breaker.CircuitBreaker(2, 30)
+
+    def test_invalid_threshold(self):
+        self.assertRaises(ValueError, circuit_breaker.CircuitBreaker, 0, 30)
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, circuit_breaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.retry_after(), 0)
+
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, circuit_breaker.OPEN)
+        self.assertTrue(self.breaker.is_open())
+        self.assertFalse(self.breaker.allow())
+
+        self.now += 10
+        self.assertEqual(self.breaker.retry_after(), 20)
+
+    def test_half_open_trial(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+
+        self.now += 30
+        self.assertEqual(self.breaker.state, circuit_breaker.HALF_OPEN)
+        self.assertFalse(self.breaker.is_open())
+
+        # A single trial call
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.assertTrue(self.breaker.is_open())
+
+        # Failed, open again for a full period
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.retry_after(), 30)
+
+        self.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, circuit_breaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_trial_after_fork(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.now += 30
+        self.assertTrue(self.breaker.allow())
+
+        self.breaker._after_fork()
+        self.assertTrue(self.breaker.allow())
+
+    def test_cancelled_trial(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.now += 30
+        self.assertTrue(self.breaker.allow())
+
+        self.breaker.cancel()
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+
+        # Nothing to give back when closed
+        self.breaker.record_success()
+        self.breaker.cancel()
+        self.assertEqual(self.breaker.state, circuit_breaker.CLOSED)
+
+    def test_lost_trial_expires(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.now += 30
+        self.assertTrue(self.breaker.allow())
+
+        # The outcome of the trial is never recorded
+        self.now += 10
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.retry_after(), 20)
+
+        self.now += 20
+        self.assertFalse(self.breaker.is_open())
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
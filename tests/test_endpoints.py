@@ -0,0 +1,72 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import testtools
+
+from eom.utils import endpoints
+
+
+class TestEndpoints(testtools.TestCase):
+
+    def test_no_endpoint(self):
+        self.assertRaises(ValueError, endpoints.Endpoints, [])
+
+    def test_choose_fastest(self):
+        balancer = endpoints.Endpoints(['a', 'b', 'c'], exploration=0)
+        balancer.scores = [0.5, 0.001, 0.2]
+
+        picks = set(balancer.choose() for _ in range(100))
+        self.assertNotIn(0, picks)
+        self.assertIn(1, picks)
+
+        picks = set(balancer.choose(exclude=1) for _ in range(100))
+        self.assertEqual(picks, set([2]))
+
+    def test_choose_single(self):
+        balancer = endpoints.Endpoints(['a'])
+        self.assertEqual(balancer.choose(), 0)
+        self.assertEqual(balancer.choose(exclude=0), 0)
+
+    def test_observe(self):
+        balancer = endpoints.Endpoints(['a', 'b'], decay=0.5)
+        balancer.observe(0, 1.0)
+        balancer.observe(0, 0.0)
+        self.assertEqual(balancer.scores[0], 0.25)
+
+        # Failures count as slow replies
+        balancer.observe(1, 0.01, failed=True)
+        self.assertEqual(balancer.scores[1],
+                         0.5 * endpoints.FAILURE_LATENCY)
+
+    def test_hedge_delay(self):
+        balancer = endpoints.Endpoints(['a', 'b'])
+        self.assertIsNone(balancer.hedge_delay())
+
+        for i in range(endpoints.MIN_SAMPLES):
+            balancer.observe(i % 2, 0.01)
+        balancer.observe(0, 5.0, failed=True)
+        self.assertAlmostEqual(balancer.hedge_delay(), 0.01, delta=0.001)
+
+        # Windows rotate
+        for i in range(endpoints.WINDOW_SAMPLES):
+            balancer.observe(0, 0.1)
+        balancer.observe(0, 0.01)
+        self.assertAlmostEqual(balancer.hedge_delay(), 0.1, delta=0.01)
+
+    def test_no_hedging(self):
+        balancer = endpoints.Endpoints(['a', 'b'], hedge_percentile=None)
+        for i in range(endpoints.MIN_SAMPLES):
+            balancer.observe(0, 0.01)
+        self.assertIsNone(balancer.hedge_delay())
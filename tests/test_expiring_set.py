@@ -0,0 +1,75 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import testtools
+
+from eom.utils import expiring_set
+
+
+class TestExpiringSet(testtools.TestCase):
+
+    def setUp(self):
+        super(TestExpiringSet, self).setUp()
+        self.now = 1000.0
+        patcher = mock.patch.object(expiring_set, '_timer',
+                                    lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_invalid_capacity(self):
+        self.assertRaises(ValueError, expiring_set.ExpiringSet, 0)
+
+    def test_members_expire(self):
+        members = expiring_set.ExpiringSet(10)
+        members.add('a', 10)
+        members.add('b', 20)
+        self.assertIn('a', members)
+        self.assertNotIn('c', members)
+
+        self.now += 10
+        self.assertNotIn('a', members)
+        self.assertIn('b', members)
+        self.assertEqual(len(members), 1)
+
+    def test_add_extends_ttl(self):
+        members = expiring_set.ExpiringSet(10)
+        members.add('a', 10)
+        members.add('a', 30)
+        members.add('a', 5)
+
+        self.now += 20
+        self.assertIn('a', members)
+
+    def test_overflow(self):
+        members = expiring_set.ExpiringSet(2)
+        members.add('a', 10)
+        members.add('b', 30)
+        members.add('c', 20)
+
+        self.assertNotIn('c', members)
+        self.assertTrue(members.may_contain('c'))
+        self.assertTrue(members.may_contain('d'))
+
+        # Expired members make room
+        self.now += 10
+        members.add('e', 60)
+        self.assertIn('e', members)
+        self.assertTrue(members.may_contain('d'))
+
+        # No member could have been missed anymore
+        self.now += 10
+        self.assertFalse(members.may_contain('d'))
+        self.assertTrue(members.may_contain('b'))
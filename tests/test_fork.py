@@ -0,0 +1,169 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gc
+import os
+import weakref
+
+import mock
+import statsd
+import testtools
+
+from eom import metrics
+from eom.utils import fork
+from eom.utils import redis_pool
+from eom.utils import stats
+from tests.util.statsd_recording_client import RecordingStatsdClient
+
+
+class TestFork(testtools.TestCase):
+
+    def setUp(self):
+        super(TestFork, self).setUp()
+        self.addCleanup(setattr, fork, '_PID', os.getpid())
+
+    def _register(self, callback):
+        fork.register(callback)
+        self.addCleanup(fork.unregister, callback)
+
+    def _simulate_fork(self):
+        # NOTE: Pretend the state was created by another process.
+        fork._PID = -1
+
+    def test_nothing_runs_in_same_process(self):
+        callback = mock.Mock()
+        self._register(callback)
+
+        fork.postfork()
+        self.assertFalse(callback.called)
+
+    def test_callbacks_run_once_after_fork(self):
+        callback = mock.Mock()
+        self._register(callback)
+
+        self._simulate_fork()
+        fork.postfork()
+        fork.postfork()
+
+        self.assertEqual(callback.call_count, 1)
+        self.assertEqual(fork._PID, os.getpid())
+
+    def test_failing_callback_does_not_stop_others(self):
+        failing = mock.Mock(side_effect=Exception('Mock - failure'))
+        callback = mock.Mock()
+        self._register(failing)
+        self._register(callback)
+
+        self._simulate_fork()
+        fork.postfork()
+
+        self.assertTrue(failing.called)
+        self.assertTrue(callback.called)
+
+    def test_methods_do_not_keep_objects_alive(self):
+        class Resettable(object):
+            resets = 0
+
+            def reset(self):
+                Resettable.resets += 1
+
+        obj = Resettable()
+        fork.register(obj.reset)
+        ref = weakref.ref(obj)
+
+        self._simulate_fork()
+        fork.postfork()
+        self.assertEqual(Resettable.resets, 1)
+
+        del obj
+        gc.collect()
+        self.assertIsNone(ref())
+
+        # Dropped from the registry on the next registration
+        callback = mock.Mock()
+        self._register(callback)
+        self.assertNotIn(None, [ref() for ref in fork._CALLBACKS])
+
+        self._simulate_fork()
+        fork.postfork()
+        self.assertEqual(Resettable.resets, 1)
+        self.assertTrue(callback.called)
+
+    def test_aggregator_drops_inherited_values(self):
+        client = RecordingStatsdClient()
+        aggregator = stats.Aggregator(client, flush_interval=60)
+        self.addCleanup(aggregator.stop)
+
+        aggregator.incr('inherited')
+        aggregator.histogram('latency', 10)
+
+        self._simulate_fork()
+        fork.postfork()
+
+        aggregator.incr('child')
+        aggregator.flush()
+        self.assertEqual(client.lines, ['child:1|c'])
+
+    def test_statsd_socket_is_reopened(self):
+        client = statsd.StatsClient()
+        inherited = client._sock
+
+        metrics._reopen_socket(client)
+
+        self.assertIsNot(client._sock, inherited)
+        self.assertEqual(client._sock.family, inherited.family)
+        self.assertEqual(inherited.fileno(), -1)
+        client._sock.close()
+
+    def test_redis_pools_are_reset(self):
+        pool = mock.Mock()
+        redis_pool._POOLS['test'] = pool
+        self.addCleanup(redis_pool._POOLS.pop, 'test')
+
+        self._simulate_fork()
+        fork.postfork()
+
+        pool.reset.assert_called_once_with()
+        self.assertFalse(pool.disconnect.called)
+
+    @testtools.skipUnless(hasattr(os, 'register_at_fork'),
+                          'os.register_at_fork is not available')
+    def test_real_fork(self):
+        client = RecordingStatsdClient()
+        aggregator = stats.Aggregator(client, flush_interval=60)
+        self.addCleanup(aggregator.stop)
+        aggregator.incr('inherited')
+
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # NOTE: Nothing may escape the child, whatever happens.
+            try:
+                os.close(read_fd)
+                aggregator.incr('child')
+                aggregator.flush()
+                os.write(write_fd, '\n'.join(client.lines).encode('utf-8'))
+            finally:
+                os._exit(0)
+
+        os.close(write_fd)
+        with os.fdopen(read_fd, 'rb') as pipe:
+            child_lines = pipe.read().decode('utf-8')
+        os.waitpid(pid, 0)
+
+        self.assertEqual(child_lines, 'child:1|c')
+
+        aggregator.flush()
+        self.assertEqual(client.lines, ['inherited:1|c'])
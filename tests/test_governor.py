@@ -211,11 +211,15 @@ class TestGovernor(util.TestCase):
         [call() for _ in range(self.limit)]
 
         self.assertEqual(
-            float(self.redis_client.hmget(1, 'c')[0]),
+            float(self.redis_client.hmget(governor._bucket_key(1), 'c')[0]),
             float(self.limit)
         )
         self.assertRaises(governor.HardLimitError, call)
 
+    def test_bucket_key_is_hash_tagged(self):
+        self.assertEqual(governor._bucket_key('8675309'),
+                         'eom:gov:{8675309}')
+
     @mock.patch('time.time')
     def test_limit_reached_no_429(self, mock_time):
         mock_time.return_value = 0.0
@@ -0,0 +1,70 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+
+import testtools
+
+from eom.utils import heavy_hitters
+
+
+class TestSpaceSaving(testtools.TestCase):
+
+    def test_invalid_capacity(self):
+        self.assertRaises(ValueError, heavy_hitters.SpaceSaving, 0)
+
+    def test_exact_below_capacity(self):
+        hitters = heavy_hitters.SpaceSaving(3)
+        for key in 'aabacb':
+            hitters.add(key)
+
+        self.assertEqual(hitters.top(),
+                         [('a', 3, 0), ('b', 2, 0), ('c', 1, 0)])
+        self.assertEqual(hitters.top(1), [('a', 3, 0)])
+
+    def test_eviction_inherits_count(self):
+        hitters = heavy_hitters.SpaceSaving(2)
+        for key in 'aab':
+            hitters.add(key)
+        hitters.add('c')
+
+        self.assertEqual(len(hitters), 2)
+        self.assertNotIn('b', hitters)
+        self.assertEqual(hitters.top(), [('a', 2, 0), ('c', 2, 1)])
+
+    def test_frequent_keys_are_tracked(self):
+        hitters = heavy_hitters.SpaceSaving(10)
+        keys = ['hot'] * 2000 + ['warm'] * 1000
+        keys += ['cold{0}'.format(i) for i in range(5000)]
+        random.shuffle(keys)
+        for key in keys:
+            hitters.add(key)
+
+        top = hitters.top(2)
+        self.assertEqual([key for key, count, error in top], ['hot', 'warm'])
+        for key, count, error in top:
+            self.assertTrue(count - error <= keys.count(key) <= count)
+
+    def test_decay(self):
+        hitters = heavy_hitters.SpaceSaving(3)
+        for key in 'aaaab':
+            hitters.add(key)
+
+        hitters.decay()
+        self.assertEqual(hitters.top(), [('a', 2, 0)])
+
+        hitters.discard('a')
+        hitters.discard('a')
+        self.assertEqual(len(hitters), 0)
@@ -0,0 +1,80 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+
+import ddt
+import testtools
+
+from eom.utils import histogram
+
+
+@ddt.ddt
+class TestLogHistogram(testtools.TestCase):
+
+    def test_empty(self):
+        h = histogram.LogHistogram()
+        self.assertIsNone(h.quantile(0.5))
+        self.assertIsNone(h.max)
+        self.assertEqual(h.count, 0)
+
+    @ddt.data(0.5, 0.9, 0.99)
+    def test_quantiles_within_relative_accuracy(self, q):
+        accuracy = 0.01
+        h = histogram.LogHistogram(accuracy)
+        values = [random.uniform(0.1, 5000) for i in range(10000)]
+        for value in values:
+            h.add(value)
+
+        expected = sorted(values)[int(q * (len(values) - 1))]
+        estimate = h.quantile(q)
+        self.assertTrue(abs(estimate - expected) <= expected * accuracy,
+                        '{0} vs {1}'.format(estimate, expected))
+
+    def test_max_is_exact(self):
+        h = histogram.LogHistogram()
+        for value in (3.0, 42.5, 7.0):
+            h.add(value)
+
+        self.assertEqual(h.max, 42.5)
+        self.assertEqual(h.quantile(1.0), 42.5)
+        self.assertEqual(h.count, 3)
+
+    def test_zero_and_negative_values(self):
+        h = histogram.LogHistogram()
+        h.add(0)
+        h.add(-1)
+        h.add(10)
+
+        self.assertEqual(h.quantile(0), 0.0)
+        self.assertEqual(h.quantile(1), 10)
+
+    def test_bucket_count_is_bounded(self):
+        h = histogram.LogHistogram(max_buckets=16)
+        for exponent in range(-20, 20):
+            h.add(2.0 ** exponent)
+
+        self.assertTrue(len(h._buckets) <= 16)
+        self.assertEqual(h.count, 40)
+        self.assertEqual(h.max, 2.0 ** 19)
+
+    @ddt.data(0, 1, -0.5)
+    def test_invalid_accuracy(self, accuracy):
+        self.assertRaises(ValueError, histogram.LogHistogram, accuracy)
+
+    @ddt.data((50, 'p50'), (99.9, 'p99_9'), ('90', 'p90'))
+    @ddt.unpack
+    def test_percentile_name(self, percentile, name):
+        self.assertEqual(histogram.percentile_name(percentile), name)
@@ -0,0 +1,113 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fakeredis
+import mock
+import redis
+import testtools
+
+from eom.utils import limits
+
+
+class TestBulkhead(testtools.TestCase):
+
+    def test_invalid_max_concurrent(self):
+        self.assertRaises(ValueError, limits.Bulkhead, 0)
+
+    def test_acquire_release(self):
+        bulkhead = limits.Bulkhead(2)
+        self.assertTrue(bulkhead.acquire())
+        self.assertTrue(bulkhead.acquire())
+        self.assertFalse(bulkhead.acquire())
+
+        bulkhead.release()
+        self.assertTrue(bulkhead.acquire())
+
+    def test_after_fork(self):
+        bulkhead = limits.Bulkhead(1)
+        self.assertTrue(bulkhead.acquire())
+
+        bulkhead._after_fork()
+        self.assertTrue(bulkhead.acquire())
+
+
+class TestTokenBucket(testtools.TestCase):
+
+    def setUp(self):
+        super(TestTokenBucket, self).setUp()
+        self.now = 1000.0
+        patcher = mock.patch.object(limits, '_timer', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_invalid_rate(self):
+        self.assertRaises(ValueError, limits.TokenBucket, 0)
+
+    def test_burst_then_rate(self):
+        bucket = limits.TokenBucket(2, burst=3)
+        for _ in range(3):
+            self.assertEqual(bucket.consume(), 0)
+        self.assertEqual(bucket.consume(), 0.5)
+
+        self.now += 0.5
+        self.assertEqual(bucket.consume(), 0)
+        self.assertEqual(bucket.consume(), 0.5)
+
+        # Never more than the burst
+        self.now += 60
+        for _ in range(3):
+            self.assertEqual(bucket.consume(), 0)
+        self.assertTrue(bucket.consume() > 0)
+
+    def test_default_burst(self):
+        bucket = limits.TokenBucket(0.5)
+        self.assertEqual(bucket.consume(), 0)
+        self.assertEqual(bucket.consume(), 2.0)
+
+
+class TestRedisRateLimiter(testtools.TestCase):
+
+    def setUp(self):
+        super(TestRedisRateLimiter, self).setUp()
+        self.redis_client = fakeredis.FakeRedis()
+        self.addCleanup(self.redis_client.flushall)
+
+    def test_invalid_rate(self):
+        self.assertRaises(ValueError, limits.RedisRateLimiter,
+                          self.redis_client, 'calls', 0)
+
+    def test_shared_window(self):
+        first = limits.RedisRateLimiter(self.redis_client, 'calls', 2)
+        second = limits.RedisRateLimiter(self.redis_client, 'calls', 2)
+
+        with mock.patch.object(limits, 'time') as MockTime:
+            MockTime.time.return_value = 1000.25
+            self.assertEqual(first.consume(), 0)
+            self.assertEqual(second.consume(), 0)
+            self.assertEqual(first.consume(), 0.75)
+
+            ttl = self.redis_client.pttl('calls:1000')
+            self.assertTrue(0 < ttl <= 2000)
+
+            # Next window
+            MockTime.time.return_value = 1001.0
+            self.assertEqual(second.consume(), 0)
+
+    def test_allows_when_redis_fails(self):
+        limiter = limits.RedisRateLimiter(self.redis_client, 'calls', 1)
+        with mock.patch.object(self.redis_client, 'pipeline') as MockPipe:
+            MockPipe.side_effect = redis.exceptions.ConnectionError('down')
+            self.assertEqual(limiter.consume(), 0)
+            self.assertEqual(limiter.consume(), 0)
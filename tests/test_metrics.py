@@ -13,14 +13,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
+import shutil
+import socket
+import tempfile
+import time
+import wsgiref.util
+
 import mock
 from stackinabox.stack import StackInABox
 import stackinabox.util.requests_mock
 
 from eom import metrics
+from eom.utils import stats
 from tests import util
 from tests.util.httpstatsd import HttpStatsdService
 from tests.util.statsd_http_client import HttpStatsdClient
+from tests.util.statsd_recording_client import RecordingStatsdClient
 
 
 metrics.configure(util.CONF)
@@ -37,6 +46,7 @@ class TestMetrics(util.TestCase):
     def tearDown(self):
         super(TestMetrics, self).tearDown()
         StackInABox.reset_services()
+        metrics._CLIENT = None
 
     def test_get_conf(self):
         config = metrics.get_conf()
@@ -155,3 +165,237 @@ class TestMetrics(util.TestCase):
                 self.assertIn('REQUEST_METHOD', my_env)
                 self.assertIn('PATH_INFO', my_env)
                 self.metrics(my_env, self.start_response)
+
+    def _set_override(self, name, override):
+        metrics._CONF.set_override(name, override, metrics.OPT_GROUP_NAME)
+        self.addCleanup(metrics._CONF.clear_override, name,
+                        metrics.OPT_GROUP_NAME)
+
+    def _wrap_aggregated(self, client, app=util.app):
+        """Wraps the app, returning it along with its Aggregator."""
+        metrics._CLIENT = None
+        aggregators = []
+        aggregator_class = stats.Aggregator
+
+        def create_aggregator(*args, **kwargs):
+            aggregator = aggregator_class(*args, **kwargs)
+            aggregators.append(aggregator)
+            self.addCleanup(aggregator.stop)
+            return aggregator
+
+        with mock.patch('statsd.StatsClient') as mok_statsd_client:
+            mok_statsd_client.return_value = client
+            with mock.patch('eom.utils.stats.Aggregator') as mok_aggregator:
+                mok_aggregator.side_effect = create_aggregator
+
+                wrapped = metrics.wrap(app)
+
+        return wrapped, aggregators[0]
+
+    def test_aggregated(self):
+        self._set_override('aggregate', True)
+
+        client = RecordingStatsdClient()
+        self.metrics, aggregator = self._wrap_aggregated(client)
+
+        # NOTE: bucket initialization is not sent right away
+        self.assertEqual(client.packets, [])
+
+        my_env = self.create_env('/', method='GET')
+        self.metrics(my_env, self.start_response)
+        self.assertEqual(client.packets, [])
+
+        aggregator.flush()
+
+        hostname = socket.gethostname()
+        lines = client.lines
+        self.assertIn(
+            'example_app.{0}.requests.GET.*.2xx:1|c'.format(hostname), lines)
+        self.assertIn(
+            'example_app.{0}.requests.PUT.*.5xx:0|c'.format(hostname), lines)
+
+    def test_histograms(self):
+        self._set_override('histograms', True)
+        self._set_override('timing_sample_rate', 0)
+
+        client = RecordingStatsdClient()
+        self.metrics, aggregator = self._wrap_aggregated(client)
+
+        for i in range(10):
+            my_env = self.create_env('/', method='GET')
+            self.metrics(my_env, self.start_response)
+
+        aggregator.flush()
+
+        latency_path = 'example_app.{0}.latency.GET.*'.format(
+            socket.gethostname())
+        self.assertFalse([line for line in client.lines
+                          if line.endswith('|ms')])
+        gauges = [line.split(':')[0] for line in client.lines
+                  if line.endswith('|g')]
+        self.assertEqual(sorted(gauges),
+                         [latency_path + '.max', latency_path + '.p50',
+                          latency_path + '.p90', latency_path + '.p99'])
+
+    def test_streaming_response_is_timed_until_closed(self):
+        self._set_override('aggregate', True)
+
+        closed = []
+
+        class Body(object):
+
+            def __iter__(self):
+                yield b''
+                time.sleep(0.01)
+                yield b'hello '
+                time.sleep(0.02)
+                yield b'world'
+
+            def close(self):
+                closed.append(True)
+
+        def streaming_app(env, start_response):
+            start_response('200 OK', [])
+            return Body()
+
+        client = RecordingStatsdClient()
+        self.metrics, aggregator = self._wrap_aggregated(client,
+                                                         streaming_app)
+
+        response = self.metrics(self.create_env('/', method='GET'),
+                                self.start_response)
+        self.assertEqual(b''.join(response), b'hello world')
+        response.close()
+        self.assertEqual(closed, [True])
+
+        aggregator.flush()
+
+        base_path = 'example_app.{0}.'.format(socket.gethostname())
+        values = dict((line.split(':')[0], float(line.split(':')[1][:-3]))
+                      for line in client.lines if line.endswith('|ms'))
+        ttfb = values[base_path + 'ttfb.GET']
+        ttlb = values[base_path + 'latency.GET']
+        self.assertGreater(ttfb, 10 - 1)
+        self.assertGreater(ttlb, ttfb + 20 - 1)
+        self.assertIn(base_path + 'bytes.GET:11|c', client.lines)
+
+    def test_response_closed_without_iteration(self):
+        self._set_override('aggregate', True)
+
+        closed = []
+
+        def generator_app(env, start_response):
+            start_response('200 OK', [])
+            try:
+                yield b'never sent'
+            finally:
+                closed.append(True)
+
+        client = RecordingStatsdClient()
+        self.metrics, aggregator = self._wrap_aggregated(client,
+                                                         generator_app)
+
+        response = self.metrics(self.create_env('/', method='GET'),
+                                self.start_response)
+        response.close()
+        response.close()
+        aggregator.flush()
+
+        base_path = 'example_app.{0}.'.format(socket.gethostname())
+        self.assertIn(base_path + 'bytes.GET:0|c', client.lines)
+        self.assertEqual(
+            len([line for line in client.lines
+                 if line.startswith(base_path + 'latency.GET:')]), 1)
+
+    def test_list_response_is_not_wrapped(self):
+        client = RecordingStatsdClient()
+        with mock.patch('statsd.StatsClient') as mok_statsd_client:
+            mok_statsd_client.return_value = client
+            self.metrics = metrics.wrap(util.app)
+
+        response = self.metrics(self.create_env('/', method='GET'),
+                                self.start_response)
+        self.assertEqual(response, [])
+
+    def test_request_is_sent_as_one_packet(self):
+        client = RecordingStatsdClient()
+        with mock.patch('statsd.StatsClient') as mok_statsd_client:
+            mok_statsd_client.return_value = client
+            self.metrics = metrics.wrap(util.app)
+
+        del client.packets[:]
+        self.metrics(self.create_env('/', method='GET'), self.start_response)
+
+        base_path = 'example_app.{0}.'.format(socket.gethostname())
+        self.assertEqual(len(client.packets), 1)
+        self.assertIn(base_path + 'requests.GET.*.2xx:1|c', client.lines)
+        self.assertIn(base_path + 'bytes.GET:0|c', client.lines)
+        self.assertEqual(
+            len([line for line in client.lines if line.endswith('|ms')]), 2)
+
+    def test_failed_request_is_counted(self):
+        def failing_app(env, start_response):
+            start_response('500 Internal Server Error', [])
+            raise ValueError()
+
+        client = RecordingStatsdClient()
+        with mock.patch('statsd.StatsClient') as mok_statsd_client:
+            mok_statsd_client.return_value = client
+            self.metrics = metrics.wrap(failing_app)
+
+        self.assertRaises(ValueError, self.metrics,
+                          self.create_env('/', method='GET'),
+                          self.start_response)
+
+        base_path = 'example_app.{0}.'.format(socket.gethostname())
+        self.assertIn(base_path + 'requests.GET.*.5xx:1|c', client.lines)
+
+    def test_file_wrapper_is_not_wrapped(self):
+        body = io.BytesIO(b'hello world')
+
+        def file_app(env, start_response):
+            start_response('200 OK', [('Content-Length', '11')])
+            return env['wsgi.file_wrapper'](body)
+
+        client = RecordingStatsdClient()
+        with mock.patch('statsd.StatsClient') as mok_statsd_client:
+            mok_statsd_client.return_value = client
+            self.metrics = metrics.wrap(file_app)
+
+        env = self.create_env('/', method='GET')
+        env['wsgi.file_wrapper'] = wsgiref.util.FileWrapper
+        response = self.metrics(env, self.start_response)
+
+        self.assertIsInstance(response, wsgiref.util.FileWrapper)
+        base_path = 'example_app.{0}.'.format(socket.gethostname())
+        self.assertIn(base_path + 'bytes.GET:11|c', client.lines)
+
+    def test_get_client_is_shared(self):
+        with mock.patch('statsd.StatsClient') as mok_statsd_client:
+            mok_statsd_client.return_value = RecordingStatsdClient()
+            self.assertIs(metrics.get_client(), metrics.get_client())
+            self.assertEqual(mok_statsd_client.call_count, 1)
+
+    def test_stat_prefix(self):
+        self.assertEqual(metrics.stat_prefix(),
+                         'example_app.' + socket.gethostname())
+
+        self._set_override('backend', metrics.BACKEND_PROMETHEUS)
+        self.assertEqual(metrics.stat_prefix(), 'example_app')
+
+    def test_prometheus_backend(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self._set_override('backend', metrics.BACKEND_PROMETHEUS)
+        self._set_override('prometheus_dir', directory)
+
+        self.metrics = metrics.wrap(util.app)
+        self.metrics(self.create_env('/', method='GET'), self.start_response)
+
+        exposition = metrics.exposition_app()
+        body = b''.join(exposition(self.create_env('/metrics'),
+                                   self.start_response))
+        self.assertEqual(self.status, '200 OK')
+        self.assertIn(b'example_app_requests_GET_2xx_total 1.0', body)
+        self.assertIn(b'example_app_requests_PUT_5xx_total 0.0', body)
+        self.assertIn(b'example_app_latency_GET_seconds_count 1.0', body)
@@ -0,0 +1,170 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import time
+
+import mock
+
+from eom import metrics
+from eom import profiler
+from tests import util
+from tests.util.statsd_recording_client import RecordingStatsdClient
+
+metrics.configure(util.CONF)
+profiler.configure(util.CONF)
+
+
+def sleeping_layer(seconds):
+
+    def wrap(app):
+
+        def middleware(env, start_response):
+            time.sleep(seconds)
+            return app(env, start_response)
+
+        return middleware
+
+    return wrap
+
+
+def slow_app(env, start_response):
+    time.sleep(0.02)
+    start_response('204 No Content', [('X-Test', 'yes')])
+    return []
+
+
+class TestProfiler(util.TestCase):
+
+    def setUp(self):
+        super(TestProfiler, self).setUp()
+        self.client = RecordingStatsdClient()
+        self._set_override('sample_rate', 1.0)
+
+    def _set_override(self, name, override):
+        profiler._CONF.set_override(name, override, profiler.OPT_GROUP_NAME)
+        self.addCleanup(profiler._CONF.clear_override, name,
+                        profiler.OPT_GROUP_NAME)
+
+    def _build(self, app=slow_app, stats_client=None):
+        return profiler.build(app, [
+            ('inner', sleeping_layer(0.01)),
+            ('outer', sleeping_layer(0.005)),
+        ], stats_client=stats_client or self.client)
+
+    def _timings(self):
+        return dict((line.split(':')[0], float(line.split(':')[1][:-3]))
+                    for line in self.client.lines)
+
+    def test_get_conf(self):
+        self.assertIsNotNone(profiler.get_conf())
+
+    def test_inclusive_and_exclusive_times(self):
+        app = self._build()
+        app(self.create_env('/'), self.start_response)
+        self.assertEqual(self.status, '204 No Content')
+
+        timings = self._timings()
+        self.assertEqual(len(timings), 6)
+
+        self.assertGreater(timings['profile.app.exclusive'], 20 - 1)
+        self.assertGreater(timings['profile.inner.exclusive'], 10 - 1)
+        self.assertGreater(timings['profile.outer.exclusive'], 5 - 1)
+        self.assertLess(timings['profile.outer.exclusive'], 10)
+
+        self.assertGreater(timings['profile.outer.inclusive'], 35 - 1)
+        self.assertAlmostEqual(timings['profile.outer.inclusive'],
+                               timings['profile.outer.exclusive'] +
+                               timings['profile.inner.inclusive'],
+                               delta=0.5)
+
+    def test_not_sampled(self):
+        self._set_override('sample_rate', 0)
+        app = self._build()
+        env = self.create_env('/')
+        app(env, self.start_response)
+
+        self.assertEqual(self.status, '204 No Content')
+        self.assertEqual(self.client.packets, [])
+        self.assertNotIn(profiler.ENV_KEY, env)
+
+    def test_server_timing_header(self):
+        self._set_override('server_timing', True)
+        app = self._build()
+        app(self.create_env('/'), self.start_response)
+
+        headers = dict(self.headers)
+        self.assertEqual(headers['X-Test'], 'yes')
+        entries = [entry.split(';')[0]
+                   for entry in headers['Server-Timing'].split(', ')]
+        self.assertEqual(entries, ['outer', 'inner', 'app'])
+
+    def test_server_timing_not_added_without_option(self):
+        app = self._build()
+        app(self.create_env('/'), self.start_response)
+        self.assertNotIn('Server-Timing', dict(self.headers))
+
+    def test_server_timing_with_write(self):
+        self._set_override('server_timing', True)
+        written = []
+
+        def writing_app(env, start_response):
+            write = start_response('200 OK', [])
+            write(b'early')
+            return [b'late']
+
+        def start_response(status, headers, exc_info=None):
+            self.start_response(status, headers)
+            return written.append
+
+        app = self._build(writing_app)
+        body = app(self.create_env('/'), start_response)
+
+        self.assertEqual(self.status, '200 OK')
+        self.assertNotIn('Server-Timing', dict(self.headers))
+        self.assertEqual(written, [b'early'])
+        self.assertEqual(body, [b'late'])
+
+    def test_server_timing_with_lazy_start_response(self):
+        self._set_override('server_timing', True)
+
+        def lazy_app(env, start_response):
+            start_response('200 OK', [])
+            yield b'body'
+
+        app = self._build(lazy_app)
+        body = list(app(self.create_env('/'), self.start_response))
+
+        self.assertEqual(body, [b'body'])
+        self.assertEqual(self.status, '200 OK')
+
+    def test_short_circuiting_layer(self):
+        app = profiler.build(slow_app, [
+            ('gate', util.wrap_403),
+        ], stats_client=self.client)
+        app(self.create_env('/'), self.start_response)
+
+        self.assertEqual(self.status, '403 Forbidden')
+        self.assertEqual(sorted(self._timings()),
+                         ['profile.gate.exclusive', 'profile.gate.inclusive'])
+
+    def test_defaults_to_metrics_client(self):
+        with mock.patch('eom.metrics.get_client') as mock_get_client:
+            mock_get_client.return_value = self.client
+            app = profiler.build(slow_app, [])
+
+        app(self.create_env('/'), self.start_response)
+        self.assertIn('example_app.{0}.profile.app.inclusive'.format(
+            socket.gethostname()), self._timings())
@@ -0,0 +1,234 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import ddt
+import mock
+import testtools
+
+from eom.utils import prometheus
+
+
+def _record_in_child(directory):
+    client = prometheus.Client(directory)
+    for i in range(100):
+        client.incr('requests')
+    os._exit(0)
+
+
+def _parse(text):
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples
+
+
+@ddt.ddt
+class TestPrometheus(testtools.TestCase):
+
+    def setUp(self):
+        super(TestPrometheus, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    @ddt.data(('app.host.requests.GET.*.2xx', 'app_host_requests_GET_2xx'),
+              ('9lives', '_9lives'),
+              ('ok_name:sub', 'ok_name:sub'))
+    @ddt.unpack
+    def test_metric_name(self, stat, name):
+        self.assertEqual(prometheus.metric_name(stat), name)
+
+    @ddt.data(('app.requests', 'app_requests_total'),
+              ('app.requests_total', 'app_requests_total'))
+    @ddt.unpack
+    def test_counter_name(self, stat, name):
+        self.assertEqual(prometheus.counter_name(stat), name)
+
+    def test_counters_are_summed_across_processes(self):
+        first = prometheus.Client(self.directory)
+        first.incr('requests', 2)
+
+        with mock.patch('os.getpid') as mock_getpid:
+            mock_getpid.return_value = os.getpid() + 1
+            second = prometheus.Client(self.directory)
+            second.incr('requests', 3)
+            second.decr('requests')
+
+        samples = _parse(prometheus.collect(self.directory))
+        self.assertEqual(samples['requests_total'], 5.0)
+
+    def test_gauges_are_reported_per_process(self):
+        client = prometheus.Client(self.directory)
+        client.gauge('depth', 4)
+        client.gauge('depth', 2, delta=True)
+
+        samples = _parse(prometheus.collect(self.directory))
+        self.assertEqual(samples['depth{{pid="{0}"}}'.format(os.getpid())],
+                         6.0)
+
+    def test_timings_become_cumulative_histograms(self):
+        client = prometheus.Client(self.directory, buckets=(0.1, 1.0,
+                                                            float('inf')))
+        client.timing('latency', 50)
+        client.timing('latency', 500)
+        client.timing('latency', 5000)
+
+        text = prometheus.collect(self.directory)
+        self.assertIn('# TYPE latency_seconds histogram', text)
+
+        samples = _parse(text)
+        self.assertEqual(samples['latency_seconds_bucket{le="0.1"}'], 1)
+        self.assertEqual(samples['latency_seconds_bucket{le="1.0"}'], 2)
+        self.assertEqual(samples['latency_seconds_bucket{le="+Inf"}'], 3)
+        self.assertEqual(samples['latency_seconds_count'], 3)
+        self.assertAlmostEqual(samples['latency_seconds_sum'], 5.55)
+
+    def test_every_bucket_is_exposed(self):
+        # NOTE: Values past the last bound fall under +Inf, which is
+        # added to the buckets given.
+        client = prometheus.Client(self.directory, buckets=(0.1, 0.05, 1.0))
+        client.timing('latency', 20)
+        client.timing('latency', 5000)
+
+        samples = _parse(prometheus.collect(self.directory))
+        self.assertEqual(samples['latency_seconds_bucket{le="0.05"}'], 1)
+        self.assertEqual(samples['latency_seconds_bucket{le="0.1"}'], 1)
+        self.assertEqual(samples['latency_seconds_bucket{le="1.0"}'], 1)
+        self.assertEqual(samples['latency_seconds_bucket{le="+Inf"}'], 2)
+        self.assertEqual(samples['latency_seconds_count'], 2)
+
+    @mock.patch('random.random')
+    def test_sampled_updates_are_weighted(self, mock_random):
+        client = prometheus.Client(self.directory, buckets=(1.0,))
+
+        mock_random.return_value = 0.9
+        client.incr('requests', rate=0.5)
+        client.timing('latency', 100, rate=0.5)
+
+        mock_random.return_value = 0.1
+        client.incr('requests', rate=0.5)
+        client.timing('latency', 100, rate=0.5)
+
+        samples = _parse(prometheus.collect(self.directory))
+        self.assertEqual(samples['requests_total'], 2.0)
+        self.assertEqual(samples['latency_seconds_bucket{le="1.0"}'], 2)
+        self.assertEqual(samples['latency_seconds_count'], 2)
+        self.assertAlmostEqual(samples['latency_seconds_sum'], 0.2)
+
+    def test_mark_process_dead(self):
+        client = prometheus.Client(self.directory)
+        client.incr('requests', 2)
+        client.timing('latency', 100)
+        client.gauge('depth', 4)
+
+        prometheus.mark_process_dead(self.directory, os.getpid())
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['.lock', 'counter_archive.db',
+                          'histogram_archive.db'])
+
+        samples = _parse(prometheus.collect(self.directory))
+        self.assertEqual(samples['requests_total'], 2.0)
+        self.assertEqual(samples['latency_seconds_count'], 1)
+        self.assertNotIn('depth{{pid="{0}"}}'.format(os.getpid()), samples)
+
+    def test_dead_processes_are_archived(self):
+        client = prometheus.Client(self.directory)
+        client.incr('requests')
+
+        process = multiprocessing.Process(target=_record_in_child,
+                                          args=(self.directory,))
+        process.start()
+        process.join()
+
+        prometheus.collect(self.directory)
+        self.assertNotIn('counter_{0}.db'.format(process.pid),
+                         os.listdir(self.directory))
+
+        process = multiprocessing.Process(target=_record_in_child,
+                                          args=(self.directory,))
+        process.start()
+        process.join()
+
+        samples = _parse(prometheus.collect(self.directory))
+        self.assertEqual(samples['requests_total'], 201.0)
+
+    def test_archived_at_exit(self):
+        client = prometheus.Client(self.directory)
+        client.incr('requests')
+        client.gauge('depth', 4)
+
+        prometheus._archive_all()
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['.lock', 'counter_archive.db'])
+
+        client.incr('requests')
+        samples = _parse(prometheus.collect(self.directory))
+        self.assertEqual(samples['requests_total'], 2.0)
+
+    def test_file_grows_and_reopens(self):
+        client = prometheus.Client(self.directory)
+        for i in range(2000):
+            client.incr('counter_with_a_rather_long_name_{0}'.format(i), i)
+
+        name = 'counter_with_a_rather_long_name_1999_total'
+        path = os.path.join(self.directory,
+                            'counter_{0}.db'.format(os.getpid()))
+        entries = dict(prometheus.read_file(path))
+        self.assertEqual(len(entries), 2000)
+        self.assertEqual(entries[name], 1999)
+
+        reopened = prometheus.MmapedFile(path)
+        reopened.add(name, 1)
+        reopened.close()
+        entries = dict(prometheus.read_file(path))
+        self.assertEqual(entries[name], 2000)
+
+    def test_forked_workers_write_their_own_files(self):
+        client = prometheus.Client(self.directory)
+        client.incr('requests')
+
+        processes = [multiprocessing.Process(target=_record_in_child,
+                                             args=(self.directory,))
+                     for i in range(3)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        samples = _parse(prometheus.collect(self.directory))
+        self.assertEqual(samples['requests_total'], 301.0)
+
+    def test_exposition_app(self):
+        client = prometheus.Client(self.directory)
+        client.incr('requests')
+
+        app = prometheus.exposition_app(self.directory)
+        result = {}
+
+        def start_response(status, headers):
+            result['status'] = status
+            result['headers'] = dict(headers)
+
+        body = b''.join(app({'PATH_INFO': '/metrics'}, start_response))
+        self.assertEqual(result['status'], '200 OK')
+        self.assertEqual(result['headers']['Content-Type'],
+                         prometheus.CONTENT_TYPE)
+        self.assertIn(b'requests_total 1.0', body)
@@ -0,0 +1,348 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fakeredis
+import mock
+import redis
+from redis import connection
+import testtools
+
+from eom import auth
+from eom import metrics
+from eom.utils import redis_pool
+from tests import util
+from tests.util.statsd_recording_client import RecordingStatsdClient
+
+auth.configure(util.CONF)
+metrics.configure(util.CONF)
+
+# NOTE: Renamed in fakeredis 2; FakeConnection became a function.
+FakeConnection = getattr(fakeredis, 'FakeRedisConnection',
+                         fakeredis.FakeConnection)
+
+
+class TestRedisPool(util.TestCase):
+
+    def setUp(self):
+        super(TestRedisPool, self).setUp()
+        self.addCleanup(redis_pool.reset)
+        self._set_override('host', '127.0.0.1')
+        self._set_override('port', '6379')
+
+    def _set_override(self, name, override,
+                      group=redis_pool.REDIS_GROUP_NAME):
+        util.CONF.set_override(name, override, group)
+        self.addCleanup(util.CONF.clear_override, name, group)
+
+    def test_pool_is_shared(self):
+        first = redis_pool.get_client()
+        second = redis_pool.get_client()
+
+        self.assertIs(first.connection_pool, second.connection_pool)
+        self.assertIs(first.connection_pool, redis_pool.get_pool())
+
+    def test_reset(self):
+        pool = redis_pool.get_pool()
+        redis_pool.reset()
+
+        self.assertIsNot(pool, redis_pool.get_pool())
+
+    def test_unset_options_are_not_passed(self):
+        pool = redis_pool.get_pool()
+
+        self.assertIsInstance(pool, redis.ConnectionPool)
+        self.assertNotIsInstance(pool, redis.BlockingConnectionPool)
+        for name in ('socket_timeout', 'socket_connect_timeout',
+                     'socket_keepalive', 'health_check_interval'):
+            self.assertNotIn(name, pool.connection_kwargs)
+
+    def test_tunables(self):
+        self._set_override('max_connections', 7)
+        self._set_override('socket_timeout', 0.25)
+        self._set_override('socket_connect_timeout', 0.5)
+        self._set_override('socket_keepalive', True)
+        self._set_override('health_check_interval', 30)
+
+        pool = redis_pool.get_pool()
+
+        self.assertEqual(pool.max_connections, 7)
+        self.assertEqual(pool.connection_kwargs['host'], '127.0.0.1')
+        self.assertEqual(pool.connection_kwargs['socket_timeout'], 0.25)
+        self.assertEqual(pool.connection_kwargs['socket_connect_timeout'],
+                         0.5)
+        self.assertTrue(pool.connection_kwargs['socket_keepalive'])
+        self.assertEqual(pool.connection_kwargs['health_check_interval'],
+                         30)
+
+    def test_health_check_interval_needs_redis_py_3_3(self):
+        self._set_override('health_check_interval', 30)
+
+        class Connection(object):
+            pass
+
+        with mock.patch.object(redis_pool.connection, 'Connection',
+                               Connection):
+            self.assertRaises(ImportError, redis_pool.check_pool_options,
+                              util.CONF, redis_pool.REDIS_GROUP_NAME)
+            self.assertRaises(ImportError, redis_pool.get_pool)
+
+        redis_pool.check_pool_options(util.CONF, redis_pool.REDIS_GROUP_NAME)
+
+    def test_cluster_needs_redis_py_4_1(self):
+        group = auth.REDIS_GROUP_NAME
+        self._set_override('cluster', True, group)
+
+        with mock.patch.object(redis_pool, 'redis_cluster', None):
+            self.assertRaises(ImportError, redis_pool.register_pool_options,
+                              util.CONF, group)
+
+    def test_blocking(self):
+        self._set_override('max_connections', 1)
+        self._set_override('blocking', True)
+        self._set_override('blocking_timeout', 0.01)
+
+        pool = redis_pool.get_pool()
+
+        self.assertIsInstance(pool, redis.BlockingConnectionPool)
+        self.assertEqual(pool.max_connections, 1)
+        self.assertEqual(pool.timeout, 0.01)
+
+    def test_unix_socket(self):
+        self._set_override('unix_socket_path', '/tmp/redis.sock')
+
+        pool = redis_pool.get_pool()
+
+        self.assertIs(pool.connection_class,
+                      connection.UnixDomainSocketConnection)
+        self.assertEqual(pool.connection_kwargs['path'], '/tmp/redis.sock')
+        self.assertNotIn('host', pool.connection_kwargs)
+
+    def test_cluster_client(self):
+        self._set_override('cluster', True)
+        self._set_override('startup_nodes', ['10.0.0.1:7000', '10.0.0.2:7001'])
+        self._set_override('socket_timeout', 0.25)
+
+        with mock.patch('redis.cluster.RedisCluster') as MockCluster:
+            first = redis_pool.get_client()
+            second = redis_pool.get_client()
+
+        self.assertIs(first, second)
+        self.assertEqual(MockCluster.call_count, 1)
+
+        args, kwargs = MockCluster.call_args
+        nodes = [(node.host, node.port) for node in kwargs['startup_nodes']]
+        self.assertEqual(nodes, [('10.0.0.1', 7000), ('10.0.0.2', 7001)])
+        self.assertEqual(kwargs['socket_timeout'], 0.25)
+        self.assertNotIn('host', kwargs)
+        self.assertNotIn('db', kwargs)
+
+    def test_auth_cluster_client(self):
+        group = auth.REDIS_GROUP_NAME
+        self._set_override('cluster', True, group)
+        self._set_override('ssl_enable', True, group)
+
+        with mock.patch('redis.cluster.RedisCluster') as MockCluster:
+            auth.get_auth_redis_client()
+
+        args, kwargs = MockCluster.call_args
+        nodes = [(node.host, node.port) for node in kwargs['startup_nodes']]
+        self.assertEqual(nodes, [('127.0.0.1', 6379)])
+        self.assertTrue(kwargs['ssl'])
+        self.assertNotIn('connection_class', kwargs)
+        self.assertNotIn('db', kwargs)
+
+    def test_node_pool(self):
+        pool = redis_pool.get_pool(node='10.0.0.2:6380')
+
+        self.assertIsNot(pool, redis_pool.get_pool())
+        self.assertIs(pool, redis_pool.get_pool(node='10.0.0.2:6380'))
+        self.assertEqual(pool.connection_kwargs['host'], '10.0.0.2')
+        self.assertEqual(pool.connection_kwargs['port'], 6380)
+
+    def test_auth_replicas(self):
+        group = auth.REDIS_GROUP_NAME
+        self._set_override('replicas', ['10.0.0.2:6379', '10.0.0.3:6379'],
+                           group)
+        self._set_override('redis_db', 2, group)
+
+        redis_client = auth.get_auth_redis_client()
+
+        self.assertIsInstance(redis_client, redis_pool.ReplicatedClient)
+        hosts = [replica.connection_pool.connection_kwargs['host']
+                 for replica in redis_client.replicas]
+        self.assertEqual(hosts, ['10.0.0.2', '10.0.0.3'])
+        for replica in redis_client.replicas:
+            self.assertEqual(replica.connection_pool.connection_kwargs['db'],
+                             2)
+        self.assertEqual(
+            redis_client.primary.connection_pool.connection_kwargs['host'],
+            '127.0.0.1')
+
+    def test_auth_redis_client(self):
+        group = auth.REDIS_GROUP_NAME
+        self._set_override('max_connections', 3, group)
+        self._set_override('redis_db', 2, group)
+
+        first = auth.get_auth_redis_client()
+        second = auth.get_auth_redis_client()
+
+        pool = first.connection_pool
+        self.assertIs(pool, second.connection_pool)
+        self.assertIsNot(pool, redis_pool.get_pool())
+        self.assertEqual(pool.max_connections, 3)
+        self.assertEqual(pool.connection_kwargs['db'], 2)
+        self.assertEqual(pool.connection_kwargs['port'], '6379')
+
+
+class TestRedisPoolMetrics(util.TestCase):
+
+    def setUp(self):
+        super(TestRedisPoolMetrics, self).setUp()
+        self.addCleanup(redis_pool.reset)
+        self.addCleanup(setattr, metrics, '_CLIENT', None)
+
+        self.client = RecordingStatsdClient()
+        metrics._CLIENT = self.client
+        self.prefix = metrics.stat_prefix() + '.redis.'
+
+        for group in (redis_pool.REDIS_GROUP_NAME, auth.REDIS_GROUP_NAME):
+            util.CONF.set_override('report_metrics', True, group)
+            self.addCleanup(util.CONF.clear_override, 'report_metrics',
+                            group)
+
+    def _get_client(self, group_name=redis_pool.REDIS_GROUP_NAME):
+        # NOTE: Connections to an in-memory server, made by the pool
+        # like any other connection.
+        pool = redis_pool.get_pool(group_name,
+                                   connection_class=FakeConnection,
+                                   server=fakeredis.FakeServer())
+        return redis_pool.make_client(pool)
+
+    def _stats(self, kind):
+        return [line.split(':')[0] for line in self.client.lines
+                if line.endswith('|' + kind)]
+
+    def test_governor_pool(self):
+        redis_client = self._get_client()
+        self.assertIsInstance(redis_client, redis_pool.StatsRedis)
+        self.assertIsInstance(redis_client.connection_pool,
+                              redis_pool.StatsConnectionPool)
+
+        redis_client.set('key', 'value')
+        self.assertEqual(redis_client.get('key'), b'value')
+
+        prefix = self.prefix + 'governor.'
+        self.assertEqual(self._stats('c'),
+                         [prefix + 'connections.created'])
+        self.assertEqual(self._stats('ms').count(prefix + 'pool.wait'), 2)
+        self.assertIn(prefix + 'command.set', self._stats('ms'))
+        self.assertIn(prefix + 'command.get', self._stats('ms'))
+
+        # NOTE: The connection was released after the last command.
+        gauges = [line for line in self.client.lines if line.endswith('|g')]
+        self.assertEqual(gauges[-2:],
+                         [prefix + 'pool.idle:1|g',
+                          prefix + 'pool.in_use:0|g'])
+
+        redis_client.connection_pool.disconnect()
+        self.assertEqual(self._stats('c')[-1],
+                         prefix + 'connections.closed')
+
+    def test_blocking_auth_pool(self):
+        util.CONF.set_override('blocking', True, auth.REDIS_GROUP_NAME)
+        self.addCleanup(util.CONF.clear_override, 'blocking',
+                        auth.REDIS_GROUP_NAME)
+
+        redis_client = self._get_client(auth.REDIS_GROUP_NAME)
+        self.assertIsInstance(redis_client.connection_pool,
+                              redis_pool.StatsBlockingConnectionPool)
+
+        conn = redis_client.connection_pool.get_connection('PING')
+        prefix = self.prefix + 'auth.'
+        self.assertEqual(self.client.lines[-2:],
+                         [prefix + 'pool.idle:0|g',
+                          prefix + 'pool.in_use:1|g'])
+
+        redis_client.connection_pool.release(conn)
+        self.assertEqual(self.client.lines[-2:],
+                         [prefix + 'pool.idle:1|g',
+                          prefix + 'pool.in_use:0|g'])
+
+    def test_no_metrics_by_default(self):
+        util.CONF.clear_override('report_metrics',
+                                 redis_pool.REDIS_GROUP_NAME)
+
+        redis_client = self._get_client()
+        self.assertNotIsInstance(redis_client, redis_pool.StatsRedis)
+
+        redis_client.set('key', 'value')
+        self.assertEqual(self.client.packets, [])
+
+
+class TestReplicatedClient(testtools.TestCase):
+
+    def setUp(self):
+        super(TestReplicatedClient, self).setUp()
+        self.primary = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+        self.replicas = [fakeredis.FakeRedis(server=fakeredis.FakeServer())
+                         for _ in range(2)]
+        self.client = redis_pool.ReplicatedClient(self.primary,
+                                                  self.replicas,
+                                                  exploration=0)
+
+    def test_writes_go_to_primary(self):
+        self.client.set('key', 'value')
+
+        self.assertEqual(self.primary.get('key'), b'value')
+        for replica in self.replicas:
+            self.assertIsNone(replica.get('key'))
+
+    def test_reads_go_to_fastest_replica(self):
+        for index, replica in enumerate(self.replicas):
+            replica.set('key', 'replica{0}'.format(index))
+        self.client.latencies = [0.5, 0.001]
+
+        for _ in range(10):
+            self.assertEqual(self.client.get('key'), b'replica1')
+
+    def test_miss_falls_back_to_primary(self):
+        self.primary.set('key', 'value')
+
+        self.assertEqual(self.client.get('key'), b'value')
+        self.assertIsNone(self.client.get_from_replica('key'))
+
+    def test_failing_replica_is_avoided(self):
+        self.primary.set('key', 'value')
+        self.replicas[1].set('key', 'value')
+
+        with mock.patch.object(self.replicas[0], 'get') as failing_get:
+            failing_get.side_effect = redis.ConnectionError('Mock - down')
+            self.client.latencies = [0.0, 0.01]
+
+            self.assertEqual(self.client.get_from_replica('key'), b'value')
+            self.assertEqual(self.client.latencies[0],
+                             redis_pool.DEFAULT_LATENCY_DECAY *
+                             redis_pool.FAILURE_LATENCY)
+
+            self.client.get_from_replica('key')
+            self.assertEqual(failing_get.call_count, 1)
+
+    def test_latency_moving_average(self):
+        client = redis_pool.ReplicatedClient(self.primary, self.replicas[:1],
+                                             decay=0.5)
+        client._observe(0, 1.0)
+        client._observe(0, 0.0)
+
+        self.assertEqual(client.latencies, [0.25])
@@ -0,0 +1,135 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import testtools
+
+from eom.utils import stats
+from tests.util.statsd_recording_client import RecordingStatsdClient
+
+
+class TestAggregator(testtools.TestCase):
+
+    def setUp(self):
+        super(TestAggregator, self).setUp()
+        self.client = RecordingStatsdClient()
+        self.aggregator = stats.Aggregator(self.client, flush_interval=60)
+        self.addCleanup(self.aggregator.stop)
+
+    def test_nothing_sent_until_flush(self):
+        self.aggregator.incr('a')
+        self.aggregator.timing('b', 10)
+        self.assertEqual(self.client.packets, [])
+
+        self.aggregator.flush()
+        self.assertEqual(len(self.client.packets), 1)
+
+    def test_counters_are_summed(self):
+        self.aggregator.incr('hits')
+        self.aggregator.incr('hits', 4)
+        self.aggregator.decr('hits', 2)
+        self.aggregator.flush()
+
+        self.assertEqual(self.client.lines, ['hits:3|c'])
+
+    def test_zero_counters_are_sent_once(self):
+        self.aggregator.incr('bucket')
+        self.aggregator.decr('bucket')
+        self.aggregator.flush()
+        self.aggregator.flush()
+
+        self.assertEqual(self.client.lines, ['bucket:0|c'])
+
+    def test_timings_and_gauges(self):
+        self.aggregator.timing('latency', 10)
+        self.aggregator.timing('latency', 20)
+        self.aggregator.gauge('depth', 5)
+        self.aggregator.gauge('depth', 2, delta=True)
+        self.aggregator.flush()
+
+        lines = self.client.lines
+        self.assertIn('latency:10.000000|ms', lines)
+        self.assertIn('latency:20.000000|ms', lines)
+        self.assertIn('depth:7|g', lines)
+
+    @mock.patch('random.random')
+    def test_timings_sampled_when_recorded(self, mock_random):
+        # NOTE: Kept samples are not sampled again when flushed.
+        mock_random.side_effect = [0.9, 0.1]
+        self.aggregator.timing('latency', 10, rate=0.5)
+        self.aggregator.timing('latency', 20, rate=0.5)
+        self.aggregator.flush()
+
+        self.assertEqual(self.client.lines, ['latency:20.000000|ms|@0.5'])
+
+    def test_flusher_started_once(self):
+        self.aggregator.incr('a')
+        flusher = self.aggregator._flusher
+        self.assertTrue(flusher.is_alive())
+
+        self.aggregator.incr('b')
+        self.assertIs(self.aggregator._flusher, flusher)
+
+        # Not started again once stopped
+        self.aggregator.stop()
+        flusher.join()
+        self.aggregator.incr('c')
+        self.assertIs(self.aggregator._flusher, flusher)
+
+    def test_histogram_percentiles_sent_as_gauges(self):
+        for value in range(1, 101):
+            self.aggregator.histogram('latency', value)
+        self.aggregator.flush()
+
+        gauges = dict(line.split('|')[0].split(':')
+                      for line in self.client.lines)
+        self.assertEqual(sorted(gauges),
+                         ['latency.max', 'latency.p50',
+                          'latency.p90', 'latency.p99'])
+        self.assertEqual(float(gauges['latency.max']), 100)
+        self.assertAlmostEqual(float(gauges['latency.p50']), 50, delta=1)
+        self.assertAlmostEqual(float(gauges['latency.p99']), 99, delta=1)
+
+    def test_histograms_reset_on_flush(self):
+        self.aggregator.histogram('latency', 5)
+        self.aggregator.flush()
+        self.aggregator.flush()
+
+        self.assertEqual(len(self.client.lines), 4)
+
+    def test_packets_respect_max_size(self):
+        for i in range(200):
+            self.aggregator.incr('counter.number.{0}'.format(i))
+        self.aggregator.flush()
+
+        self.assertGreater(len(self.client.packets), 1)
+        for packet in self.client.packets:
+            self.assertLess(len(packet), self.client._maxudpsize)
+        self.assertEqual(len(self.client.lines), 200)
+
+    def test_flusher_thread_started_lazily(self):
+        self.assertIsNone(self.aggregator._flusher)
+        self.aggregator.incr('a')
+        self.assertTrue(self.aggregator._flusher.is_alive())
+
+    def test_flush_failure_is_logged(self):
+        self.aggregator.incr('a')
+        with mock.patch.object(self.client, 'pipeline') as mock_pipeline:
+            mock_pipeline.side_effect = IOError('mock socket error')
+            self.aggregator.flush()
+
+    def test_invalid_flush_mode(self):
+        self.assertRaises(ValueError, stats.Aggregator,
+                          self.client, flush_mode='carrier-pigeon')
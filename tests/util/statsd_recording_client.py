@@ -0,0 +1,38 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import statsd.client
+
+
+class RecordingStatsdClient(statsd.client.StatsClientBase):
+
+    """statsd client that keeps the packets it would have sent."""
+
+    def __init__(self, prefix=None, maxudpsize=512):
+        self._prefix = prefix
+        self._maxudpsize = maxudpsize
+        self.packets = []
+
+    def _send(self, data):
+        self.packets.append(data)
+
+    def pipeline(self):
+        return statsd.client.Pipeline(self)
+
+    @property
+    def lines(self):
+        return [line
+                for packet in self.packets
+                for line in packet.split('\n')]